@@ -304,16 +304,17 @@ class RACECAR(object):
 
 class Laser(object):
 	"""docstring for Laser"""
-	def __init__(self, num_rays=None, min_angle=None, max_angle=None, max_range=None, range_method=None, frame=None, omap=None):
+	def __init__(self, num_rays=None, min_angle=None, max_angle=None, max_range=None, range_method=None, frame=None, omap=None, cache_dir=None):
 		self.max_range = max_range
 
 		self.laser_ranges = np.zeros(num_rays, dtype=np.float32)
 		self.laser_angles = np.linspace(min_angle, max_angle, num_rays, endpoint=True)
 		self.queries = np.zeros((num_rays, 3), dtype=np.float32)
 
-		map_msg = omap.map_msg
-		map_info = map_msg.info
-		oMap = range_libc.PyOMap(map_msg)
+		map_info = omap.map_info
+		# range_libc reads the occupancy matrix in place, which is much faster than the message data
+		oMap = range_libc.PyOMap(omap.raw_matrix, resolution=map_info.resolution,
+			origin=(map_info.origin.position.x, map_info.origin.position.y, omap.angle), occupied_threshold=10)
 		self.MAX_RANGE_PX = int(self.max_range / map_info.resolution)
 		self.THETA_DISCRETIZATION = 200
 
@@ -322,16 +323,16 @@ class Laser(object):
 		if range_method == "bl":
 			self.range_method = range_libc.PyBresenhamsLine(oMap, self.MAX_RANGE_PX)
 		elif "cddt" in range_method:
-			self.range_method = range_libc.PyCDDTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
-			if range_method == "pcddt":
-				print "Pruning..."
-				self.range_method.prune()
+			# lookup tables are cached on disk, so this is only slow the first time a map is used
+			self.range_method = utils.cached_range_method(range_libc.PyCDDTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+				prune=range_method == "pcddt", cache_dir=cache_dir)
 		elif range_method == "rm":
 			self.range_method = range_libc.PyRayMarching(oMap, self.MAX_RANGE_PX)
 		elif range_method == "rmgpu":
 			self.range_method = range_libc.PyRayMarchingGPU(oMap, self.MAX_RANGE_PX)
 		elif range_method == "glt":
-			self.range_method = range_libc.PyGiantLUTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+			self.range_method = utils.cached_range_method(range_libc.PyGiantLUTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+				cache_dir=cache_dir)
 		print "Simulated Laser Scanner Initialized..."
 
 	def simulate(self, state):
@@ -393,6 +394,7 @@ class Simulator(object):
 			self.laser_range_method = rospy.get_param("~laser_range_method")
 			self.laser_frame = rospy.get_param("~laser_frame")
 			self.laser_rate = rospy.get_param("~laser_rate")
+			self.laser_cache_dir = rospy.get_param("~laser_cache_dir", utils.CACHE_DIR)
 
 			self.laser_angle_increment = (self.laser_max_angle - self.laser_min_angle) / float(self.laser_rays)
 
@@ -402,7 +404,8 @@ class Simulator(object):
 				max_range=self.laser_max_range,
 				frame=self.laser_frame,
 				range_method=self.laser_range_method,
-				omap=self.omap)
+				omap=self.omap,
+				cache_dir=self.laser_cache_dir)
 
 			self.scan_msg = LaserScan()
 			self.scan_msg.header = utils.make_header(self.laser_frame, stamp=None)
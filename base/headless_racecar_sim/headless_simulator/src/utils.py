@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import scipy.ndimage
 import skimage.morphology
 import json, time, collections, recordclass
+import os, hashlib
 
 State = collections.namedtuple('State', ['x', 'y', 'theta'])
 ExtendedState = collections.namedtuple('State', ['x', 'y', 'theta', 'throttle']) # throttle: 1 - forwards, -1: backwards
@@ -48,7 +49,7 @@ class Map(object):
 
         self.cspace = None
         # 0: permissible, -1: unmapped, 100: blocked
-        self.raw_matrix = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
+        self.raw_matrix = np.array(map_msg.data, dtype=np.int8).reshape((map_msg.info.height, map_msg.info.width))
 
         # reversed from expectation since this is what distance_transform_edt requires
         self.occupancy_grid = np.ones_like(self.raw_matrix, dtype=bool)
@@ -194,6 +195,61 @@ class Timer:
     def fps(self):
         return self.arr.mean()
 
+# on-disk cache helpers, synced from localization_solution/src/utils.py. Make changes there
+# and copy them over rather than editing this copy. load_or_compute is left out, the simulator
+# only caches range method lookup tables
+
+# default location of the on-disk lookup table cache
+CACHE_DIR = os.path.join(os.environ.get("ROS_HOME", os.path.expanduser("~/.ros")), "headless_simulator_cache")
+
+def cache_path(name, key, extension, cache_dir=None):
+    """ Path of the on-disk cache entry for name. key is any object with a stable repr, such as
+        a tuple of parameters, and the path changes whenever key does.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s_%s.%s" % (name, digest, extension))
+
+def _write_cache_file(path, write):
+    """ Calls write(tmp_path) and moves the result to path, so that a concurrent reader never
+        sees a partial file. write returns False on failure.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if write(tmp_path) is not False:
+            os.rename(tmp_path, path)
+            return
+    except (IOError, OSError) as e:
+        print "WARNING:", e
+    print "WARNING: could not write cache file:", path
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+def cached_range_method(range_method_class, omap, max_range_px, theta_discretization, prune=False, cache_dir=None):
+    """ Returns a range_libc.PyCDDTCast or PyGiantLUTCast for omap. The lookup table is loaded from
+        the on-disk cache if it has been built for the same map, max range and theta discretization
+        before, otherwise it is built and saved for next time. Loaded giant LUTs are memory mapped,
+        so every process using the same map shares one copy of the table.
+    """
+    name = range_method_class.__name__ + ("_pruned" if prune else "")
+    key = (omap.hash(), int(max_range_px), int(theta_discretization))
+    path = cache_path(name, key, "bin", cache_dir)
+    if os.path.isfile(path):
+        range_method = range_method_class.load(path, omap)
+        if range_method is not None:
+            print "Loaded lookup table from:", path
+            return range_method
+        print "WARNING: ignoring unreadable cache file:", path
+
+    range_method = range_method_class(omap, max_range_px, theta_discretization)
+    if prune:
+        print "Pruning..."
+        range_method.prune()
+    _write_cache_file(path, range_method.save)
+    return range_method
+
 def angle_to_quaternion(angle):
     """Convert an angle in radians into a quaternion _message_."""
     return Quaternion(*tf.transformations.quaternion_from_euler(0, 0, angle))
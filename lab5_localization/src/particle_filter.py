@@ -56,6 +56,7 @@ import matplotlib.pyplot as plt
 import range_libc
 import time
 import utils as Utils
+from resampler import Resampler
 
 from threading import Lock
 
@@ -93,6 +94,12 @@ class ParticleFilter():
     self.THETA_DISCRETIZATION = int(rospy.get_param("~theta_discretization"))
     self.WHICH_RANGE_METHOD = rospy.get_param("~range_method", "cddt")
 
+    # One of multinomial, stratified, systematic or residual. See resampler.py.
+    self.RESAMPLER = rospy.get_param("~resampler", "systematic").lower()
+
+    # Directory for the on-disk sensor model cache.
+    self.CACHE_DIR = rospy.get_param("~cache_dir", Utils.CACHE_DIR)
+
     self.SUBSAMPLING_BIN_SIZE = 10 # Only take 1/this value of the scans
 
     # various data containers used in the MCL algorithm
@@ -119,6 +126,7 @@ class ParticleFilter():
 
     # Initialize weights to a uniform prior.
     self.weights = np.ones(self.MAX_PARTICLES) / float(self.MAX_PARTICLES)
+    self.resampler = Resampler(self.RESAMPLER)
     self.initialize_particles_gaussian(np.array([0.0, 0.0, 0.0]), np.array([0.1, 0.1, 0.01]))
 
     # Stores the latest laser scan data received.
@@ -171,7 +179,13 @@ class ParticleFilter():
     map_msg = rospy.ServiceProxy(map_service_name, GetMap)().map
 
     self.map_info = map_msg.info
-    oMap = range_libc.PyOMap(map_msg)
+    # 0: permissible, -1: unmapped, large value: blocked
+    array_255 = np.array(map_msg.data, dtype=np.int8).reshape((map_msg.info.height, map_msg.info.width))
+    # range_libc reads the array in place, which is much faster than passing it the message
+    oMap = range_libc.PyOMap(array_255, resolution=self.map_info.resolution,
+                             origin=(self.map_info.origin.position.x, self.map_info.origin.position.y,
+                                     Utils.quaternion_to_angle(self.map_info.origin.orientation)),
+                             occupied_threshold=10)
     # this value is the max range used internally in RangeLibc
     # it also should be the size of your sensor model table
 
@@ -183,21 +197,18 @@ class ParticleFilter():
     if self.WHICH_RANGE_METHOD == "bl":
       self.range_method = range_libc.PyBresenhamsLine(oMap, self.MAX_RANGE_PX)
     elif "cddt" in self.WHICH_RANGE_METHOD:
-      self.range_method = range_libc.PyCDDTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
-      if self.WHICH_RANGE_METHOD == "pcddt":
-        rospy.loginfo("Pruning...")
-        self.range_method.prune()
+      # Lookup tables are cached on disk, so this is only slow the first time a map is used.
+      self.range_method = Utils.cached_range_method(range_libc.PyCDDTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                    prune=self.WHICH_RANGE_METHOD == "pcddt", cache_dir=self.CACHE_DIR)
     elif self.WHICH_RANGE_METHOD == "rm":
       self.range_method = range_libc.PyRayMarching(oMap, self.MAX_RANGE_PX)
     elif self.WHICH_RANGE_METHOD == "rmgpu":
       self.range_method = range_libc.PyRayMarchingGPU(oMap, self.MAX_RANGE_PX)
     elif self.WHICH_RANGE_METHOD == "glt":
-      self.range_method = range_libc.PyGiantLUTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+      self.range_method = Utils.cached_range_method(range_libc.PyGiantLUTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                    cache_dir=self.CACHE_DIR)
     rospy.loginfo("Done loading map.")
 
-     # 0: permissible, -1: unmapped, large value: blocked
-    array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
-
     # 0: not permissible, 1: permissible
     # this may be useful for global particle initialization - don't initialize particles in non-permissible states
     self.permissible_region = np.zeros_like(array_255, dtype=bool)
@@ -370,21 +381,26 @@ class ParticleFilter():
     # if your table is not this size, you may encounter at best weirdness and at worst segfaults
     # MAX_RANGE_PX is simply the max range in meters scaled by the resolution of the map: self.map_info.resolution
     table_width = int(self.MAX_RANGE_PX) + 1
-    self.sensor_model_table = np.zeros((table_width,table_width))
 
-    # Call our sensor probability model for each discrete point in the table.
-    for i in xrange(table_width): # Expected pixel.
-      for j in xrange(table_width): # Measured pixel.
-        x = j * self.MAX_RANGE_METERS * 1. / self.MAX_RANGE_PX # Measured distance (meters).
-        y = i * self.MAX_RANGE_METERS * 1. / self.MAX_RANGE_PX # Expected distance (meters).
-        self.sensor_model_table[i][j] = self.probability_of_range(x, y)
+    def compute_table():
+      # Evaluate our sensor probability model for every discrete point in the table at once.
+      # Rows are expected pixels, columns are measured pixels.
+      px = np.arange(table_width, dtype=np.float64) * self.MAX_RANGE_METERS * 1. / self.MAX_RANGE_PX
+      table = self.probability_of_range(px[np.newaxis,:], px[:,np.newaxis])
 
-    # Make sure each row is normalized.
-    #for i in xrange(table_width):
-    #  self.sensor_model_table[i] /= np.sum(self.sensor_model_table[i])
+      # Make sure each row is normalized.
+      #table /= np.sum(table, axis=1)[:,np.newaxis]
 
-    # Scale.
-    self.sensor_model_table *= 20
+      # Scale.
+      table *= 20
+      return table
+
+    # The table only depends on the sensor model parameters, so it is cached on disk between runs.
+    start = time.time()
+    key = (self.PROBABILITY_OF_KNOWN_OBSTACLE, self.PROBABILITY_OF_SHORT_MEASUREMENT, self.PROBABILITY_OF_MISSED_MEASUREMENT,
+           self.PROBABILITY_OF_RANDOM_MEASUREMENT, self.GAUSSIAN_STD_DEV, int(self.MAX_RANGE_PX), self.MAX_RANGE_METERS)
+    self.sensor_model_table = Utils.load_or_compute("lab5_sensor_model", key, compute_table, self.CACHE_DIR)
+    rospy.loginfo("Sensor model ready in %.1f ms." % ((time.time() - start) * 1000.0))
 
     # Upload the sensor model to RangeLib for ultra fast resolution later.
     self.range_method.set_sensor_model(self.sensor_model_table)
@@ -429,16 +445,21 @@ class ParticleFilter():
     """
     Return the probability of observing measured_range given expected_range (groundtruth).
 
-    measured_range: (float) The measured range value in meters.
-    expected_range: (float) The expected range value in meters.
+    measured_range: (float or np.ndarray) The measured range value in meters.
+    expected_range: (float or np.ndarray) The expected range value in meters.
+
+    Arrays are broadcast against each other, so the whole table can be computed in one call.
     """
 
     # Factorization of the sensor model distribution.
     probability_if_known_obstacle = self.METERS_PER_PX \
                                   * (1./ (self.GAUSSIAN_STD_DEV * math.sqrt(2*math.pi))) \
-                                  * math.exp(-(measured_range - expected_range)**2 / (2 * self.GAUSSIAN_STD_DEV**2))
-    probability_if_short_measurement = 0.0 if expected_range == 0 else self.METERS_PER_PX * max(0., -2. * measured_range / expected_range**2 + 2. / expected_range)
-    probability_if_missed_measurement = 1. if measured_range >= (self.MAX_RANGE_METERS - 1e-2) else 0.
+                                  * np.exp(-(measured_range - expected_range)**2 / (2 * self.GAUSSIAN_STD_DEV**2))
+    # Avoid dividing by zero, the short measurement term is zero when the expected range is.
+    safe_expected_range = np.where(expected_range == 0, 1., expected_range)
+    probability_if_short_measurement = np.where(expected_range == 0, 0.0,
+      self.METERS_PER_PX * np.maximum(0., -2. * measured_range / safe_expected_range**2 + 2. / safe_expected_range))
+    probability_if_missed_measurement = np.where(measured_range >= (self.MAX_RANGE_METERS - 1e-2), 1., 0.)
     probability_if_random_measurement = self.METERS_PER_PX * 5. / self.MAX_RANGE_METERS
 
     final_probability = self.PROBABILITY_OF_KNOWN_OBSTACLE * probability_if_known_obstacle \
@@ -486,7 +507,7 @@ class ParticleFilter():
     """
     #time1 = time.time()
     # Sample poses from the current distribution.
-    samples = np.random.choice(self.particle_indices, size=self.particles.shape[0], p=self.weights)
+    samples = self.resampler.resample(self.weights)
 
     X_tm1 = self.particles[samples, :] # Samples from
     #time2 = time.time()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+'''
+Offline benchmark for the steady state MCL update of the particle filter.
+
+Runs the filter against a map image without a roscore: a synthetic scan is cast from a fixed pose
+and the filter is stepped repeatedly with a small constant odometry delta. Reports the time per
+MCL step for the current implementation and for the old resample/motion model, which built new
+particle arrays on every step, the latency percentiles of each stage of the current implementation,
+and checks that the particle buffers are reused between steps. Only the data pointers of those
+buffers are compared: small temporaries, such as the resampled index array, are still allocated on
+every step and are not counted. The ray casting dominates the step, so the two implementations can
+be within noise of each other.
+
+range_libc is used in its native pixel coordinate space here, so ranges are in pixels.
+
+Usage:
+    $ python mcl_benchmark.py --map ../maps/basement_fixed.png --particles 4000 --iters 500
+'''
+
+import argparse, os, time
+import numpy as np
+import range_libc
+import utils as Utils
+from particle_filter import ParticleFiler, VAR_REPEAT_ANGLES_EVAL_SENSOR_ONE_SHOT, STAGES
+
+class BenchmarkParticleFilter(ParticleFiler):
+    '''
+    Particle filter with the ROS plumbing stripped out. Parameters are set directly.
+    '''
+    def __init__(self, map_path, num_particles, max_range_px, theta_disc, range_method, angle_step, resampler, resample_threshold, kld, seed, sensor_threads=1):
+        self.ANGLE_STEP        = angle_step
+        self.MAX_PARTICLES     = num_particles
+        self.INV_SQUASH_FACTOR = 1.0 / 2.2
+        self.MAX_RANGE_PX      = max_range_px
+        self.THETA_DISCRETIZATION = theta_disc
+        self.WHICH_RM          = range_method
+        self.RANGELIB_VAR      = VAR_REPEAT_ANGLES_EVAL_SENSOR_ONE_SHOT
+        self.SHOW_FINE_TIMING  = False
+        self.SENSOR_THREADS    = sensor_threads
+        self.RESAMPLER         = resampler
+        self.RESAMPLE_THRESHOLD = resample_threshold
+        self.KLD_SAMPLING      = kld
+        self.MIN_PARTICLES     = min(500, num_particles)
+        self.KLD_EPSILON       = 0.05
+        self.KLD_Z             = 2.33
+        # 0.25m and 10 degree bins, assuming a 5cm map resolution
+        self.KLD_BIN_SIZE      = np.array([5.0, 5.0, 0.175])
+        self.MOTION_MODEL      = "odometry"
+        # the launch file defaults in pixels, again assuming a 5cm map resolution
+        self.MOTION_NOISE_FLOOR = np.array([0.2, 0.1, 0.01])
+        self.MOTION_NOISE_TRANS = 0.1
+        self.MOTION_NOISE_LATERAL = 0.05
+        self.MOTION_NOISE_ROT  = 0.2
+        self.MOTION_NOISE_ROT_PER_METER = 0.1 / 20.0
+        # None selects the default cache directory
+        self.CACHE_DIR         = None
+
+        self.iters = 0
+        self.first_sensor_update = True
+        self.queries = None
+        self.ranges = None
+        self.tiled_angles = None
+        self.sensor_model_table = None
+        self.inferred_pose = None
+        self.latency = Utils.StageLatencies(STAGES)
+        self.allocate_particle_buffers(seed)
+
+        self.omap = range_libc.PyOMap(map_path, 1)
+        if self.omap.error():
+            raise IOError("could not load map: " + map_path)
+        if self.WHICH_RM == "bl":
+            self.range_method = range_libc.PyBresenhamsLine(self.omap, self.MAX_RANGE_PX)
+        elif self.WHICH_RM == "rm":
+            self.range_method = range_libc.PyRayMarching(self.omap, self.MAX_RANGE_PX)
+        elif self.WHICH_RM == "glt":
+            self.range_method = range_libc.PyGiantLUTCast(self.omap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+        else:
+            self.range_method = range_libc.PyCDDTCast(self.omap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+        self.init_sensor_pool()
+        self.precompute_sensor_model()
+
+        # same field of view as the hokuyo, downsampled the same way lidarCB does it
+        laser_angles = np.linspace(-0.75*np.pi, 0.75*np.pi, 1081)
+        self.downsampled_angles = np.copy(laser_angles[0::self.ANGLE_STEP]).astype(np.float32)
+        self.observation = np.zeros(self.downsampled_angles.shape[0], dtype=np.float32)
+
+    def reset(self, pose):
+        ''' Scatters the particles around the given pose (in pixels) and casts the scan seen from it. '''
+        self.set_num_particles(self.MAX_PARTICLES)
+        self.particles[:,0] = pose[0] + self.rng.normal(0.0, 5.0, self.MAX_PARTICLES)
+        self.particles[:,1] = pose[1] + self.rng.normal(0.0, 5.0, self.MAX_PARTICLES)
+        self.particles[:,2] = pose[2] + self.rng.normal(0.0, 0.2, self.MAX_PARTICLES)
+        self.weights[:] = 1.0 / self.MAX_PARTICLES
+        self.n_eff = float(self.MAX_PARTICLES)
+
+        query = np.array([pose], dtype=np.float32)
+        self.range_method.calc_range_repeat_angles(query, self.downsampled_angles, self.observation)
+
+    def legacy_MCL(self, a, o):
+        ''' The MCL step as it was before the particle buffers were reused, for comparison. '''
+        proposal_indices = np.random.choice(self.particle_indices[:self.num_particles], self.num_particles, p=self.weights)
+        proposal_distribution = self.particles[proposal_indices,:]
+
+        local_deltas = np.zeros((self.num_particles, 3))
+        cosines = np.cos(proposal_distribution[:,2])
+        sines = np.sin(proposal_distribution[:,2])
+        local_deltas[:,0] = cosines*a[0] - sines*a[1]
+        local_deltas[:,1] = sines*a[0] + cosines*a[1]
+        local_deltas[:,2] = a[2]
+        proposal_distribution[:,:] += local_deltas
+        proposal_distribution[:,0] += np.random.normal(loc=0.0,scale=0.05,size=self.num_particles)
+        proposal_distribution[:,1] += np.random.normal(loc=0.0,scale=0.025,size=self.num_particles)
+        proposal_distribution[:,2] += np.random.normal(loc=0.0,scale=0.25,size=self.num_particles)
+
+        # the old code kept a fixed number of particles, copy them back into the particle store
+        self.sensor_model(proposal_distribution, o, self.weights)
+        range_libc.normalize_log_weights(self.weights, self.weights)
+        self.particles[:,:] = proposal_distribution
+
+    def buffer_addresses(self):
+        ''' Data pointers of every buffer touched by a steady state MCL step. '''
+        names = ["particle_store", "weight_buffer", "log_likelihood_buffer", "local_deltas", "cosines", "sines",
+                 "noise", "ranges", "observation", "action"]
+        return dict((name, getattr(self, name).__array_interface__["data"][0]) for name in names)
+
+def time_steps(step, pf, iters):
+    pf.action[:] = [0.5, 0.0, 0.01]
+    # warm up, the sensor model buffers are allocated on the first step
+    for i in xrange(5):
+        step(pf.action, pf.observation)
+    resamples = 0
+    t = time.time()
+    for i in xrange(iters):
+        step(pf.action, pf.observation)
+        resamples += pf.resampled
+    return (time.time() - t) / float(iters), resamples / float(iters)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the steady state MCL update.")
+    parser.add_argument("--map", default=os.path.join(os.path.dirname(__file__), "../maps/basement_fixed.png"))
+    parser.add_argument("--particles", type=int, default=4000)
+    parser.add_argument("--iters", type=int, default=500)
+    parser.add_argument("--max_range_px", type=int, default=200)
+    parser.add_argument("--theta_discretization", type=int, default=112)
+    parser.add_argument("--range_method", default="cddt")
+    parser.add_argument("--angle_step", type=int, default=18)
+    parser.add_argument("--resampler", default="systematic")
+    parser.add_argument("--resample_threshold", type=float, default=0.5,
+                        help="resample when N_eff drops below this fraction of the particles")
+    parser.add_argument("--sensor_threads", type=int, default=1)
+    parser.add_argument("--kld", action="store_true", help="enable KLD-sampling")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    pf = BenchmarkParticleFilter(args.map, args.particles, args.max_range_px, args.theta_discretization,
+                                 args.range_method, args.angle_step, args.resampler, args.resample_threshold, args.kld, args.seed,
+                                 args.sensor_threads)
+    start_pose = [pf.omap.width() / 2.0, pf.omap.height() / 2.0, 0.0]
+    print "particles:", args.particles, " rays:", pf.downsampled_angles.shape[0], " range method:", args.range_method, " resampler:", args.resampler, \
+          " sensor threads:", pf.SENSOR_THREADS
+
+    # check that the particles live in the double buffered store and nothing is reallocated
+    pf.reset(start_pose)
+    pf.MCL(pf.action, pf.observation)
+    before = pf.buffer_addresses()
+    for i in xrange(10):
+        pf.MCL(pf.action, pf.observation)
+    after = pf.buffer_addresses()
+    in_store = pf.particles.base is pf.particle_store and pf.weights.base is pf.weight_buffer
+    reallocated = [name for name in before if before[name] != after[name]]
+    print "particles are views of the particle store:", in_store
+    print "reallocated particle buffers:", reallocated if reallocated else "none"
+    print "particles in use after 11 steps:", pf.num_particles
+
+    pf.reset(start_pose)
+    pf.latency = Utils.StageLatencies(STAGES)
+    t_new, resample_rate = time_steps(pf.MCL, pf, args.iters)
+    latency = pf.latency
+    pf.reset(start_pose)
+    t_old, _ = time_steps(pf.legacy_MCL, pf, args.iters)
+
+    print "preallocated MCL: %.3f ms/iter (%d iters per sec), resampled on %d%% of steps" % \
+          (t_new * 1000.0, int(1.0 / t_new), int(100 * resample_rate))
+    print "legacy MCL:       %.3f ms/iter (%d iters per sec)" % (t_old * 1000.0, int(1.0 / t_old))
+    print "speedup:          %.2fx" % (t_old / t_new)
+    print
+    print "preallocated MCL latency per stage:"
+    print latency.table()
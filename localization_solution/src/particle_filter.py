@@ -5,18 +5,22 @@ import rospy
 import numpy as np
 import range_libc
 import time
-from threading import Lock
+from threading import Lock, Thread
+from multiprocessing.pool import ThreadPool
 import tf.transformations
 import tf
 import utils as Utils
+from resampler import Resampler, kld_sample_size
 
 # messages
-from std_msgs.msg import String, Header, Float32MultiArray
-from sensor_msgs.msg import LaserScan
+from std_msgs.msg import String, Header, Float32, Float32MultiArray
+from sensor_msgs.msg import LaserScan, Imu
 from visualization_msgs.msg import Marker
 from geometry_msgs.msg import Point, Pose, PoseStamped, PoseArray, Quaternion, PolygonStamped,Polygon, Point32, PoseWithCovarianceStamped, PointStamped
 from nav_msgs.msg import Odometry
 from nav_msgs.srv import GetMap
+from std_srvs.srv import Trigger, TriggerResponse
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 # visualization packages
 # import matplotlib.pyplot as plt
@@ -32,6 +36,9 @@ VAR_CALC_RANGE_MANY_EVAL_SENSOR = 1
 VAR_REPEAT_ANGLES_EVAL_SENSOR = 2
 VAR_REPEAT_ANGLES_EVAL_SENSOR_ONE_SHOT = 3
 
+# stages of update() whose latency is recorded, "update" is the whole call
+STAGES = ["resample", "motion", "sensor", "normalize", "publish", "update"]
+
 
 class ParticleFiler():
     '''
@@ -51,6 +58,60 @@ class ParticleFiler():
         self.SHOW_FINE_TIMING  = bool(rospy.get_param("~fine_timing", "0"))
         self.PUBLISH_ODOM      = bool(rospy.get_param("~publish_odom", "1"))
         self.DO_VIZ            = bool(rospy.get_param("~viz"))
+        # rate in Hz of the background thread that publishes the visualization topics
+        self.VIZ_RATE          = float(rospy.get_param("~viz_rate", "10"))
+        # rate in Hz of the per stage latency percentiles on /diagnostics, 0 disables them
+        self.DIAGNOSTIC_RATE   = float(rospy.get_param("~diagnostic_rate", "1"))
+        self.RESAMPLER         = rospy.get_param("~resampler", "systematic").lower()
+        # directory of the on-disk cache for tables that are slow to compute at startup
+        self.CACHE_DIR         = rospy.get_param("~cache_dir", Utils.CACHE_DIR)
+        # only resample when the effective sample size drops below this fraction of the particles
+        self.RESAMPLE_THRESHOLD = float(rospy.get_param("~resample_threshold", "0.5"))
+        # maximum rate of sensor model updates in Hz, 0 runs one for every new scan. Odometry
+        # messages in between only apply the motion model
+        self.MAX_SENSOR_RATE   = float(rospy.get_param("~max_sensor_rate", "0"))
+        # number of threads the sensor model is split across, each evaluates a slice of the particles
+        self.SENSOR_THREADS    = int(rospy.get_param("~sensor_threads", "1"))
+
+        # KLD-sampling: when enabled, max_particles is the capacity of the particle buffers and
+        # the number of particles in use varies between min_particles and max_particles
+        self.KLD_SAMPLING      = bool(rospy.get_param("~kld_sampling", "0"))
+        self.MIN_PARTICLES     = int(rospy.get_param("~min_particles", "500"))
+        self.KLD_EPSILON       = float(rospy.get_param("~kld_epsilon", "0.05"))
+        self.KLD_Z             = float(rospy.get_param("~kld_z", "2.33"))
+        self.KLD_BIN_SIZE      = np.array([float(rospy.get_param("~kld_bin_xy", "0.25")),
+                                           float(rospy.get_param("~kld_bin_xy", "0.25")),
+                                           float(rospy.get_param("~kld_bin_theta", "0.175"))])
+
+        # ~global_localize service: scores a coarse grid of poses over the permissible region against
+        # the latest scan, refines the best global_refine_k of them and seeds the particles around
+        # the best global_top_k refined poses
+        self.GLOBAL_XY_STEP       = float(rospy.get_param("~global_xy_step", "0.5"))
+        self.GLOBAL_THETA_BINS    = int(rospy.get_param("~global_theta_bins", "48"))
+        self.GLOBAL_REFINE_K      = int(rospy.get_param("~global_refine_k", "1000"))
+        self.GLOBAL_REFINE_LEVELS = int(rospy.get_param("~global_refine_levels", "2"))
+        self.GLOBAL_TOP_K         = int(rospy.get_param("~global_top_k", "100"))
+
+        # motion model: "odometry" scales the noise with how far the car moved and turned since the
+        # last update, "fixed" adds the same noise to every update
+        self.MOTION_MODEL      = rospy.get_param("~motion_model", "odometry").lower()
+        # standard deviation of the odometry noise in the frame of the car: a floor applied to every
+        # update, plus a fraction of the translation (x: along the motion, y: lateral) and of the rotation
+        self.MOTION_NOISE_FLOOR = np.array([float(rospy.get_param("~motion_noise_x", "0.01")),
+                                            float(rospy.get_param("~motion_noise_y", "0.005")),
+                                            float(rospy.get_param("~motion_noise_theta", "0.01"))])
+        self.MOTION_NOISE_TRANS = float(rospy.get_param("~motion_noise_trans", "0.1"))
+        self.MOTION_NOISE_LATERAL = float(rospy.get_param("~motion_noise_lateral", "0.05"))
+        self.MOTION_NOISE_ROT  = float(rospy.get_param("~motion_noise_rot", "0.2"))
+        # heading noise in radians per meter travelled
+        self.MOTION_NOISE_ROT_PER_METER = float(rospy.get_param("~motion_noise_rot_per_meter", "0.1"))
+
+        # the yaw rate of an IMU (sensor_msgs/Imu) is integrated between odometry messages and blended
+        # into the odometry rotation with this weight. An empty topic disables it
+        self.IMU_TOPIC         = rospy.get_param("~imu_topic", "")
+        self.IMU_YAW_WEIGHT    = float(rospy.get_param("~imu_yaw_weight", "1.0"))
+        # multiplies angular_velocity.z, -1 for an IMU mounted upside down
+        self.IMU_YAW_SCALE     = float(rospy.get_param("~imu_yaw_scale", "1.0"))
 
         # various data containers used in the MCL algorithm
         self.MAX_RANGE_PX = None
@@ -68,27 +129,49 @@ class ParticleFiler():
         self.last_time = None
         self.last_stamp = None
         self.first_sensor_update = True
+        self.new_scan = False
+        self.last_sensor_update = 0.0
+        self.imu_yaw_delta = 0.0
+        self.imu_samples = 0
+        self.last_imu_stamp = None
+        self.last_imu_yaw_rate = 0.0
+        # IMU yaw change over the same interval as odometry_data, None without IMU samples
+        self.odometry_imu_yaw = None
+        self.imu_lock = Lock()
         self.state_lock = Lock()
-
-        # cache this to avoid memory allocation in motion model
-        self.local_deltas = np.zeros((self.MAX_PARTICLES, 3))
+        # odometry pose the particles were last moved to by update()
+        self.odometry_pose = None
+        # serializes ~global_localize calls, which share the hypothesis buffers
+        self.global_localize_lock = Lock()
 
         # cache this for the sensor model computation
         self.queries = None
         self.ranges = None
         self.tiled_angles = None
         self.sensor_model_table = None
+        self.global_hypotheses = None
+        self.global_log_weights = None
+        # PoseArray layout of the visualized particles, never more than MAX_VIZ_PARTICLES of them
+        self.viz_pose_data = np.zeros((self.MAX_VIZ_PARTICLES, 7), dtype=np.float64)
+
+        # update() hands the state over to the visualization thread through a double buffer, and
+        # the visualization thread works on its own copy, so MCL never waits on the publishers
+        self.viz_state = Utils.DoubleBuffer(self.make_viz_state)
+        self.viz_copy = self.make_viz_state()
+        self.viz_resampler = Resampler("systematic", Utils.make_rng())
 
         # particle poses and weights
         self.inferred_pose = None
-        self.particle_indices = np.arange(self.MAX_PARTICLES)
-        self.particles = np.zeros((self.MAX_PARTICLES, 3))
-        self.weights = np.ones(self.MAX_PARTICLES) / float(self.MAX_PARTICLES)
+        self.allocate_particle_buffers()
 
         # initialize the state
         self.smoothing = Utils.CircularArray(10)
+        self.resample_history = Utils.CircularArray(10)
+        self.sensor_history = Utils.CircularArray(10)
         self.timer = Utils.Timer(10)
+        self.latency = Utils.StageLatencies(STAGES)
         self.get_omap()
+        self.init_sensor_pool()
         self.precompute_sensor_model()
         self.initialize_global()
 
@@ -97,6 +180,8 @@ class ParticleFiler():
         self.particle_pub  = rospy.Publisher("/pf/viz/particles", PoseArray, queue_size = 1)
         self.pub_fake_scan = rospy.Publisher("/pf/viz/fake_scan", LaserScan, queue_size = 1)
         self.rect_pub      = rospy.Publisher("/pf/viz/poly1", PolygonStamped, queue_size = 1)
+        self.n_eff_pub     = rospy.Publisher("/pf/n_eff", Float32, queue_size = 1)
+        self.diagnostic_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size = 1)
 
         if self.PUBLISH_ODOM:
             self.odom_pub      = rospy.Publisher("/pf/pose/odom", Odometry, queue_size = 1)
@@ -108,10 +193,73 @@ class ParticleFiler():
         self.laser_sub = rospy.Subscriber(rospy.get_param("~scan_topic", "/scan"), LaserScan, self.lidarCB, queue_size=1)
         self.odom_sub  = rospy.Subscriber(rospy.get_param("~odometry_topic", "/odom"), Odometry, self.odomCB, queue_size=1)
         self.pose_sub  = rospy.Subscriber("/initialpose", PoseWithCovarianceStamped, self.clicked_pose, queue_size=1)
+        if self.IMU_TOPIC:
+            self.imu_sub = rospy.Subscriber(self.IMU_TOPIC, Imu, self.imuCB, queue_size=10)
+        self.global_localize_srv = rospy.Service("~global_localize", Trigger, self.global_localize_cb)
         # self.click_sub = rospy.Subscriber("/clicked_point", PointStamped, self.clicked_pose, queue_size=1)
 
+        if self.DIAGNOSTIC_RATE > 0:
+            rospy.Timer(rospy.Duration(1.0 / self.DIAGNOSTIC_RATE), self.publish_diagnostics)
+        rospy.on_shutdown(self.print_latencies)
+
+        if self.DO_VIZ:
+            self.viz_thread = Thread(target=self.viz_loop, name="pf_viz")
+            self.viz_thread.daemon = True
+            self.viz_thread.start()
+
         print "Finished initializing, waiting on messages..."
 
+    def allocate_particle_buffers(self, seed=None):
+        '''
+        Allocate the particle state and every scratch buffer used by the resampling step and the
+        motion model. These are reused for the lifetime of the filter, so a steady state update()
+        never reallocates the particle buffers. It still allocates small temporaries, such as the
+        resampled indices and, on numpy < 1.17, the random draws.
+        '''
+        # particle poses and weights. The proposal distribution is drawn into the other half of
+        # the particle store and the two halves are swapped after every MCL step, so the particle
+        # arrays are never reallocated. self.particles and self.weights are views of the first
+        # num_particles entries of the active buffers, see set_num_particles.
+        # Everything is float32 like RangeLib, so the particles are ray cast without a conversion copy
+        self.particle_indices = np.arange(self.MAX_PARTICLES)
+        self.particle_store = np.zeros((2, self.MAX_PARTICLES, 3), dtype=np.float32)
+        self.active_store = 0
+        self.weight_buffer = np.zeros(self.MAX_PARTICLES, dtype=np.float32)
+        self.set_num_particles(self.MAX_PARTICLES)
+        self.weights[:] = 1.0 / self.MAX_PARTICLES
+        self.n_eff = float(self.MAX_PARTICLES)
+        self.resampled = False
+        # the sensor model writes the squashed log likelihood of each particle here, the weights are
+        # carried forward between resampling steps by multiplying these in
+        self.log_likelihood_buffer = np.zeros(self.MAX_PARTICLES, dtype=np.float32)
+
+        # cache these to avoid memory allocation in motion model
+        self.local_deltas = np.zeros((self.MAX_PARTICLES, 3), dtype=np.float32)
+        self.cosines = np.zeros(self.MAX_PARTICLES, dtype=np.float32)
+        self.sines = np.zeros(self.MAX_PARTICLES, dtype=np.float32)
+        self.noise = np.zeros((self.MAX_PARTICLES, 3), dtype=np.float32)
+        # standard deviation of the noise added to (x, y, theta) by the "fixed" motion model
+        self.motion_noise = np.array([0.05, 0.025, 0.25], dtype=np.float32)
+        # standard deviation of the noise on the action of the "odometry" motion model, set every update
+        self.action_noise = np.zeros(3, dtype=np.float32)
+
+        # the inputs to each MCL step are copied here, since the callbacks may replace them
+        self.action = np.zeros(3, dtype=np.float32)
+        self.observation = None
+
+        # persistent generator, so random samples can be written straight into the buffers above
+        self.rng = Utils.make_rng(seed)
+        self.resampler = Resampler(self.RESAMPLER, self.rng)
+
+    def set_num_particles(self, num_particles):
+        '''
+        Point self.particles and self.weights at the first num_particles entries of the active
+        buffers. Every other per-particle buffer is sliced to match when it is used.
+        '''
+        self.num_particles = num_particles
+        self.particles = self.particle_store[self.active_store,:num_particles]
+        self.weights = self.weight_buffer[:num_particles]
+
     def get_omap(self):
         '''
         Fetch the occupancy grid map from the map_server instance, and initialize the correct
@@ -122,9 +270,21 @@ class ParticleFiler():
         print("getting map from service: ", map_service_name)
         rospy.wait_for_service(map_service_name)
         map_msg = rospy.ServiceProxy(map_service_name, GetMap)().map
+        # 0: permissible, -1: unmapped, 100: blocked
+        array_255 = np.array(map_msg.data, dtype=np.int8).reshape((map_msg.info.height, map_msg.info.width))
+        self.init_omap(array_255, map_msg.info)
 
-        self.map_info = map_msg.info
-        oMap = range_libc.PyOMap(map_msg)
+    def init_omap(self, array_255, map_info):
+        '''
+        Initialize the range method and the permissible region from an occupancy grid array with
+        the values of an OccupancyGrid message, and its map metadata.
+        '''
+        self.map_info = map_info
+        # range_libc reads the array in place, which is much faster than passing it the message
+        oMap = range_libc.PyOMap(array_255, resolution=self.map_info.resolution,
+                                 origin=(self.map_info.origin.position.x, self.map_info.origin.position.y,
+                                         Utils.quaternion_to_angle(self.map_info.origin.orientation)),
+                                 occupied_threshold=10)
         self.MAX_RANGE_PX = int(self.MAX_RANGE_METERS / self.map_info.resolution)
 
         # initialize range method
@@ -132,26 +292,49 @@ class ParticleFiler():
         if self.WHICH_RM == "bl":
             self.range_method = range_libc.PyBresenhamsLine(oMap, self.MAX_RANGE_PX)
         elif "cddt" in self.WHICH_RM:
-            self.range_method = range_libc.PyCDDTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
-            if self.WHICH_RM == "pcddt":
-                print "Pruning..."
-                self.range_method.prune()
+            # lookup tables are cached on disk, so this is only slow the first time a map is used
+            self.range_method = Utils.cached_range_method(range_libc.PyCDDTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                          prune=self.WHICH_RM == "pcddt", cache_dir=self.CACHE_DIR)
         elif self.WHICH_RM == "rm":
             self.range_method = range_libc.PyRayMarching(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "rmgpu":
             self.range_method = range_libc.PyRayMarchingGPU(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "glt":
-            self.range_method = range_libc.PyGiantLUTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+            self.range_method = Utils.cached_range_method(range_libc.PyGiantLUTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                          cache_dir=self.CACHE_DIR)
         print "Done loading map"
 
-         # 0: permissible, -1: unmapped, 100: blocked
-        array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
-
         # 0: not permissible, 1: permissible
         self.permissible_region = np.zeros_like(array_255, dtype=bool)
         self.permissible_region[array_255==0] = 1
         self.map_initialized = True
 
+    def init_sensor_pool(self):
+        '''
+        Start the worker threads used to split the sensor model across particle shards. RangeLibc
+        releases the GIL while casting rays, so the shards run in parallel.
+        '''
+        self.sensor_pool = None
+        # whether the range method may be called from several threads at once
+        self.range_method_thread_safe = self.WHICH_RM != "rmgpu" and range_libc.THREAD_SAFE
+        if self.SENSOR_THREADS <= 1:
+            return
+        if not self.range_method_thread_safe:
+            print "WARNING: range method cannot be shared between threads, using a single sensor thread"
+            self.SENSOR_THREADS = 1
+            return
+        self.sensor_pool = ThreadPool(self.SENSOR_THREADS)
+
+    def run_sharded(self, fn, num_particles):
+        '''
+        Calls fn(start, end) for contiguous slices of the particles, on the sensor thread pool.
+        '''
+        shards = self.SENSOR_THREADS
+        if self.sensor_pool is None or num_particles < shards:
+            fn(0, num_particles)
+            return
+        self.sensor_pool.map(lambda i: fn(i*num_particles//shards, (i+1)*num_particles//shards), xrange(shards))
+
     def publish_tf(self,pose, stamp=None):
         """ Publish a tf for the car. This tells ROS where the car is with respect to the map. """
         if stamp == None:
@@ -193,47 +376,117 @@ class ParticleFiler():
         # Publish transform
         self.pub_tf.sendTransform(map_laser_pos, map_laser_rotation, stamp , "/base_link", "/map")
 
+    def make_viz_state(self):
+        '''
+        Buffers for the part of the filter state that is visualized.
+        '''
+        return {"particles": np.zeros((self.MAX_PARTICLES, 3), dtype=np.float32),
+                "weights": np.zeros(self.MAX_PARTICLES, dtype=np.float32),
+                "pose": np.zeros(3, dtype=np.float32),
+                "num_particles": 0,
+                "stamp": None,
+                # fake scan cast by update(), only used if the range method is not thread safe
+                "fake_scan": False,
+                "ranges": None}
+
+    def snapshot_viz_state(self):
+        '''
+        Copy the visualized state into the back slot of the double buffer and hand it over to the
+        visualization thread. Called by update() with the state lock held.
+        '''
+        state = self.viz_state.back()
+        n = self.num_particles
+        state["particles"][:n] = self.particles
+        state["weights"][:n] = self.weights
+        state["pose"][:] = self.inferred_pose
+        state["num_particles"] = n
+        state["stamp"] = self.last_stamp
+        # a range method that is not thread safe cannot cast the fake scan on the visualization
+        # thread next to the sensor model, so it is cast here with the state lock held
+        state["fake_scan"] = not self.range_method_thread_safe and self.pub_fake_scan.get_num_connections() > 0
+        if state["fake_scan"]:
+            if state["ranges"] is None:
+                state["ranges"] = np.zeros(self.downsampled_angles.shape[0], dtype=np.float32)
+            self.cast_fake_scan(self.inferred_pose, state["ranges"])
+        self.viz_state.publish()
+
+    def copy_viz_state(self, state):
+        n = state["num_particles"]
+        self.viz_copy["particles"][:n] = state["particles"][:n]
+        self.viz_copy["weights"][:n] = state["weights"][:n]
+        self.viz_copy["pose"][:] = state["pose"]
+        self.viz_copy["num_particles"] = n
+        self.viz_copy["stamp"] = state["stamp"]
+        self.viz_copy["fake_scan"] = state["fake_scan"]
+        if state["fake_scan"]:
+            if self.viz_copy["ranges"] is None:
+                self.viz_copy["ranges"] = np.zeros_like(state["ranges"])
+            self.viz_copy["ranges"][:] = state["ranges"]
+
+    def viz_loop(self):
+        '''
+        Body of the visualization thread: publishes the latest snapshot at up to viz_rate Hz.
+        '''
+        rate = rospy.Rate(self.VIZ_RATE)
+        version = 0
+        while not rospy.is_shutdown():
+            if self.viz_state.version != version:
+                version = self.viz_state.read(self.copy_viz_state)
+                self.visualize()
+            try:
+                rate.sleep()
+            except rospy.ROSInterruptException:
+                break
+
     def visualize(self):
         '''
-        Publish various visualization messages.
+        Publish various visualization messages from the latest snapshot of the filter state.
+        Runs on the visualization thread.
         '''
-        if not self.DO_VIZ:
-            return
+        pose = self.viz_copy["pose"]
+        n = self.viz_copy["num_particles"]
+        particles = self.viz_copy["particles"][:n]
 
-        if self.pose_pub.get_num_connections() > 0 and isinstance(self.inferred_pose, np.ndarray):
+        if self.pose_pub.get_num_connections() > 0:
             ps = PoseStamped()
             ps.header = Utils.make_header("map")
-            ps.pose.position.x = self.inferred_pose[0]
-            ps.pose.position.y = self.inferred_pose[1]
-            ps.pose.orientation = Utils.angle_to_quaternion(self.inferred_pose[2])
+            ps.pose.position.x = pose[0]
+            ps.pose.position.y = pose[1]
+            ps.pose.orientation = Utils.angle_to_quaternion(pose[2])
             self.pose_pub.publish(ps)
 
         if self.particle_pub.get_num_connections() > 0:
-            if self.MAX_PARTICLES > self.MAX_VIZ_PARTICLES:
-                # randomly downsample particles
-                proposal_indices = np.random.choice(self.particle_indices, self.MAX_VIZ_PARTICLES, p=self.weights)
-                # proposal_indices = np.random.choice(self.particle_indices, self.MAX_VIZ_PARTICLES)
-                self.publish_particles(self.particles[proposal_indices,:])
+            if n > self.MAX_VIZ_PARTICLES:
+                # downsample particles in proportion to their weights
+                proposal_indices = self.viz_resampler.resample(self.viz_copy["weights"][:n], self.MAX_VIZ_PARTICLES)
+                self.publish_particles(particles[proposal_indices,:])
             else:
-                self.publish_particles(self.particles)
+                self.publish_particles(particles)
+
+        if self.pub_fake_scan.get_num_connections() > 0:
+            if self.range_method_thread_safe:
+                self.cast_fake_scan(pose, self.viz_ranges)
+                self.publish_scan(self.downsampled_angles, self.viz_ranges, self.viz_copy["stamp"])
+            elif self.viz_copy["fake_scan"]:
+                # cast by update(), see snapshot_viz_state
+                self.publish_scan(self.downsampled_angles, self.viz_copy["ranges"], self.viz_copy["stamp"])
 
-        if self.pub_fake_scan.get_num_connections() > 0 and isinstance(self.ranges, np.ndarray):
-            # generate the scan from the point of view of the inferred position for visualization
-            self.viz_queries[:,0] = self.inferred_pose[0]
-            self.viz_queries[:,1] = self.inferred_pose[1]
-            self.viz_queries[:,2] = self.downsampled_angles + self.inferred_pose[2]
-            self.range_method.calc_range_many(self.viz_queries, self.viz_ranges)
-            self.publish_scan(self.downsampled_angles, self.viz_ranges)
+    def cast_fake_scan(self, pose, ranges):
+        '''
+        Generate the scan from the point of view of the given pose, for visualization.
+        '''
+        self.viz_queries[:,0] = pose[0]
+        self.viz_queries[:,1] = pose[1]
+        self.viz_queries[:,2] = self.downsampled_angles + pose[2]
+        self.range_method.calc_range_many(self.viz_queries, ranges)
 
     def publish_particles(self, particles):
-        pa = PoseArray()
-        pa.header = Utils.make_header("map")
-        pa.poses = Utils.particles_to_poses(particles)
-        self.particle_pub.publish(pa)
+        pose_data = Utils.particles_to_pose_data(particles, self.viz_pose_data[:particles.shape[0]])
+        self.particle_pub.publish(Utils.NumpyPoseArray(Utils.make_header("map"), pose_data))
 
-    def publish_scan(self, angles, ranges):
+    def publish_scan(self, angles, ranges, stamp=None):
         ls = LaserScan()
-        ls.header = Utils.make_header("laser", stamp=self.last_stamp)
+        ls.header = Utils.make_header("laser", stamp=stamp)
         ls.angle_min = np.min(angles)
         ls.angle_max = np.max(angles)
         ls.angle_increment = np.abs(angles[0] - angles[1])
@@ -242,6 +495,31 @@ class ParticleFiler():
         ls.ranges = ranges
         self.pub_fake_scan.publish(ls)
 
+    def publish_diagnostics(self, evt=None):
+        '''
+        Publish the latency percentiles of every stage of update() since startup on /diagnostics.
+        '''
+        if self.diagnostic_pub.get_num_connections() == 0:
+            return
+        da = DiagnosticArray()
+        da.header = Utils.make_header("")
+        for stage, count, p50, p95, p99, max_latency in self.latency.summary():
+            status = DiagnosticStatus()
+            status.level = DiagnosticStatus.OK
+            status.name = "particle_filter: %s latency" % stage
+            status.message = "p99 %.2f ms" % (p99 * 1000.0)
+            status.values = [KeyValue("count", str(count)),
+                             KeyValue("p50_ms", "%.3f" % (p50 * 1000.0)),
+                             KeyValue("p95_ms", "%.3f" % (p95 * 1000.0)),
+                             KeyValue("p99_ms", "%.3f" % (p99 * 1000.0)),
+                             KeyValue("max_ms", "%.3f" % (max_latency * 1000.0))]
+            da.status.append(status)
+        self.diagnostic_pub.publish(da)
+
+    def print_latencies(self):
+        print "Particle filter latency per stage since startup:"
+        print self.latency.table()
+
     def lidarCB(self, msg):
         '''
         Initializes reused buffers, and stores the relevant laser scanner data for later use.
@@ -252,9 +530,11 @@ class ParticleFiler():
             self.downsampled_angles = np.copy(self.laser_angles[0::self.ANGLE_STEP]).astype(np.float32)
             self.viz_queries = np.zeros((self.downsampled_angles.shape[0],3), dtype=np.float32)
             self.viz_ranges = np.zeros(self.downsampled_angles.shape[0], dtype=np.float32)
+            self.observation = np.zeros(self.downsampled_angles.shape[0], dtype=np.float32)
             print self.downsampled_angles.shape[0]
 
         self.downsampled_ranges = np.array(msg.ranges[::self.ANGLE_STEP])
+        self.new_scan = True
         self.lidar_initialized = True
         # self.update()
 
@@ -271,13 +551,17 @@ class ParticleFiler():
         orientation = Utils.quaternion_to_angle(msg.pose.pose.orientation)
         pose = np.array([position[0], position[1], orientation])
 
-        if isinstance(self.last_pose, np.ndarray):
-            rot = Utils.rotation_matrix(-self.last_pose[2])
-            delta = np.array([position - self.last_pose[0:2]]).transpose()
-            local_delta = (rot*delta).transpose()
+        # take the yaw integrated by imuCB since the last odometry message, so it covers the same
+        # interval as the odometry delta below even if update() skips this message
+        with self.imu_lock:
+            self.odometry_imu_yaw = self.imu_yaw_delta if self.imu_samples > 0 else None
+            self.imu_yaw_delta = 0.0
+            self.imu_samples = 0
 
-            # changes in x,y,theta in local coordinate system of the car
-            self.odometry_data = np.array([local_delta[0,0], local_delta[0,1], orientation - self.last_pose[2]])
+        if isinstance(self.last_pose, np.ndarray):
+            # changes in x,y,theta in local coordinate system of the car. The odometry heading is
+            # reported in (-pi, pi], relative_pose wraps the change
+            self.odometry_data = Utils.relative_pose(pose, self.last_pose)
             self.last_pose = pose
             self.last_stamp = msg.header.stamp
             self.odom_initialized = True
@@ -288,6 +572,30 @@ class ParticleFiler():
         # this topic is slower than lidar, so update every time we receive a message
         self.update()
 
+    def imuCB(self, msg):
+        '''
+        Integrate the yaw rate of the IMU until the next odometry message, see fuse_imu_yaw.
+        '''
+        stamp = msg.header.stamp.to_sec()
+        yaw_rate = self.IMU_YAW_SCALE * msg.angular_velocity.z
+        if self.last_imu_stamp is not None:
+            dt = stamp - self.last_imu_stamp
+            # skip over gaps and out of order messages rather than integrating across them
+            if 0.0 < dt < 0.5:
+                with self.imu_lock:
+                    self.imu_yaw_delta += 0.5 * (yaw_rate + self.last_imu_yaw_rate) * dt
+                    self.imu_samples += 1
+        self.last_imu_stamp = stamp
+        self.last_imu_yaw_rate = yaw_rate
+
+    def fuse_imu_yaw(self, action, imu_yaw_delta):
+        '''
+        Blend the change in heading measured by the IMU into the rotation of the odometry action.
+        The gyro is much more accurate than the heading of the wheel odometry, which slips and is
+        derived from the commanded steering angle.
+        '''
+        action[2] += self.IMU_YAW_WEIGHT * (imu_yaw_delta - action[2])
+
     def clicked_pose(self, msg):
         '''
         Receive pose messages from RViz and initialize the particle distribution in response.
@@ -304,7 +612,9 @@ class ParticleFiler():
         print "SETTING POSE"
         print pose
         self.state_lock.acquire()
-        self.weights = np.ones(self.MAX_PARTICLES) / float(self.MAX_PARTICLES)
+        self.set_num_particles(self.MAX_PARTICLES)
+        self.weights[:] = 1.0 / self.MAX_PARTICLES
+        self.n_eff = float(self.MAX_PARTICLES)
         self.particles[:,0] = pose.position.x + np.random.normal(loc=0.0,scale=0.5,size=self.MAX_PARTICLES)
         self.particles[:,1] = pose.position.y + np.random.normal(loc=0.0,scale=0.5,size=self.MAX_PARTICLES)
         self.particles[:,2] = Utils.quaternion_to_angle(pose.orientation) + np.random.normal(loc=0.0,scale=0.4,size=self.MAX_PARTICLES)
@@ -326,10 +636,141 @@ class ParticleFiler():
         permissible_states[:,2] = np.random.random(self.MAX_PARTICLES) * np.pi * 2.0
 
         Utils.map_to_world(permissible_states, self.map_info)
-        self.particles = permissible_states
+        self.set_num_particles(self.MAX_PARTICLES)
+        self.particles[:,:] = permissible_states
         self.weights[:] = 1.0 / self.MAX_PARTICLES
+        self.n_eff = float(self.MAX_PARTICLES)
         self.state_lock.release()
 
+    def make_global_hypotheses(self):
+        '''
+        Build the coarse grid of (x, y, theta) poses scored by global_localize: every permissible cell
+        of a grid global_xy_step apart, each with global_theta_bins evenly spaced headings. The map
+        does not change, so this is only done once.
+        '''
+        step = max(1, int(round(self.GLOBAL_XY_STEP / self.map_info.resolution)))
+        rows, cols = np.where(self.permissible_region[::step,::step])
+        cells = np.zeros((len(rows), 3), dtype=np.float32)
+        cells[:,0] = cols * step
+        cells[:,1] = rows * step
+        Utils.map_to_world(cells, self.map_info)
+
+        headings = np.arange(self.GLOBAL_THETA_BINS, dtype=np.float32) * np.float32(2.0 * np.pi / self.GLOBAL_THETA_BINS)
+        self.global_hypotheses = np.repeat(cells, self.GLOBAL_THETA_BINS, axis=0)
+        self.global_hypotheses[:,2] += np.tile(headings, len(rows))
+        self.global_log_weights = np.zeros(self.global_hypotheses.shape[0], dtype=np.float32)
+        print "Global localization grid:", len(rows), "cells x", self.GLOBAL_THETA_BINS, "headings"
+
+    def score_poses(self, poses, obs, log_weights):
+        '''
+        Batched log likelihood of each pose given the downsampled scan, sharded over the sensor pool.
+        '''
+        def score(start, end):
+            self.range_method.calc_range_repeat_angles_eval_sensor_model_log(poses[start:end],
+                self.downsampled_angles, obs, log_weights[start:end], self.INV_SQUASH_FACTOR)
+        self.run_sharded(score, poses.shape[0])
+
+    def rank_global_hypotheses(self, obs):
+        '''
+        Score the global hypothesis grid against the given downsampled scan in one batched sensor
+        model call. The coarse grid is too sparse to rank the true pose reliably, so the best
+        global_refine_k poses are refined coarse to fine: each is replaced by the best of a 3x3x3
+        neighbourhood at half the previous spacing, global_refine_levels times.
+
+        Returns the global_top_k best refined poses, their normalized weights, the spacing of the
+        last refinement level and the number of poses scored. Only the hypothesis buffers and the
+        range method are used, so this does not need the state lock if the range method is thread safe.
+        '''
+        if self.global_hypotheses is None:
+            self.make_global_hypotheses()
+        num_hypotheses = self.global_hypotheses.shape[0]
+        self.score_poses(self.global_hypotheses, obs, self.global_log_weights)
+        num_scored = num_hypotheses
+
+        m = min(self.GLOBAL_REFINE_K, num_hypotheses)
+        top = np.argpartition(self.global_log_weights, num_hypotheses - m)[num_hypotheses - m:]
+        poses = self.global_hypotheses[top]
+        log_weights = self.global_log_weights[top]
+
+        offsets = np.array(np.meshgrid([-1,0,1], [-1,0,1], [-1,0,1], indexing="ij"), dtype=np.float32).reshape(3,-1).T
+        spacing = np.array([self.GLOBAL_XY_STEP, self.GLOBAL_XY_STEP, 2.0 * np.pi / self.GLOBAL_THETA_BINS], dtype=np.float32)
+        for level in xrange(self.GLOBAL_REFINE_LEVELS):
+            spacing *= 0.5
+            neighbours = (poses[:,np.newaxis,:] + offsets * spacing).reshape(-1,3)
+            neighbour_weights = np.zeros(neighbours.shape[0], dtype=np.float32)
+            self.score_poses(neighbours, obs, neighbour_weights)
+            num_scored += neighbours.shape[0]
+            # the centre of each neighbourhood is the pose itself, so a pose never gets worse
+            best = np.argmax(neighbour_weights.reshape(m, -1), axis=1) + np.arange(m) * offsets.shape[0]
+            poses = neighbours[best]
+            log_weights = neighbour_weights[best]
+
+        k = min(self.GLOBAL_TOP_K, m)
+        top = np.argpartition(log_weights, m - k)[m - k:]
+        top_weights = log_weights[top]
+        range_libc.normalize_log_weights(top_weights, top_weights)
+        return poses[top], top_weights, spacing, num_scored
+
+    def seed_global_particles(self, poses, weights, spacing):
+        '''
+        Draw the particles from the given poses in proportion to their weights, spread by the given
+        spacing. Returns the best pose. The caller must hold the state lock.
+        '''
+        # seed the particles around the best poses, the MCL updates refine them from there
+        self.set_num_particles(self.MAX_PARTICLES)
+        seeds = self.resampler.resample(weights, self.MAX_PARTICLES)
+        np.take(poses, seeds, axis=0, out=self.particles)
+        noise = self.noise[:self.MAX_PARTICLES]
+        Utils.fill_standard_normal(self.rng, noise)
+        noise *= spacing
+        self.particles += noise
+        self.weights[:] = 1.0 / self.MAX_PARTICLES
+        self.n_eff = float(self.MAX_PARTICLES)
+        return poses[np.argmax(weights)]
+
+    def global_localize(self, obs):
+        '''
+        Relocalize from scratch with the given downsampled scan, see rank_global_hypotheses. The
+        particles are then drawn from the best refined poses. Returns the best pose and the number
+        of poses scored.
+
+        The caller must hold the state lock.
+        '''
+        poses, weights, spacing, num_scored = self.rank_global_hypotheses(obs)
+        return self.seed_global_particles(poses, weights, spacing), num_scored
+
+    def global_localize_cb(self, req):
+        '''
+        Handler of the ~global_localize service, relocalizes with the latest scan.
+
+        Scoring the hypotheses takes hundreds of milliseconds, so it runs without the state lock
+        and update() keeps moving the old particles meanwhile. The odometry applied in that time
+        is then applied to the seeded particles as well. A range method that is not thread safe
+        cannot score next to the sensor model, and holds the state lock throughout.
+        '''
+        if not (self.lidar_initialized and self.map_initialized):
+            return TriggerResponse(success=False, message="no scan received yet")
+        t = time.time()
+        with self.global_localize_lock:
+            with self.state_lock:
+                obs = np.copy(self.downsampled_ranges)
+                start_pose = self.odometry_pose
+            if self.range_method_thread_safe:
+                ranked = self.rank_global_hypotheses(obs)
+            else:
+                with self.state_lock:
+                    ranked = self.rank_global_hypotheses(obs)
+            poses, weights, spacing, num_hypotheses = ranked
+            with self.state_lock:
+                best = self.seed_global_particles(poses, weights, spacing)
+                # move the seeded particles by the odometry the old particles received while scoring
+                if start_pose is not None and self.odometry_pose is not start_pose:
+                    self.motion_update(Utils.relative_pose(self.odometry_pose, start_pose))
+        message = "scored %d poses in %.0f ms, best pose: (%.2f, %.2f, %.2f)" % \
+                  (num_hypotheses, (time.time() - t) * 1000.0, best[0], best[1], best[2])
+        print "GLOBAL LOCALIZATION", message
+        return TriggerResponse(success=True, message=message)
+
     def precompute_sensor_model(self):
         '''
         Generate and store a table which represents the sensor model. For each discrete computed
@@ -348,37 +789,35 @@ class ParticleFiler():
         c_r = 0.01
 
         table_width = int(self.MAX_RANGE_PX) + 1
-        self.sensor_model_table = np.zeros((table_width,table_width))
 
-        t = time.time()
-        # d is the computed range from RangeLibc
-        for d in xrange(table_width):
-            norm = 0.0
-            sum_unkown = 0.0
-            # r is the observed range from the lidar unit
-            for r in xrange(table_width):
-                prob = 0.0
-                z = float(r-d)
-                # reflects from the intended object
-                prob += z_hit * np.exp(-(z*z)/(2.0*sigma_hit*sigma_hit)) / (sigma_hit * np.sqrt(2.0*np.pi))
-
-                # observed range is less than the predicted range - short reading
-                if r < d:
-                    prob += 2.0 * z_short * (d - r) / float(d)
-
-                # erroneous max range measurement
-                if int(r) == int(self.MAX_RANGE_PX):
-                    prob += z_max
-
-                # random measurement
-                if r < int(self.MAX_RANGE_PX):
-                    prob += z_rand * 1.0/float(self.MAX_RANGE_PX)
-
-                norm += prob
-                self.sensor_model_table[int(r),int(d)] = prob
+        def compute_table():
+            # r is the observed range from the lidar unit, d is the computed range from RangeLibc.
+            # the table is indexed as [r,d], and is built in one shot by broadcasting
+            r = np.arange(table_width, dtype=np.float64)[:,np.newaxis]
+            d = np.arange(table_width, dtype=np.float64)[np.newaxis,:]
+            z = r - d
+
+            # reflects from the intended object
+            table = z_hit * np.exp(-(z*z)/(2.0*sigma_hit*sigma_hit)) / (sigma_hit * np.sqrt(2.0*np.pi))
+
+            # observed range is less than the predicted range - short reading
+            table += np.where(r < d, 2.0 * z_short * (d - r) / np.maximum(d, 1.0), 0.0)
+
+            # erroneous max range measurement
+            table[int(self.MAX_RANGE_PX),:] += z_max
+
+            # random measurement
+            table[:int(self.MAX_RANGE_PX),:] += z_rand * 1.0/float(self.MAX_RANGE_PX)
 
             # normalize
-            self.sensor_model_table[:,int(d)] /= norm
+            table /= np.sum(table, axis=0)
+            return table
+
+        # the table only depends on these, so it is cached on disk and loaded on later starts
+        t = time.time()
+        key = (z_hit, z_short, z_max, z_rand, sigma_hit, int(self.MAX_RANGE_PX))
+        self.sensor_model_table = Utils.load_or_compute("sensor_model", key, compute_table, self.CACHE_DIR)
+        print "Sensor model ready in", int((time.time() - t) * 1000.0), "ms"
 
         # upload the sensor model to RangeLib for ultra fast resolution
         if self.RANGELIB_VAR > 0:
@@ -416,40 +855,84 @@ class ParticleFiler():
             plt.ylabel("P(Measured Distance | Ground Truth Distance = 140px)")
             plt.show()
 
+    def odometry_noise(self, action):
+        '''
+        Standard deviation of the noise on each component of the action, in the frame of the car.
+        It grows with the distance travelled and the angle turned, so the particles spread out when
+        the car moves fast and stay tight when it is stationary or driving slowly.
+        '''
+        translation = np.hypot(action[0], action[1])
+        rotation = abs(action[2])
+        self.action_noise[0] = self.MOTION_NOISE_FLOOR[0] + self.MOTION_NOISE_TRANS * translation
+        self.action_noise[1] = self.MOTION_NOISE_FLOOR[1] + self.MOTION_NOISE_LATERAL * translation
+        self.action_noise[2] = self.MOTION_NOISE_FLOOR[2] + self.MOTION_NOISE_ROT * rotation \
+                               + self.MOTION_NOISE_ROT_PER_METER * translation
+        return self.action_noise
+
     def motion_model(self, proposal_dist, action):
         '''
         The motion model applies the odometry to the particle distribution. Since there the odometry
         data is inaccurate, the motion model mixes in gaussian noise to spread out the distribution.
 
+        With the "odometry" motion model every particle gets its own noisy copy of the action, with
+        noise that scales with the motion (see odometry_noise), which is then rotated into the frame
+        of the particle. The "fixed" motion model adds the same noise in the map frame regardless of
+        the motion.
+
         Vectorized motion model. Computing the motion model over all particles is thousands of times
         faster than doing it for each particle individually due to vectorization and reduction in
         function call overhead
-        
-        TODO this could be better, but it works for now
-            - fixed random noise is not very realistic
-            - ackermann model provides bad estimates at high speed
-        '''
-        # rotate the action into the coordinate space of each particle
-        # t1 = time.time()
-        cosines = np.cos(proposal_dist[:,2])
-        sines = np.sin(proposal_dist[:,2])
 
-        self.local_deltas[:,0] = cosines*action[0] - sines*action[1]
-        self.local_deltas[:,1] = sines*action[0] + cosines*action[1]
-        self.local_deltas[:,2] = action[2]
-
-        proposal_dist[:,:] += self.local_deltas
-        add_rand = 0.05
-        proposal_dist[:,0] += np.random.normal(loc=0.0,scale=add_rand,size=self.MAX_PARTICLES)
-        proposal_dist[:,1] += np.random.normal(loc=0.0,scale=add_rand*0.5,size=self.MAX_PARTICLES)
-        proposal_dist[:,2] += np.random.normal(loc=0.0,scale=0.25,size=self.MAX_PARTICLES)
+        TODO ackermann model provides bad estimates at high speed
+        '''
+        # the cached buffers are sized to the particle capacity, only use as many as needed
+        num_particles = proposal_dist.shape[0]
+        cosines = self.cosines[:num_particles]
+        sines = self.sines[:num_particles]
+        local_deltas = self.local_deltas[:num_particles]
+        noise = self.noise[:num_particles]
+
+        Utils.fill_standard_normal(self.rng, noise)
+        if self.MOTION_MODEL == "fixed":
+            dx, dy, dtheta = action[0], action[1], action[2]
+        else:
+            # noise becomes the per particle action
+            noise *= self.odometry_noise(action)
+            noise += action
+            dx, dy, dtheta = noise[:,0], noise[:,1], noise[:,2]
 
-    def sensor_model(self, proposal_dist, obs, weights):
+        # rotate the action into the coordinate space of each particle
+        # every operation writes into a cached buffer to avoid allocating temporaries
+        np.cos(proposal_dist[:,2], out=cosines)
+        np.sin(proposal_dist[:,2], out=sines)
+
+        # local_deltas[:,0] = cosines*dx - sines*dy
+        np.multiply(cosines, dx, out=local_deltas[:,0])
+        np.multiply(sines, dy, out=local_deltas[:,1])
+        np.subtract(local_deltas[:,0], local_deltas[:,1], out=local_deltas[:,0])
+        # local_deltas[:,1] = sines*dx + cosines*dy
+        np.multiply(sines, dx, out=local_deltas[:,1])
+        np.multiply(cosines, dy, out=cosines)
+        np.add(local_deltas[:,1], cosines, out=local_deltas[:,1])
+        local_deltas[:,2] = dtheta
+
+        proposal_dist += local_deltas
+
+        if self.MOTION_MODEL == "fixed":
+            # add scaled gaussian noise to x, y and theta
+            noise *= self.motion_noise
+            proposal_dist += noise
+
+    def sensor_model(self, proposal_dist, obs, log_likelihoods):
         '''
         This function computes a probablistic weight for each particle in the proposal distribution.
         These weights represent how probable each proposed (x,y,theta) pose is given the measured
         ranges from the lidar scanner.
 
+        The weights are written to log_likelihoods as logarithms, already raised to the power of
+        INV_SQUASH_FACTOR. RangeLib sums the log of the sensor model table, so the weights do not
+        underflow however many rays are used.
+
         There are 4 different variants using various features of RangeLibc for demonstration purposes.
         - VAR_REPEAT_ANGLES_EVAL_SENSOR is the most stable, and is very fast.
         - VAR_NO_EVAL_SENSOR_MODEL directly indexes the precomputed sensor model. This is slow
@@ -457,131 +940,180 @@ class ParticleFiler():
         '''
         
         num_rays = self.downsampled_angles.shape[0]
-        # only allocate buffers once to avoid slowness
+        num_particles = proposal_dist.shape[0]
+        # only allocate buffers once to avoid slowness. They are sized to the particle capacity
+        # and sliced to the number of particles in use
         if self.first_sensor_update:
             if self.RANGELIB_VAR <= 1:
                 self.queries = np.zeros((num_rays*self.MAX_PARTICLES,3), dtype=np.float32)
-            else:
-                self.queries = np.zeros((self.MAX_PARTICLES,3), dtype=np.float32)
 
             self.ranges = np.zeros(num_rays*self.MAX_PARTICLES, dtype=np.float32)
             self.tiled_angles = np.tile(self.downsampled_angles, self.MAX_PARTICLES)
             self.first_sensor_update = False
 
+        if self.RANGELIB_VAR <= 1:
+            queries = self.queries[:num_rays*num_particles]
+        else:
+            # the particles are float32 and contiguous, RangeLib reads them in place
+            queries = proposal_dist
+        ranges = self.ranges[:num_rays*num_particles]
+
+        # these evaluate the given slice of the particles, so they can be split across threads
+        def repeat_angles_eval_sensor(start, end):
+            self.range_method.calc_range_repeat_angles_eval_sensor_model_log(queries[start:end], self.downsampled_angles, obs,
+                log_likelihoods[start:end], self.INV_SQUASH_FACTOR)
+        def repeat_angles(start, end):
+            self.range_method.calc_range_repeat_angles(queries[start:end], self.downsampled_angles, ranges[start*num_rays:end*num_rays])
+        def eval_sensor(start, end):
+            self.range_method.eval_sensor_model_log(obs, ranges[start*num_rays:end*num_rays], log_likelihoods[start:end], num_rays, end-start,
+                self.INV_SQUASH_FACTOR)
+
         if self.RANGELIB_VAR == VAR_REPEAT_ANGLES_EVAL_SENSOR_ONE_SHOT:
-            self.queries[:,:] = proposal_dist[:,:]
-            self.range_method.calc_range_repeat_angles_eval_sensor_model(self.queries, self.downsampled_angles, obs, self.weights)
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
+            self.run_sharded(repeat_angles_eval_sensor, num_particles)
         elif self.RANGELIB_VAR == VAR_REPEAT_ANGLES_EVAL_SENSOR:
             if self.SHOW_FINE_TIMING:
                 t_start = time.time()
             # this version demonstrates what this would look like with coordinate space conversion pushed to rangelib
-            self.queries[:,:] = proposal_dist[:,:]
             if self.SHOW_FINE_TIMING:
                 t_init = time.time()
-            self.range_method.calc_range_repeat_angles(self.queries, self.downsampled_angles, self.ranges)
+            self.run_sharded(repeat_angles, num_particles)
             if self.SHOW_FINE_TIMING:
                 t_range = time.time()
             # evaluate the sensor model on the GPU
-            self.range_method.eval_sensor_model(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES)
+            self.run_sharded(eval_sensor, num_particles)
             if self.SHOW_FINE_TIMING:
                 t_eval = time.time()
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
-            if self.SHOW_FINE_TIMING:
-                t_squash = time.time()
-                t_total = (t_squash - t_start) / 100.0
+                t_total = (t_eval - t_start) / 100.0
 
             if self.SHOW_FINE_TIMING and self.iters % 10 == 0:
                 print "sensor_model: init: ", np.round((t_init-t_start)/t_total, 2), "range:", np.round((t_range-t_init)/t_total, 2), \
-                      "eval:", np.round((t_eval-t_range)/t_total, 2), "squash:", np.round((t_squash-t_eval)/t_total, 2)
+                      "eval:", np.round((t_eval-t_range)/t_total, 2)
         elif self.RANGELIB_VAR == VAR_CALC_RANGE_MANY_EVAL_SENSOR:
             # this version demonstrates what this would look like with coordinate space conversion pushed to rangelib
             # this part is inefficient since it requires a lot of effort to construct this redundant array
-            self.queries[:,0] = np.repeat(proposal_dist[:,0], num_rays)
-            self.queries[:,1] = np.repeat(proposal_dist[:,1], num_rays)
-            self.queries[:,2] = np.repeat(proposal_dist[:,2], num_rays)
-            self.queries[:,2] += self.tiled_angles
+            queries[:,0] = np.repeat(proposal_dist[:,0], num_rays)
+            queries[:,1] = np.repeat(proposal_dist[:,1], num_rays)
+            queries[:,2] = np.repeat(proposal_dist[:,2], num_rays)
+            queries[:,2] += self.tiled_angles[:num_rays*num_particles]
 
-            self.range_method.calc_range_many(self.queries, self.ranges)
+            self.range_method.calc_range_many(queries, ranges)
 
             # evaluate the sensor model on the GPU
-            self.range_method.eval_sensor_model(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES)
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
+            self.range_method.eval_sensor_model_log(obs, ranges, log_likelihoods, num_rays, num_particles, self.INV_SQUASH_FACTOR)
         elif self.RANGELIB_VAR == VAR_NO_EVAL_SENSOR_MODEL:
             # this version directly uses the sensor model in Python, at a significant computational cost
-            self.queries[:,0] = np.repeat(proposal_dist[:,0], num_rays)
-            self.queries[:,1] = np.repeat(proposal_dist[:,1], num_rays)
-            self.queries[:,2] = np.repeat(proposal_dist[:,2], num_rays)
-            self.queries[:,2] += self.tiled_angles
+            queries[:,0] = np.repeat(proposal_dist[:,0], num_rays)
+            queries[:,1] = np.repeat(proposal_dist[:,1], num_rays)
+            queries[:,2] = np.repeat(proposal_dist[:,2], num_rays)
+            queries[:,2] += self.tiled_angles[:num_rays*num_particles]
 
             # compute the ranges for all the particles in a single functon call
-            self.range_method.calc_range_many(self.queries, self.ranges)
+            self.range_method.calc_range_many(queries, ranges)
 
             # resolve the sensor model by discretizing and indexing into the precomputed table
             obs /= float(self.map_info.resolution)
-            ranges = self.ranges / float(self.map_info.resolution)
+            ranges = ranges / float(self.map_info.resolution)
             obs[obs > self.MAX_RANGE_PX] = self.MAX_RANGE_PX
             ranges[ranges > self.MAX_RANGE_PX] = self.MAX_RANGE_PX
 
             intobs = np.rint(obs).astype(np.uint16)
             intrng = np.rint(ranges).astype(np.uint16)
 
-            # compute the weight for each particle
-            for i in xrange(self.MAX_PARTICLES):
-                weight = np.product(self.sensor_model_table[intobs,intrng[i*num_rays:(i+1)*num_rays]])
-                weight = np.power(weight, self.INV_SQUASH_FACTOR)
-                weights[i] = weight
+            # compute the log weight for each particle
+            for i in xrange(num_particles):
+                log_weight = np.sum(np.log(self.sensor_model_table[intobs,intrng[i*num_rays:(i+1)*num_rays]]))
+                log_likelihoods[i] = log_weight * self.INV_SQUASH_FACTOR
         else:
             print "PLEASE SET rangelib_variant PARAM to 0-3"
 
     def MCL(self, a, o):
         '''
         Performs one step of Monte Carlo Localization.
-            1. resample particle distribution to form the proposal distribution
+            1. resample particle distribution to form the proposal distribution, only if the
+               effective sample size has dropped below the resample threshold
             2. apply the motion model
             3. apply the sensor model
-            4. normalize particle weights
+            4. multiply the likelihoods into the particle weights and normalize them
 
         This is in the critical path of code execution, so it is optimized for speed.
         '''
-        if self.SHOW_FINE_TIMING:
-            t = time.time()
-        # draw the proposal distribution from the old particles
-        proposal_indices = np.random.choice(self.particle_indices, self.MAX_PARTICLES, p=self.weights)
-        proposal_distribution = self.particles[proposal_indices,:]
-        if self.SHOW_FINE_TIMING:
-            t_propose = time.time()
+        t = time.time()
+        self.resampled = self.n_eff < self.RESAMPLE_THRESHOLD * self.num_particles
+        if self.resampled:
+            # pick how many particles to draw. KLD-sampling uses fewer as the distribution converges
+            if self.KLD_SAMPLING:
+                num_particles = kld_sample_size(self.particles, self.KLD_BIN_SIZE, self.KLD_EPSILON, self.KLD_Z,
+                    self.MIN_PARTICLES, self.MAX_PARTICLES)
+            else:
+                num_particles = self.num_particles
+
+            # draw the proposal distribution from the old particles, the chosen particles are
+            # gathered directly into the spare half of the particle store. An index past the
+            # particles in use raises rather than being clipped, so resampler bugs do not go unnoticed
+            proposal_indices = self.resampler.resample(self.weights, num_particles)
+            np.take(self.particles, proposal_indices, axis=0,
+                out=self.particle_store[1-self.active_store,:num_particles])
+
+            # save the particles, the old particle buffer becomes the next proposal buffer
+            self.active_store = 1 - self.active_store
+            self.set_num_particles(num_particles)
+            self.weights[:] = 1.0 / num_particles
+        # otherwise the particles are moved in place and keep their weights
+        proposal_distribution = self.particles
+        t_propose = time.time()
 
         # compute the motion model to update the proposal distribution
         self.motion_model(proposal_distribution, a)
-        if self.SHOW_FINE_TIMING:
-            t_motion = time.time()
+        t_motion = time.time()
 
         # compute the sensor model
-        self.sensor_model(proposal_distribution, o, self.weights)
-        if self.SHOW_FINE_TIMING:
-            t_sensor = time.time()
-
-        # normalize importance weights
-        self.weights /= np.sum(self.weights)
-        if self.SHOW_FINE_TIMING:
-            t_norm = time.time()
-            t_total = (t_norm - t)/100.0
+        log_likelihoods = self.log_likelihood_buffer[:self.num_particles]
+        self.sensor_model(proposal_distribution, o, log_likelihoods)
+        t_sensor = time.time()
+
+        # multiply in the likelihoods and normalize the importance weights in one pass
+        self.n_eff = range_libc.normalize_log_weights(log_likelihoods, self.weights, True)
+        t_norm = time.time()
+
+        if self.resampled:
+            self.latency.record("resample", t_propose - t)
+        self.latency.record("motion", t_motion - t_propose)
+        self.latency.record("sensor", t_sensor - t_motion)
+        self.latency.record("normalize", t_norm - t_sensor)
 
         if self.SHOW_FINE_TIMING and self.iters % 10 == 0:
+            t_total = (t_norm - t)/100.0
             print "MCL: propose: ", np.round((t_propose-t)/t_total, 2), "motion:", np.round((t_motion-t_propose)/t_total, 2), \
                   "sensor:", np.round((t_sensor-t_motion)/t_total, 2), "norm:", np.round((t_norm-t_sensor)/t_total, 2)
-
-        # save the particles
-        self.particles = proposal_distribution
     
+    def motion_update(self, a):
+        '''
+        Applies only the motion model. Used for odometry messages that arrive between sensor
+        updates: the particles are moved in place and keep their weights.
+        '''
+        self.resampled = False
+        t = time.time()
+        self.motion_model(self.particles, a)
+        self.latency.record("motion", time.time() - t)
+
+    def sensor_update_due(self):
+        '''
+        A sensor update is only worth its cost if a scan has arrived since the last one. The
+        ~max_sensor_rate param further limits how often they run.
+        '''
+        if not self.new_scan:
+            return False
+        return self.MAX_SENSOR_RATE <= 0 or time.time() - self.last_sensor_update >= 1.0 / self.MAX_SENSOR_RATE
+
     def expected_pose(self):
         # returns the expected value of the pose given the particle distribution
         return np.dot(self.particles.transpose(), self.weights)
 
     def update(self):
         '''
-        Apply the MCL function to update particle filter state. 
+        Apply the MCL function to update particle filter state. This is called for every
+        odometry message, but the sensor model only runs when a sensor update is due, the rest
+        of the time the particles are just moved by the motion model.
 
         Ensures the state is correctly initialized, and acquires the state lock before proceeding.
         '''
@@ -594,28 +1126,49 @@ class ParticleFiler():
                 self.iters += 1
 
                 t1 = time.time()
-                observation = np.copy(self.downsampled_ranges).astype(np.float32)
-                action = np.copy(self.odometry_data)
-                self.odometry_data = np.zeros(3)
-
-                # run the MCL update algorithm
-                self.MCL(action, observation)
+                # copy the latest data into the cached input buffers
+                self.action[:] = self.odometry_data
+                self.odometry_data[:] = 0.0
+                if self.odometry_imu_yaw is not None:
+                    self.fuse_imu_yaw(self.action, self.odometry_imu_yaw)
+
+                sensor_update = self.sensor_update_due()
+                if sensor_update:
+                    self.observation[:] = self.downsampled_ranges
+                    self.new_scan = False
+                    self.last_sensor_update = t1
+
+                    # run the MCL update algorithm
+                    self.MCL(self.action, self.observation)
+                else:
+                    self.motion_update(self.action)
 
                 # compute the expected value of the robot pose
                 self.inferred_pose = self.expected_pose()
+                self.odometry_pose = self.last_pose
+                if self.DO_VIZ:
+                    self.snapshot_viz_state()
                 self.state_lock.release()
                 t2 = time.time()
 
                 # publish transformation frame based on inferred pose
                 self.publish_tf(self.inferred_pose, self.last_stamp)
 
+                if self.n_eff_pub.get_num_connections() > 0:
+                    self.n_eff_pub.publish(Float32(self.n_eff))
+                t3 = time.time()
+                self.latency.record("publish", t3 - t2)
+                self.latency.record("update", t3 - t1)
+
                 # this is for tracking particle filter speed
                 ips = 1.0 / (t2 - t1)
                 self.smoothing.append(ips)
+                self.resample_history.append(self.resampled)
+                self.sensor_history.append(sensor_update)
                 if self.iters % 10 == 0:
-                    print "iters per sec:", int(self.timer.fps()), " possible:", int(self.smoothing.mean())
-
-                self.visualize()
+                    print "iters per sec:", int(self.timer.fps()), " possible:", int(self.smoothing.mean()), \
+                          " particles:", self.num_particles, " sensor:", "%d%%" % (100 * self.sensor_history.mean()), \
+                          " resampled:", "%d%%" % (100 * self.resample_history.mean())
 
 import argparse
 import sys
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+'''
+Offline replay of recorded laser scans and odometry through the particle filter.
+
+Loads a map_server map (YAML and image) and a recording from a rosbag or an NPZ file, and feeds it
+to the filter the way the node's callbacks would: every odometry message applies the motion model,
+and runs a full MCL step when a scan has arrived since the last one. No roscore is needed, and the
+random generators are seeded, so two runs over the same inputs produce the same particles.
+
+Reports the update rate, the latency percentiles of each stage and, when the recording has a
+reference trajectory, the position and heading error of the inferred pose. Results can be written
+as JSON so runs of different versions can be compared.
+
+Parameters are read from a YAML file of node parameters, the same format as the node's --config
+option. Missing parameters take the values in launch/localize.launch.
+
+NPZ layout, stamps in seconds:
+    scan_stamps (S,), scans (S, beams): ranges in meters
+    scan_angles (2,): angle_min and angle_max of the scans
+    odom_stamps (O,), odom (O, 3): x, y, theta of the odometry. theta is wrapped to (-pi, pi] on
+        load, as odometry messages report it
+    reference_stamps (P,), reference (P, 3): x, y, theta in the map frame, optional
+    imu_stamps (I,), imu_yaw_rate (I,): angular_velocity.z of an IMU in rad/s, optional. When present
+        it is fused into the odometry as the node does with ~imu_topic
+A bag can be converted with --save_npz, so machines without rosbag can replay it.
+
+Usage:
+    $ python replay.py --data run.bag --reference_topic /pf/pose/odom --save_npz run.npz
+    $ python replay.py --data run.npz --config params.yaml --seed 0 --output results.json
+'''
+
+import argparse, json, os, time
+import numpy as np
+import cv2
+import yaml
+import utils as Utils
+from threading import Lock
+from nav_msgs.msg import MapMetaData
+from particle_filter import ParticleFiler, STAGES
+
+# nothing is published during a replay
+REPLAY_STAGES = [stage for stage in STAGES if stage != "publish"]
+
+# parameter values of launch/localize.launch
+DEFAULT_PARAMS = {
+    "angle_step": 18,
+    "max_particles": 2000,
+    "squash_factor": 2.2,
+    "max_range": 10,
+    "theta_discretization": 112,
+    "range_method": "cddt",
+    "rangelib_variant": 3,
+    "fine_timing": 0,
+    "resampler": "systematic",
+    "resample_threshold": 0.5,
+    "max_sensor_rate": 0,
+    "sensor_threads": 1,
+    "kld_sampling": 0,
+    "min_particles": 500,
+    "kld_epsilon": 0.05,
+    "kld_z": 2.33,
+    "kld_bin_xy": 0.25,
+    "kld_bin_theta": 0.175,
+    "global_xy_step": 0.5,
+    "global_theta_bins": 48,
+    "global_refine_k": 1000,
+    "global_refine_levels": 2,
+    "global_top_k": 100,
+    "motion_model": "odometry",
+    "motion_noise_x": 0.01,
+    "motion_noise_y": 0.005,
+    "motion_noise_theta": 0.01,
+    "motion_noise_trans": 0.1,
+    "motion_noise_lateral": 0.05,
+    "motion_noise_rot": 0.2,
+    "motion_noise_rot_per_meter": 0.1,
+    "imu_yaw_weight": 1.0,
+    "imu_yaw_scale": 1.0,
+}
+
+def load_map(map_yaml):
+    '''
+    Read a map_server map into an array with the values of an OccupancyGrid message
+    (0: free, 100: occupied, -1: unknown) and its map metadata.
+    '''
+    with open(map_yaml) as f:
+        desc = yaml.safe_load(f)
+    image_path = os.path.join(os.path.dirname(os.path.abspath(map_yaml)), desc["image"])
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise IOError("could not load map image: " + image_path)
+
+    # same thresholds as map_server
+    occupancy = image / 255.0 if desc.get("negate", 0) else (255.0 - image) / 255.0
+    array_255 = np.full(image.shape, -1, dtype=np.int8)
+    array_255[occupancy > desc.get("occupied_thresh", 0.65)] = 100
+    array_255[occupancy < desc.get("free_thresh", 0.196)] = 0
+    # image rows go down, map rows go up
+    array_255 = np.ascontiguousarray(array_255[::-1])
+
+    map_info = MapMetaData()
+    map_info.resolution = desc["resolution"]
+    map_info.height, map_info.width = array_255.shape
+    map_info.origin.position.x = desc["origin"][0]
+    map_info.origin.position.y = desc["origin"][1]
+    map_info.origin.orientation = Utils.angle_to_quaternion(desc["origin"][2])
+    return array_255, map_info
+
+def message_pose(msg):
+    # Odometry and PoseWithCovarianceStamped nest the pose one level deeper than PoseStamped
+    pose = msg.pose.pose if hasattr(msg.pose, "pose") else msg.pose
+    return [pose.position.x, pose.position.y, Utils.quaternion_to_angle(pose.orientation)]
+
+def load_bag(path, scan_topic, odom_topic, reference_topic=None, imu_topic=None):
+    '''
+    Read the scans, odometry and optionally a reference trajectory (any Odometry, PoseStamped or
+    PoseWithCovarianceStamped topic) and the yaw rate of an IMU from a bag, into the NPZ layout.
+    '''
+    import rosbag
+    recording = {"scan_stamps": [], "scans": [], "odom_stamps": [], "odom": [], "reference_stamps": [], "reference": [],
+                 "imu_stamps": [], "imu_yaw_rate": []}
+    topics = [scan_topic, odom_topic] + [topic for topic in [reference_topic, imu_topic] if topic]
+    with rosbag.Bag(path) as bag:
+        for topic, msg, t in bag.read_messages(topics=topics):
+            stamp = msg.header.stamp.to_sec()
+            if topic == scan_topic:
+                recording["scan_stamps"].append(stamp)
+                recording["scans"].append(msg.ranges)
+                recording["scan_angles"] = [msg.angle_min, msg.angle_max]
+            elif topic == odom_topic:
+                recording["odom_stamps"].append(stamp)
+                recording["odom"].append(message_pose(msg))
+            elif topic == imu_topic:
+                recording["imu_stamps"].append(stamp)
+                recording["imu_yaw_rate"].append(msg.angular_velocity.z)
+            else:
+                recording["reference_stamps"].append(stamp)
+                recording["reference"].append(message_pose(msg))
+    if not recording["reference"]:
+        del recording["reference_stamps"], recording["reference"]
+    if not recording["imu_yaw_rate"]:
+        del recording["imu_stamps"], recording["imu_yaw_rate"]
+    return dict((key, np.array(value, dtype=np.float32 if key == "scans" else np.float64))
+                for key, value in recording.items())
+
+def load_recording(args):
+    if args.data.endswith(".npz"):
+        data = np.load(args.data)
+        recording = dict((key, data[key]) for key in data.files)
+        # a recording that was not read from a bag may carry a continuous heading, wrap it the
+        # way quaternion_to_angle does so that the replay crosses +-pi like the node does
+        odom = recording["odom"].copy()
+        odom[:,2] = np.arctan2(np.sin(odom[:,2]), np.cos(odom[:,2]))
+        recording["odom"] = odom
+        return recording
+    return load_bag(args.data, args.scan_topic, args.odom_topic, args.reference_topic, args.imu_topic)
+
+def odometry_deltas(odom):
+    ''' Changes in x, y, theta between consecutive odometry poses in the frame of the car, as odomCB computes them. '''
+    cosines, sines = np.cos(-odom[:-1,2]), np.sin(-odom[:-1,2])
+    dx, dy = np.diff(odom[:,0]), np.diff(odom[:,1])
+    deltas = np.zeros((odom.shape[0] - 1, 3), dtype=np.float32)
+    deltas[:,0] = cosines*dx - sines*dy
+    deltas[:,1] = sines*dx + cosines*dy
+    dtheta = np.diff(odom[:,2])
+    deltas[:,2] = np.arctan2(np.sin(dtheta), np.cos(dtheta))
+    return deltas
+
+def imu_yaw_deltas(imu_stamps, yaw_rates, stamps):
+    '''
+    Change in heading between consecutive stamps from the integrated IMU yaw rate, as imuCB
+    integrates it. NaN for the intervals the IMU does not cover.
+    '''
+    integral = np.zeros(imu_stamps.shape[0])
+    integral[1:] = np.cumsum(0.5 * (yaw_rates[1:] + yaw_rates[:-1]) * np.diff(imu_stamps))
+    return np.diff(np.interp(stamps, imu_stamps, integral, left=np.nan, right=np.nan))
+
+def interpolate_poses(stamps, reference_stamps, reference):
+    ''' Reference poses at the given stamps, NaN outside of the reference trajectory. '''
+    poses = np.zeros((stamps.shape[0], 3))
+    theta = np.unwrap(reference[:,2])
+    for i, values in enumerate([reference[:,0], reference[:,1], theta]):
+        poses[:,i] = np.interp(stamps, reference_stamps, values, left=np.nan, right=np.nan)
+    return poses
+
+def angle_difference(a, b):
+    return np.abs((a - b + np.pi) % (2.0 * np.pi) - np.pi)
+
+class ReplayParticleFilter(ParticleFiler):
+    '''
+    Particle filter with the ROS plumbing stripped out, driven from a recording.
+    '''
+    def __init__(self, params, map_yaml, seed):
+        self.ANGLE_STEP        = int(params["angle_step"])
+        self.MAX_PARTICLES     = int(params["max_particles"])
+        self.INV_SQUASH_FACTOR = 1.0 / float(params["squash_factor"])
+        self.MAX_RANGE_METERS  = float(params["max_range"])
+        self.THETA_DISCRETIZATION = int(params["theta_discretization"])
+        self.WHICH_RM          = str(params["range_method"]).lower()
+        self.RANGELIB_VAR      = int(params["rangelib_variant"])
+        self.SHOW_FINE_TIMING  = bool(params["fine_timing"])
+        self.RESAMPLER         = str(params["resampler"]).lower()
+        self.CACHE_DIR         = params.get("cache_dir", Utils.CACHE_DIR)
+        self.RESAMPLE_THRESHOLD = float(params["resample_threshold"])
+        self.MAX_SENSOR_RATE   = float(params["max_sensor_rate"])
+        self.SENSOR_THREADS    = int(params["sensor_threads"])
+        self.KLD_SAMPLING      = bool(params["kld_sampling"])
+        self.MIN_PARTICLES     = int(params["min_particles"])
+        self.KLD_EPSILON       = float(params["kld_epsilon"])
+        self.KLD_Z             = float(params["kld_z"])
+        self.KLD_BIN_SIZE      = np.array([float(params["kld_bin_xy"]), float(params["kld_bin_xy"]), float(params["kld_bin_theta"])])
+        self.GLOBAL_XY_STEP       = float(params["global_xy_step"])
+        self.GLOBAL_THETA_BINS    = int(params["global_theta_bins"])
+        self.GLOBAL_REFINE_K      = int(params["global_refine_k"])
+        self.GLOBAL_REFINE_LEVELS = int(params["global_refine_levels"])
+        self.GLOBAL_TOP_K         = int(params["global_top_k"])
+        self.MOTION_MODEL      = str(params["motion_model"]).lower()
+        self.MOTION_NOISE_FLOOR = np.array([float(params["motion_noise_x"]), float(params["motion_noise_y"]), float(params["motion_noise_theta"])])
+        self.MOTION_NOISE_TRANS = float(params["motion_noise_trans"])
+        self.MOTION_NOISE_LATERAL = float(params["motion_noise_lateral"])
+        self.MOTION_NOISE_ROT  = float(params["motion_noise_rot"])
+        self.MOTION_NOISE_ROT_PER_METER = float(params["motion_noise_rot_per_meter"])
+        self.IMU_YAW_WEIGHT    = float(params["imu_yaw_weight"])
+        self.IMU_YAW_SCALE     = float(params["imu_yaw_scale"])
+
+        self.iters = 0
+        self.first_sensor_update = True
+        self.queries = None
+        self.ranges = None
+        self.tiled_angles = None
+        self.sensor_model_table = None
+        self.global_hypotheses = None
+        self.global_log_weights = None
+        self.inferred_pose = None
+        self.state_lock = Lock()
+        self.latency = Utils.StageLatencies(REPLAY_STAGES)
+
+        # initialize_particles_pose and initialize_global draw from the global generator
+        np.random.seed(seed)
+        self.allocate_particle_buffers(seed)
+
+        array_255, map_info = load_map(map_yaml)
+        self.init_omap(array_255, map_info)
+        self.init_sensor_pool()
+        self.precompute_sensor_model()
+
+    def set_scan_geometry(self, angle_min, angle_max, beams):
+        ''' The same downsampled angles and observation buffer that lidarCB sets up on the first scan. '''
+        laser_angles = np.linspace(angle_min, angle_max, beams)
+        self.downsampled_angles = np.copy(laser_angles[0::self.ANGLE_STEP]).astype(np.float32)
+        self.observation = np.zeros(self.downsampled_angles.shape[0], dtype=np.float32)
+
+    def replay(self, recording, initial_pose=None):
+        '''
+        Step the filter through the recording. The particles start around initial_pose, around
+        the first reference pose, or are seeded by global_localize from the first scan.
+
+        Returns the inferred pose after every step, the odometry stamp of every step, the number
+        of sensor updates and the total time spent in the steps.
+        '''
+        scans, scan_stamps = recording["scans"], recording["scan_stamps"]
+        odom, odom_stamps = recording["odom"], recording["odom_stamps"]
+        self.set_scan_geometry(recording["scan_angles"][0], recording["scan_angles"][1], scans.shape[1])
+
+        # everything the callbacks would compute per message is prepared up front, outside the timing
+        observations = np.ascontiguousarray(scans[:,::self.ANGLE_STEP], dtype=np.float32)
+        deltas = odometry_deltas(odom)
+        step_stamps = odom_stamps[1:]
+        if "imu_yaw_rate" in recording:
+            imu_deltas = self.IMU_YAW_SCALE * imu_yaw_deltas(recording["imu_stamps"], recording["imu_yaw_rate"], odom_stamps)
+            covered = ~np.isnan(imu_deltas)
+            # the same blend as update(), applied to every step at once
+            fused = deltas[covered]
+            self.fuse_imu_yaw(fused.T, imu_deltas[covered])
+            deltas[covered] = fused
+        # latest scan received before each odometry message
+        latest_scan = np.searchsorted(scan_stamps, step_stamps, side="right") - 1
+        first = np.searchsorted(latest_scan, 0)
+        if first == len(step_stamps):
+            raise ValueError("no odometry after the first scan")
+
+        if initial_pose is None and "reference" in recording:
+            initial_pose = interpolate_poses(step_stamps[first:first+1], recording["reference_stamps"], recording["reference"])[0]
+            if np.isnan(initial_pose).any():
+                initial_pose = None
+        if initial_pose is not None:
+            self.initialize_particles_pose(Utils.particle_to_pose(initial_pose))
+        else:
+            self.global_localize(observations[latest_scan[first]])
+
+        poses = np.zeros((len(step_stamps) - first, 3))
+        last_scan = -1
+        last_sensor_stamp = -np.inf
+        sensor_updates = 0
+        elapsed = 0.0
+        for i in xrange(first, len(step_stamps)):
+            t = time.time()
+            self.iters += 1
+            self.action[:] = deltas[i]
+            # a sensor update is due for a scan that has not been used yet, subject to max_sensor_rate
+            scan = latest_scan[i]
+            if scan != last_scan and (self.MAX_SENSOR_RATE <= 0 or step_stamps[i] - last_sensor_stamp >= 1.0 / self.MAX_SENSOR_RATE):
+                last_scan = scan
+                last_sensor_stamp = step_stamps[i]
+                sensor_updates += 1
+                self.observation[:] = observations[scan]
+                self.MCL(self.action, self.observation)
+            else:
+                self.motion_update(self.action)
+            self.inferred_pose = self.expected_pose()
+            duration = time.time() - t
+            self.latency.record("update", duration)
+            elapsed += duration
+            poses[i - first] = self.inferred_pose
+        return poses, step_stamps[first:], sensor_updates, elapsed
+
+def pose_errors(poses, stamps, recording):
+    ''' Position and heading error statistics of the inferred poses against the reference trajectory. '''
+    reference = interpolate_poses(stamps, recording["reference_stamps"], recording["reference"])
+    covered = ~np.isnan(reference[:,0])
+    if not covered.any():
+        return None
+    position = np.hypot(poses[covered,0] - reference[covered,0], poses[covered,1] - reference[covered,1])
+    heading = angle_difference(poses[covered,2], reference[covered,2])
+    errors = {"steps": int(covered.sum())}
+    for name, values in [("position_m", position), ("heading_rad", heading)]:
+        errors[name] = {"mean": float(np.mean(values)), "median": float(np.median(values)),
+                        "p95": float(np.percentile(values, 95)), "max": float(np.max(values))}
+    return errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded scans and odometry through the particle filter.")
+    parser.add_argument("--map", default=os.path.join(os.path.dirname(__file__), "../maps/basement_fixed.map.yaml"),
+                        help="map_server YAML file of the map")
+    parser.add_argument("--data", required=True, help="recording, a .bag or a .npz file")
+    parser.add_argument("--config", default=None, help="YAML file of node parameters, as for particle_filter.py --config")
+    parser.add_argument("--scan_topic", default="/scan")
+    parser.add_argument("--odom_topic", default="/vesc/odom")
+    parser.add_argument("--reference_topic", default=None, help="topic of the reference trajectory in a bag")
+    parser.add_argument("--imu_topic", default=None, help="sensor_msgs/Imu topic in a bag, fused into the odometry")
+    parser.add_argument("--initial_pose", type=float, nargs=3, default=None, metavar=("X", "Y", "THETA"),
+                        help="start pose in the map frame, defaults to the first reference pose or global localization")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save_npz", default=None, help="save the recording in the NPZ layout and exit")
+    parser.add_argument("--output", default=None, help="path of the JSON results")
+    args = parser.parse_args()
+
+    recording = load_recording(args)
+    if args.save_npz:
+        np.savez_compressed(args.save_npz, **recording)
+        print "saved recording to:", args.save_npz
+    else:
+        params = dict(DEFAULT_PARAMS)
+        if args.config:
+            with open(args.config) as f:
+                params.update(yaml.safe_load(f) or {})
+
+        pf = ReplayParticleFilter(params, args.map, args.seed)
+        poses, stamps, sensor_updates, elapsed = pf.replay(recording, args.initial_pose)
+        duration = stamps[-1] - stamps[0]
+
+        print
+        print "steps:", len(stamps), " sensor updates:", sensor_updates, " particles:", pf.MAX_PARTICLES, \
+              " range method:", pf.WHICH_RM, " recording: %.1f s" % duration
+        print "%.1f updates per sec, %.2f ms per update, %.1fx real time" % \
+              (len(stamps) / elapsed, elapsed / len(stamps) * 1000.0, duration / elapsed)
+        print
+        print pf.latency.table()
+
+        errors = pose_errors(poses, stamps, recording) if "reference" in recording else None
+        if errors:
+            print
+            print "pose error over %d steps:" % errors["steps"]
+            for name in ["position_m", "heading_rad"]:
+                print "    %-12s mean %.3f  median %.3f  p95 %.3f  max %.3f" % \
+                      (name, errors[name]["mean"], errors[name]["median"], errors[name]["p95"], errors[name]["max"])
+
+        if args.output:
+            report = {
+                "params": params,
+                "seed": args.seed,
+                "steps": len(stamps),
+                "sensor_updates": sensor_updates,
+                "updates_per_sec": len(stamps) / elapsed,
+                "real_time_factor": duration / elapsed,
+                "stages": [dict(zip(["stage", "count", "p50", "p95", "p99", "max"], row)) for row in pf.latency.summary()],
+                "pose_error": errors,
+                "final_pose": poses[-1].tolist(),
+            }
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            print "saved results to:", args.output
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+''' Resampling schemes for the particle filter.
+
+    All schemes draw N particle indices in proportion to the particle weights, they differ in how
+    much noise the draw adds:
+
+    "multinomial": N independent draws from the weight distribution. Highest variance.
+    "stratified":  one uniform draw inside each of N equal strata of [0,1). Lower variance.
+    "systematic":  a single uniform offset shared by N evenly spaced positions. Lowest variance,
+                   and only one random number per resample.
+    "residual":    floor(N*w) copies of every particle are kept deterministically, the remaining
+                   particles are drawn multinomially from the residual weights.
+
+    kld_sample_size picks the number of particles to draw with KLD-sampling (Fox, 2003).
+
+    This file has no ROS dependencies so that it can be benchmarked on its own.
+
+    This is the canonical copy. lab5_localization and obstacle_mapping carry identical copies
+    of it, since the ROS packages do not share python modules: edit this file and copy it over.
+'''
+
+import numpy as np
+
+METHODS = ("multinomial", "stratified", "systematic", "residual")
+
+def _fill_uniform(rng, out):
+    # the Generator API (numpy >= 1.17) can write into out, RandomState cannot
+    if isinstance(rng, np.random.RandomState):
+        out[...] = rng.random_sample(out.shape)
+    else:
+        rng.random(out=out)
+
+class Resampler(object):
+    """ Draws particle indices in proportion to the particle weights.
+
+        Scratch buffers are cached and only reallocated when the number of particles grows,
+        so resampling at a fixed particle count only allocates the returned index array.
+    """
+    def __init__(self, method="systematic", rng=None):
+        if not method in METHODS:
+            raise ValueError("Unknown resampler: %s, must be one of %s" % (method, ", ".join(METHODS)))
+        self.method = method
+        if rng is None:
+            rng = np.random.default_rng() if hasattr(np.random, "default_rng") else np.random.RandomState()
+        self.rng = rng
+        self.capacity = 0
+        self._resample = getattr(self, "_" + method)
+
+    def _reserve(self, n):
+        if n <= self.capacity:
+            return
+        self.capacity = n
+        self.cum_weights = np.zeros(n)
+        self.positions = np.zeros(n)
+        self.counts = np.zeros(n, dtype=np.intp)
+        self.arange = np.arange(n, dtype=np.intp)
+
+    def resample(self, weights, num_samples=None):
+        """ Returns an array of num_samples particle indices, by default as many as there are
+            weights. Weights must sum to one.
+        """
+        n = weights.shape[0]
+        m = n if num_samples is None else num_samples
+        self._reserve(max(n, m))
+        return self._resample(weights, n, m)
+
+    def _cdf(self, weights, n):
+        cum_weights = self.cum_weights[:n]
+        np.cumsum(weights, out=cum_weights)
+        # guard against round off leaving the last bin short of 1.0
+        cum_weights[-1] = 1.0
+        return cum_weights
+
+    def _multinomial(self, weights, n, m):
+        cum_weights = self._cdf(weights, n)
+        positions = self.positions[:m]
+        _fill_uniform(self.rng, positions)
+        return np.searchsorted(cum_weights, positions, side="right")
+
+    def _stratified(self, weights, n, m):
+        cum_weights = self._cdf(weights, n)
+        positions = self.positions[:m]
+        _fill_uniform(self.rng, positions)
+        positions += self.arange[:m]
+        positions *= 1.0 / m
+        # positions are sorted, which keeps the binary search cache friendly
+        return np.searchsorted(cum_weights, positions, side="right")
+
+    def _systematic(self, weights, n, m):
+        # positions are (u + j) / m for j in [0, m). The number of positions below C_i is
+        # ceil(m*C_i - u), so each particle's offspring count falls out of the cdf in O(n)
+        ends = self._cdf(weights, n)
+        ends *= m
+        ends -= self.rng.uniform()
+        np.ceil(ends, out=ends)
+        ends[-1] = m
+        return self._repeat_cumulative(ends, n, m)
+
+    def _residual(self, weights, n, m):
+        scaled = self.positions[:n]
+        np.multiply(weights, m, out=scaled)
+        counts = self.counts[:n]
+        counts[:] = scaled
+        remaining = m - int(counts.sum())
+        if remaining > 0:
+            # draw the rest from the fractional parts of m*w
+            scaled -= counts
+            cum_weights = self.cum_weights[:n]
+            np.cumsum(scaled, out=cum_weights)
+            cum_weights *= 1.0 / cum_weights[-1]
+            cum_weights[-1] = 1.0
+            draws = np.searchsorted(cum_weights, self.rng.uniform(size=remaining), side="right")
+            counts += np.bincount(draws, minlength=n)
+        return np.repeat(self.arange[:n], counts)
+
+    def _repeat_cumulative(self, ends, n, m):
+        # ends holds the cumulative offspring count of each particle
+        counts = self.counts[:n]
+        np.clip(ends, 0, m, out=ends)
+        counts[0] = ends[0]
+        np.subtract(ends[1:], ends[:-1], out=counts[1:], casting="unsafe")
+        return np.repeat(self.arange[:n], counts)
+
+def effective_sample_size(weights):
+    """ Kish's effective sample size of a normalized weight vector. """
+    return 1.0 / np.dot(weights, weights)
+
+def kld_sample_size(particles, bin_size, epsilon, z, min_particles, max_particles):
+    """ Number of particles needed so that, with probability given by the normal quantile z,
+        the KL divergence between the particle approximation and the true posterior stays
+        below epsilon. The posterior is assumed to occupy the (x, y, theta) bins of the given
+        size that currently contain a particle.
+    """
+    bins = np.floor(particles / bin_size).astype(np.int64)
+    bins[:,2] %= int(np.ceil(2.0 * np.pi / bin_size[2]))
+    # pack each bin into a single integer so that occupied bins can be counted with np.unique
+    bins -= bins.min(axis=0)
+    extent = bins.max(axis=0) + 1
+    keys = (bins[:,0] * extent[1] + bins[:,1]) * extent[2] + bins[:,2]
+    k = np.unique(keys).shape[0]
+    if k <= 1:
+        return min_particles
+    # Wilson-Hilferty approximation of the chi-square quantile with k-1 degrees of freedom
+    a = 2.0 / (9.0 * (k - 1))
+    n = (k - 1) / (2.0 * epsilon) * (1.0 - a + np.sqrt(a) * z) ** 3
+    return int(min(max(np.ceil(n), min_particles), max_particles))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+'''
+Microbenchmark for the resampling schemes in resampler.py.
+
+For each particle count, a weight vector shaped like a converged sensor model update is
+resampled repeatedly with every scheme, and with np.random.choice as the old baseline. Reported:
+
+    ms:        wall time per resample
+    unique:    fraction of distinct particles that survive one resample
+    retention: unique survivors divided by the effective sample size of the weights. Higher
+               means less of the information in the weights is thrown away by resampling.
+    noise:     mean squared difference between each particle's offspring count and N*w_i
+
+Usage:
+    $ python resampler_benchmark.py --particles 1000 10000 100000
+'''
+
+import argparse, time
+import numpy as np
+from resampler import Resampler, METHODS, effective_sample_size
+
+def make_weights(n, rng):
+    # gaussian likelihood of a random offset, similar to a sensor model update near convergence
+    offsets = rng.normal(0.0, 1.0, n)
+    weights = np.exp(-0.5 * offsets * offsets / 0.25)
+    return weights / np.sum(weights)
+
+def measure(resample, weights, iters):
+    n = weights.shape[0]
+    expected = n * weights
+    unique = 0.0
+    noise = 0.0
+    t = time.time()
+    for i in range(iters):
+        indices = resample(weights)
+    elapsed = (time.time() - t) / float(iters)
+    # statistics are computed outside of the timed loop
+    for i in range(iters):
+        counts = np.bincount(resample(weights), minlength=n)
+        unique += np.count_nonzero(counts) / float(n)
+        noise += np.mean((counts - expected) ** 2)
+    return elapsed, unique / iters, noise / iters
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark particle filter resampling schemes.")
+    parser.add_argument("--particles", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    for n in args.particles:
+        weights = make_weights(n, rng)
+        n_eff = effective_sample_size(weights)
+        print("particles: %d  N_eff: %.0f (%.2f)" % (n, n_eff, n_eff / n))
+        print("    %-12s %10s %8s %10s %8s" % ("method", "ms", "unique", "retention", "noise"))
+
+        indices = np.arange(n)
+        schemes = [("choice", lambda w: rng.choice(indices, n, p=w))]
+        schemes += [(method, Resampler(method, rng).resample) for method in METHODS]
+        for name, resample in schemes:
+            elapsed, unique, noise = measure(resample, weights, args.iters)
+            print("    %-12s %10.3f %8.3f %10.3f %8.3f" % (name, elapsed * 1000.0, unique, unique * n / n_eff, noise))
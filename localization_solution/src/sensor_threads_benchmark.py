@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+'''
+Scaling benchmark for the multi-threaded sensor model.
+
+Evaluates the sensor model for a fixed particle set with 1 to 8 threads and reports the time per
+evaluation, the speedup over a single thread and the parallel efficiency. The particles are split
+into one contiguous shard per thread, and RangeLibc releases the GIL while it casts rays.
+
+Usage:
+    $ python sensor_threads_benchmark.py --particles 4000 --range_method cddt --rangelib_variant 3
+'''
+
+import argparse, multiprocessing, os, time
+import numpy as np
+from mcl_benchmark import BenchmarkParticleFilter
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sensor model scaling across threads.")
+    parser.add_argument("--map", default=os.path.join(os.path.dirname(__file__), "../maps/basement_fixed.png"))
+    parser.add_argument("--particles", type=int, default=4000)
+    parser.add_argument("--iters", type=int, default=100)
+    parser.add_argument("--max_range_px", type=int, default=200)
+    parser.add_argument("--theta_discretization", type=int, default=112)
+    parser.add_argument("--range_method", default="cddt")
+    parser.add_argument("--rangelib_variant", type=int, default=3, choices=[2, 3])
+    parser.add_argument("--angle_step", type=int, default=18)
+    parser.add_argument("--max_threads", type=int, default=8)
+    args = parser.parse_args()
+
+    pf = BenchmarkParticleFilter(args.map, args.particles, args.max_range_px, args.theta_discretization,
+                                 args.range_method, args.angle_step, "systematic", 0.5, False, 0)
+    pf.RANGELIB_VAR = args.rangelib_variant
+    pf.reset([pf.omap.width() / 2.0, pf.omap.height() / 2.0, 0.0])
+    weights = np.zeros(args.particles)
+
+    print "particles:", args.particles, " rays:", pf.downsampled_angles.shape[0], " range method:", args.range_method, \
+          " variant:", args.rangelib_variant, " cores:", multiprocessing.cpu_count()
+    print "    %-8s %10s %8s %11s" % ("threads", "ms", "speedup", "efficiency")
+    reference = None
+    baseline = None
+    for threads in xrange(1, args.max_threads + 1):
+        pf.SENSOR_THREADS = threads
+        pf.init_sensor_pool()
+        if pf.SENSOR_THREADS != threads:
+            break
+        # warm up the buffers and the worker threads
+        pf.sensor_model(pf.particles, pf.observation, weights)
+        t = time.time()
+        for i in xrange(args.iters):
+            pf.sensor_model(pf.particles, pf.observation, weights)
+        elapsed = (time.time() - t) / float(args.iters)
+        if pf.sensor_pool is not None:
+            pf.sensor_pool.terminate()
+
+        # every thread count must produce the same weights
+        if reference is None:
+            reference = np.copy(weights)
+            baseline = elapsed
+        elif not np.allclose(weights, reference):
+            print "ERROR: weights computed with", threads, "threads do not match the single threaded result"
+        print "    %-8d %10.3f %8.2f %11.2f" % (threads, elapsed * 1000.0, baseline / elapsed, baseline / elapsed / threads)
@@ -2,6 +2,7 @@
 
 import rospy
 import numpy as np
+import os, hashlib, struct
 
 from std_msgs.msg import Header
 from visualization_msgs.msg import Marker
@@ -53,6 +54,137 @@ class Timer:
     def fps(self):
         return self.arr.mean()
 
+class LatencyHistogram(object):
+    """ Fixed size histogram of durations for tail latency, in the style of HdrHistogram.
+
+        Durations are recorded in whole microseconds. Values below 2 * 2^SUB_BITS are counted
+        exactly; above that every power of two is split into 2^SUB_BITS equal buckets, so any
+        reported percentile is within 1/2^SUB_BITS (about 3%) of the true value. Recording is a
+        couple of integer operations and a counter increment, and nothing is allocated.
+    """
+    SUB_BITS = 5
+
+    def __init__(self, max_seconds=60.0):
+        self.max_value = int(max_seconds * 1e6)
+        self.counts = np.zeros(self.index(self.max_value) + 1, dtype=np.int64)
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return ((shift + 1) << self.SUB_BITS) + (value >> shift) - (1 << self.SUB_BITS)
+
+    def highest_equivalent(self, index):
+        """ Largest value counted in the bucket at index. """
+        if index < 2 << self.SUB_BITS:
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        sub_bucket = (index & ((1 << self.SUB_BITS) - 1)) + (1 << self.SUB_BITS)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        # time.time() can step backwards, a negative duration would otherwise index from the end
+        value = min(max(int(seconds * 1e6), 0), self.max_value)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, percentiles):
+        """ Returns the given percentiles in seconds, or zeros if nothing was recorded. """
+        if self.total == 0:
+            return [0.0] * len(percentiles)
+        cumulative = np.cumsum(self.counts)
+        total = cumulative[-1]
+        result = []
+        for percentile in percentiles:
+            index = np.searchsorted(cumulative, max(1, int(np.ceil(total * percentile / 100.0))))
+            result.append(min(self.highest_equivalent(int(index)), self.max) * 1e-6)
+        return result
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.max = 0
+
+class StageLatencies(object):
+    """ One LatencyHistogram per named stage of a loop, for reporting p50/p95/p99/max. """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.histograms = dict((stage, LatencyHistogram()) for stage in self.stages)
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def summary(self):
+        """ List of (stage, count, p50, p95, p99, max) for every stage, durations in seconds. """
+        rows = []
+        for stage in self.stages:
+            histogram = self.histograms[stage]
+            rows.append(tuple([stage, histogram.total] + histogram.percentiles(self.PERCENTILES) + [histogram.max * 1e-6]))
+        return rows
+
+    def table(self):
+        lines = ["%-10s %8s %9s %9s %9s %9s" % ("stage", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        for stage, count, p50, p95, p99, max_latency in self.summary():
+            lines.append("%-10s %8d %9.3f %9.3f %9.3f %9.3f" % (stage, count, p50 * 1e3, p95 * 1e3, p99 * 1e3, max_latency * 1e3))
+        return "\n".join(lines)
+
+class DoubleBuffer(object):
+    """ Lock free handoff of the latest state from one writer thread to one reader thread.
+
+        The writer fills back() and then calls publish(), which swaps the slots. The reader
+        calls read(copy) to copy out of the front slot; if the writer published over that slot
+        in the meantime, the copy may be torn and is retried. The writer never waits.
+
+        make_slot is called twice to build the two slots, for example a dict of numpy buffers.
+    """
+    def __init__(self, make_slot):
+        self.slots = [make_slot(), make_slot()]
+        self.front = 0
+        # number of publishes so far, lets the reader detect new and overwritten data
+        self.version = 0
+
+    def back(self):
+        return self.slots[1 - self.front]
+
+    def publish(self):
+        self.front = 1 - self.front
+        self.version += 1
+
+    def read(self, copy):
+        """ Calls copy(slot) with the latest published slot and returns its version. """
+        while True:
+            # version must be read before front: the writer only reuses the front slot after
+            # publishing over it, which increments version before the slot is written again
+            version = self.version
+            copy(self.slots[self.front])
+            if self.version == version:
+                return version
+
+# the Generator API (numpy >= 1.17) can write random samples into preallocated buffers,
+# the legacy RandomState API always allocates a fresh array for every draw
+HAS_GENERATOR = hasattr(np.random, "default_rng")
+
+def make_rng(seed=None):
+    """ Returns a persistent random number generator. Keep one of these around rather than
+        calling the np.random module functions, which go through the global state.
+    """
+    if HAS_GENERATOR:
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+def fill_standard_normal(rng, out):
+    """ Fills the given float32 or float64 buffer with samples from N(0,1). """
+    if HAS_GENERATOR:
+        rng.standard_normal(out=out, dtype=out.dtype)
+    else:
+        out[...] = rng.standard_normal(out.shape)
+
 def angle_to_quaternion(angle):
     """Convert an angle in radians into a quaternion _message_."""
     return Quaternion(*tf.transformations.quaternion_from_euler(0, 0, angle))
@@ -69,6 +201,15 @@ def rotation_matrix(theta):
     c, s = np.cos(theta), np.sin(theta)
     return np.matrix([[c, -s], [s, c]])
 
+def relative_pose(pose, reference):
+    """ Change in x, y, theta from reference to pose, in the frame of reference. The heading change
+        is wrapped to (-pi, pi], so that crossing +-pi is not a 2pi turn.
+    """
+    c, s = np.cos(reference[2]), np.sin(reference[2])
+    dx, dy = pose[0] - reference[0], pose[1] - reference[1]
+    dtheta = pose[2] - reference[2]
+    return np.array([c*dx + s*dy, -s*dx + c*dy, np.arctan2(np.sin(dtheta), np.cos(dtheta))])
+
 def particle_to_pose(particle):
     pose = Pose()
     pose.position.x = particle[0]
@@ -76,8 +217,46 @@ def particle_to_pose(particle):
     pose.orientation = angle_to_quaternion(particle[2])
     return pose
 
+def particles_to_pose_data(particles, out=None):
+    """ Vectorized conversion of (N,3) particles into the (N,7) float64 layout of the poses in a
+        PoseArray message: position x, y, z followed by orientation x, y, z, w. For a rotation
+        about z only, the quaternion is (0, 0, sin(theta/2), cos(theta/2)).
+    """
+    if out is None:
+        out = np.empty((particles.shape[0], 7), dtype=np.float64)
+    out[:,:2] = particles[:,:2]
+    out[:,2:5] = 0.0
+    # half angles in double precision, staged in the qz column
+    np.multiply(particles[:,2], 0.5, out=out[:,5])
+    np.cos(out[:,5], out=out[:,6])
+    np.sin(out[:,5], out=out[:,5])
+    return out
+
 def particles_to_poses(particles):
-    return map(particle_to_pose, particles)
+    return [Pose(Point(x, y, z), Quaternion(qx, qy, qz, qw))
+            for x, y, z, qx, qy, qz, qw in particles_to_pose_data(particles).tolist()]
+
+class NumpyPoseArray(PoseArray):
+    """ PoseArray which serializes its poses straight from an (N,7) float64 array in the layout
+        of particles_to_pose_data, rather than from a list of Pose messages. The wire format is
+        identical to PoseArray, so subscribers see a normal PoseArray. Only for publishing: the
+        poses field stays empty.
+    """
+    __slots__ = PoseArray.__slots__ + ["pose_data"]
+
+    def __init__(self, header, pose_data):
+        super(NumpyPoseArray, self).__init__(header=header, poses=[])
+        self.pose_data = pose_data
+
+    def serialize(self, buff):
+        header = self.header
+        frame_id = header.frame_id.encode("utf-8")
+        pose_data = np.ascontiguousarray(self.pose_data, dtype="<f8")
+        buff.write(struct.pack("<3I", header.seq, header.stamp.secs, header.stamp.nsecs))
+        buff.write(struct.pack("<I", len(frame_id)))
+        buff.write(frame_id)
+        buff.write(struct.pack("<I", pose_data.shape[0]))
+        buff.write(pose_data.data)
 
 def make_header(frame_id, stamp=None):
     if stamp == None:
@@ -164,3 +343,75 @@ def world_to_map_slow(x,y,t, map_info):
                       [y]])
     map_c = rot*((world - trans) / float(scale))
     return map_c[0,0],map_c[1,0],t-angle
+
+# on-disk cache helpers. This is the canonical copy, lab5_localization, obstacle_mapping and the
+# headless simulator carry copies synced from it since the ROS packages do not share modules
+
+# default location of the on-disk cache for expensive startup computations
+CACHE_DIR = os.path.join(os.environ.get("ROS_HOME", os.path.expanduser("~/.ros")), "particle_filter_cache")
+
+def cache_path(name, key, extension, cache_dir=None):
+    """ Path of the on-disk cache entry for name. key is any object with a stable repr, such as
+        a tuple of parameters, and the path changes whenever key does.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s_%s.%s" % (name, digest, extension))
+
+def _write_cache_file(path, write):
+    """ Calls write(tmp_path) and moves the result to path, so that a concurrent reader never
+        sees a partial file. write returns False on failure.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if write(tmp_path) is not False:
+            os.rename(tmp_path, path)
+            return
+    except (IOError, OSError) as e:
+        print "WARNING:", e
+    print "WARNING: could not write cache file:", path
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+def load_or_compute(name, key, compute, cache_dir=None):
+    """ Returns the array cached on disk for (name, key), or calls compute() and caches the result.
+        Failing to read or write the cache is not an error, the array is just recomputed.
+    """
+    path = cache_path(name, key, "npy", cache_dir)
+    if os.path.isfile(path):
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            print "WARNING: ignoring unreadable cache file:", path
+
+    arr = compute()
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+    _write_cache_file(path, write)
+    return arr
+
+def cached_range_method(range_method_class, omap, max_range_px, theta_discretization, prune=False, cache_dir=None):
+    """ Returns a range_libc.PyCDDTCast or PyGiantLUTCast for omap. The lookup table is loaded from
+        the on-disk cache if it has been built for the same map, max range and theta discretization
+        before, otherwise it is built and saved for next time. Loaded giant LUTs are memory mapped,
+        so every process using the same map shares one copy of the table.
+    """
+    name = range_method_class.__name__ + ("_pruned" if prune else "")
+    key = (omap.hash(), int(max_range_px), int(theta_discretization))
+    path = cache_path(name, key, "bin", cache_dir)
+    if os.path.isfile(path):
+        range_method = range_method_class.load(path, omap)
+        if range_method is not None:
+            print "Loaded lookup table from:", path
+            return range_method
+        print "WARNING: ignoring unreadable cache file:", path
+
+    range_method = range_method_class(omap, max_range_px, theta_discretization)
+    if prune:
+        print "Pruning..."
+        range_method.prune()
+    _write_cache_file(path, range_method.save)
+    return range_method
@@ -13,6 +13,7 @@ from threading import Lock
 import tf.transformations
 import tf
 import utils as Utils
+from resampler import Resampler
 import math
 
 # messages
@@ -57,6 +58,9 @@ class ParticleFiler():
         self.SHOW_FINE_TIMING  = bool(rospy.get_param("~fine_timing", "0"))
         self.PUBLISH_ODOM      = bool(rospy.get_param("~publish_odom", "1"))
         self.DO_VIZ            = bool(rospy.get_param("~viz"))
+        self.RESAMPLER         = rospy.get_param("~resampler", "systematic").lower()
+        # directory of the on-disk cache for tables that are slow to compute at startup
+        self.CACHE_DIR         = rospy.get_param("~cache_dir", Utils.CACHE_DIR)
 
         # Mapping params (namespaced under /mapping).
         self.USE_LOCAL_MAP          = Utils.getParamOrFail("/mapping/use_local_map")
@@ -103,12 +107,16 @@ class ParticleFiler():
         self.particle_indices = np.arange(self.MAX_PARTICLES)
         self.particles = np.zeros((self.MAX_PARTICLES, 3))
         self.weights = np.ones(self.MAX_PARTICLES) / float(self.MAX_PARTICLES)
+        self.resampler = Resampler(self.RESAMPLER)
 
         # initialize the state
         self.smoothing = Utils.CircularArray(10)
         self.timer = Utils.Timer(10)
 
         self.dynamic_map = None
+        # the PyOMap the range method was built from, and its occupancy as a (height, width) array
+        self.omap = None
+        self.occupied_map = None
 
         self.base_map_mask = None
         self.get_omap()
@@ -175,10 +183,31 @@ class ParticleFiler():
         print "Finished initializing, waiting on messages..."
 
     def update_range_method_map(self):
-        self.map_msg.data = self.dynamic_map.astype(int).flatten().tolist()
+        # same occupancy threshold as PyOMap uses for OccupancyGrid messages
+        occupied = self.dynamic_map > 10
+        if self.WHICH_RM == "rm":
+            # ray marching can patch its distance transform in place, so only the bounding box of the
+            # cells that changed occupancy since the last update is pushed to range_libc
+            changed = occupied != self.occupied_map
+            rows = np.flatnonzero(changed.any(axis=1))
+            if rows.shape[0] > 0:
+                cols = np.flatnonzero(changed.any(axis=0))
+                # the omap x axis is the row of the map data, and y the column
+                region = self.omap.update_region(rows[0], cols[0], occupied[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1])
+                self.range_method.refresh(self.omap, region)
+            self.occupied_map = occupied
+            if self.map_debug_pub.get_num_connections() > 0:
+                self.map_msg.data = self.dynamic_map.astype(int).flatten().tolist()
+                self.map_debug_pub.publish(self.map_msg)
+            return
+
         print "UPDATING MAP"
-        self.map_debug_pub.publish(self.map_msg)
-        oMap = range_libc.PyOMap(self.map_msg)
+        if self.map_debug_pub.get_num_connections() > 0:
+            self.map_msg.data = self.dynamic_map.astype(int).flatten().tolist()
+            self.map_debug_pub.publish(self.map_msg)
+        oMap = self.make_omap()
+        self.omap = oMap
+        self.occupied_map = occupied
         if self.WHICH_RM == "bl":
             self.range_method = range_libc.PyBresenhamsLine(oMap, self.MAX_RANGE_PX)
         elif "cddt" in self.WHICH_RM:
@@ -186,8 +215,6 @@ class ParticleFiler():
             if self.WHICH_RM == "pcddt":
                 print "Pruning..."
                 self.range_method.prune()
-        elif self.WHICH_RM == "rm":
-            self.range_method = range_libc.PyRayMarching(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "rmgpu":
             self.range_method = range_libc.PyRayMarchingGPU(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "glt":
@@ -211,34 +238,38 @@ class ParticleFiler():
         self.map_info = self.map_msg.info
         self.MAX_RANGE_PX = int(self.MAX_RANGE_METERS / self.map_info.resolution)
         self.init_dynamic_map(self.MAP_BASE_PATH)
-        self.map_msg.data = self.dynamic_map.astype(float).flatten().tolist()
-        oMap = range_libc.PyOMap(self.map_msg)
+        oMap = self.make_omap()
+        self.omap = oMap
+        self.occupied_map = self.dynamic_map > 10
 
         # initialize range method
         print "Initializing range method:", self.WHICH_RM
         if self.WHICH_RM == "bl":
             self.range_method = range_libc.PyBresenhamsLine(oMap, self.MAX_RANGE_PX)
         elif "cddt" in self.WHICH_RM:
-            self.range_method = range_libc.PyCDDTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
-            if self.WHICH_RM == "pcddt":
-                print "Pruning..."
-                self.range_method.prune()
+            # lookup tables are cached on disk, so this is only slow the first time a map is used
+            self.range_method = Utils.cached_range_method(range_libc.PyCDDTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                          prune=self.WHICH_RM == "pcddt", cache_dir=self.CACHE_DIR)
         elif self.WHICH_RM == "rm":
             self.range_method = range_libc.PyRayMarching(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "rmgpu":
             self.range_method = range_libc.PyRayMarchingGPU(oMap, self.MAX_RANGE_PX)
         elif self.WHICH_RM == "glt":
-            self.range_method = range_libc.PyGiantLUTCast(oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION)
+            self.range_method = Utils.cached_range_method(range_libc.PyGiantLUTCast, oMap, self.MAX_RANGE_PX, self.THETA_DISCRETIZATION,
+                                                          cache_dir=self.CACHE_DIR)
         print "Done loading map"
 
-         # 0: permissible, -1: unmapped, 100: blocked
-        array_255 = np.array(self.map_msg.data).reshape((self.map_msg.info.height, self.map_msg.info.width))
-
         # 0: not permissible, 1: permissible
-        self.permissible_region = np.zeros_like(array_255, dtype=bool)
-        self.permissible_region[array_255==0] = 1
+        self.permissible_region = self.dynamic_map == 0
         self.map_initialized = True
 
+    def make_omap(self):
+        # range_libc reads the dynamic map in place, values above 10 are occupied
+        return range_libc.PyOMap(self.dynamic_map, resolution=self.map_info.resolution,
+                                 origin=(self.map_info.origin.position.x, self.map_info.origin.position.y,
+                                         Utils.quaternion_to_angle(self.map_info.origin.orientation)),
+                                 occupied_threshold=10)
+
     def init_dynamic_map(self, path_to_map="/home/racecar/racecar_ws/src/obstacle/maps/basement_fixed.png"):
         # print(path_to_map)
         self.dynamic_map = cv.imread(path_to_map, cv.IMREAD_GRAYSCALE)
@@ -452,37 +483,35 @@ class ParticleFiler():
         c_r = 0.01
 
         table_width = int(self.MAX_RANGE_PX) + 1
-        self.sensor_model_table = np.zeros((table_width,table_width))
 
-        t = time.time()
-        # d is the computed range from RangeLibc
-        for d in xrange(table_width):
-            norm = 0.0
-            sum_unkown = 0.0
-            # r is the observed range from the lidar unit
-            for r in xrange(table_width):
-                prob = 0.0
-                z = float(r-d)
-                # reflects from the intended object
-                prob += z_hit * np.exp(-(z*z)/(2.0*sigma_hit*sigma_hit)) / (sigma_hit * np.sqrt(2.0*np.pi))
-
-                # observed range is less than the predicted range - short reading
-                if r < d:
-                    prob += 2.0 * z_short * (d - r) / float(d)
-
-                # erroneous max range measurement
-                if int(r) == int(self.MAX_RANGE_PX):
-                    prob += z_max
-
-                # random measurement
-                if r < int(self.MAX_RANGE_PX):
-                    prob += z_rand * 1.0/float(self.MAX_RANGE_PX)
-
-                norm += prob
-                self.sensor_model_table[int(r),int(d)] = prob
+        def compute_table():
+            # r is the observed range from the lidar unit, d is the computed range from RangeLibc.
+            # the table is indexed as [r,d], and is built in one shot by broadcasting
+            r = np.arange(table_width, dtype=np.float64)[:,np.newaxis]
+            d = np.arange(table_width, dtype=np.float64)[np.newaxis,:]
+            z = r - d
+
+            # reflects from the intended object
+            table = z_hit * np.exp(-(z*z)/(2.0*sigma_hit*sigma_hit)) / (sigma_hit * np.sqrt(2.0*np.pi))
+
+            # observed range is less than the predicted range - short reading
+            table += np.where(r < d, 2.0 * z_short * (d - r) / np.maximum(d, 1.0), 0.0)
+
+            # erroneous max range measurement
+            table[int(self.MAX_RANGE_PX),:] += z_max
+
+            # random measurement
+            table[:int(self.MAX_RANGE_PX),:] += z_rand * 1.0/float(self.MAX_RANGE_PX)
 
             # normalize
-            self.sensor_model_table[:,int(d)] /= norm
+            table /= np.sum(table, axis=0)
+            return table
+
+        # the table only depends on these, so it is cached on disk and loaded on later starts
+        t = time.time()
+        key = (z_hit, z_short, z_max, z_rand, sigma_hit, int(self.MAX_RANGE_PX))
+        self.sensor_model_table = Utils.load_or_compute("sensor_model", key, compute_table, self.CACHE_DIR)
+        print "Sensor model ready in", int((time.time() - t) * 1000.0), "ms"
 
         # upload the sensor model to RangeLib for ultra fast resolution
         if self.RANGELIB_VAR > 0:
@@ -554,6 +583,10 @@ class ParticleFiler():
         These weights represent how probable each proposed (x,y,theta) pose is given the measured
         ranges from the lidar scanner.
 
+        The weights are written as logarithms, already raised to the power of INV_SQUASH_FACTOR.
+        RangeLib sums the log of the sensor model table, so the weights do not underflow however
+        many rays are used.
+
         There are 4 different variants using various features of RangeLibc for demonstration purposes.
         - VAR_REPEAT_ANGLES_EVAL_SENSOR is the most stable, and is very fast.
         - VAR_NO_EVAL_SENSOR_MODEL directly indexes the precomputed sensor model. This is slow
@@ -574,8 +607,7 @@ class ParticleFiler():
 
         if self.RANGELIB_VAR == VAR_REPEAT_ANGLES_EVAL_SENSOR_ONE_SHOT:
             self.queries[:,:] = proposal_dist[:,:]
-            self.range_method.calc_range_repeat_angles_eval_sensor_model(self.queries, self.downsampled_angles, obs, self.weights)
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
+            self.range_method.calc_range_repeat_angles_eval_sensor_model_log(self.queries, self.downsampled_angles, obs, self.weights, self.INV_SQUASH_FACTOR)
         elif self.RANGELIB_VAR == VAR_REPEAT_ANGLES_EVAL_SENSOR:
             if self.SHOW_FINE_TIMING:
                 t_start = time.time()
@@ -587,17 +619,14 @@ class ParticleFiler():
             if self.SHOW_FINE_TIMING:
                 t_range = time.time()
             # evaluate the sensor model on the GPU
-            self.range_method.eval_sensor_model(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES)
+            self.range_method.eval_sensor_model_log(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES, self.INV_SQUASH_FACTOR)
             if self.SHOW_FINE_TIMING:
                 t_eval = time.time()
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
-            if self.SHOW_FINE_TIMING:
-                t_squash = time.time()
-                t_total = (t_squash - t_start) / 100.0
+                t_total = (t_eval - t_start) / 100.0
 
             if self.SHOW_FINE_TIMING and self.iters % 10 == 0:
                 print "sensor_model: init: ", np.round((t_init-t_start)/t_total, 2), "range:", np.round((t_range-t_init)/t_total, 2), \
-                      "eval:", np.round((t_eval-t_range)/t_total, 2), "squash:", np.round((t_squash-t_eval)/t_total, 2)
+                      "eval:", np.round((t_eval-t_range)/t_total, 2)
         elif self.RANGELIB_VAR == VAR_CALC_RANGE_MANY_EVAL_SENSOR:
             # this version demonstrates what this would look like with coordinate space conversion pushed to rangelib
             # this part is inefficient since it requires a lot of effort to construct this redundant array
@@ -609,8 +638,7 @@ class ParticleFiler():
             self.range_method.calc_range_many(self.queries, self.ranges)
 
             # evaluate the sensor model on the GPU
-            self.range_method.eval_sensor_model(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES)
-            np.power(self.weights, self.INV_SQUASH_FACTOR, self.weights)
+            self.range_method.eval_sensor_model_log(obs, self.ranges, self.weights, num_rays, self.MAX_PARTICLES, self.INV_SQUASH_FACTOR)
         elif self.RANGELIB_VAR == VAR_NO_EVAL_SENSOR_MODEL:
             # this version directly uses the sensor model in Python, at a significant computational cost
             self.queries[:,0] = np.repeat(proposal_dist[:,0], num_rays)
@@ -630,11 +658,10 @@ class ParticleFiler():
             intobs = np.rint(obs).astype(np.uint16)
             intrng = np.rint(ranges).astype(np.uint16)
 
-            # compute the weight for each particle
+            # compute the log weight for each particle
             for i in xrange(self.MAX_PARTICLES):
-                weight = np.product(self.sensor_model_table[intobs,intrng[i*num_rays:(i+1)*num_rays]])
-                weight = np.power(weight, self.INV_SQUASH_FACTOR)
-                weights[i] = weight
+                log_weight = np.sum(np.log(self.sensor_model_table[intobs,intrng[i*num_rays:(i+1)*num_rays]]))
+                weights[i] = log_weight * self.INV_SQUASH_FACTOR
         else:
             print "PLEASE SET rangelib_variant PARAM to 0-3"
 
@@ -651,7 +678,7 @@ class ParticleFiler():
         if self.SHOW_FINE_TIMING:
             t = time.time()
         # draw the proposal distribution from the old particles
-        proposal_indices = np.random.choice(self.particle_indices, self.MAX_PARTICLES, p=self.weights)
+        proposal_indices = self.resampler.resample(self.weights)
         proposal_distribution = self.particles[proposal_indices,:]
         if self.SHOW_FINE_TIMING:
             t_propose = time.time()
@@ -666,8 +693,8 @@ class ParticleFiler():
         if self.SHOW_FINE_TIMING:
             t_sensor = time.time()
 
-        # normalize importance weights
-        self.weights /= np.sum(self.weights)
+        # turn the log weights into normalized importance weights
+        range_libc.normalize_log_weights(self.weights, self.weights)
         if self.SHOW_FINE_TIMING:
             t_norm = time.time()
             t_total = (t_norm - t)/100.0
@@ -714,7 +741,8 @@ class ParticleFiler():
                 else:
                     self.update_dynamic_map(self.inferred_pose, self.laser_angles, self.laser)
 
-                if self.iters % ITERS_PER_UPDATE == 0 and UPDATE_OMAP:
+                # ray marching is refreshed incrementally, which is cheap enough to do on every scan
+                if UPDATE_OMAP and (self.WHICH_RM == "rm" or self.iters % ITERS_PER_UPDATE == 0):
                     self.update_range_method_map()
                 self.state_lock.release()
                 t2 = time.time()
@@ -2,6 +2,7 @@
 
 import rospy
 import numpy as np
+import os, hashlib
 
 from std_msgs.msg import Header
 from visualization_msgs.msg import Marker
@@ -177,3 +178,75 @@ def world_to_map_slow(x,y,t, map_info):
                       [y]])
     map_c = rot*((world - trans) / float(scale))
     return map_c[0,0],map_c[1,0],t-angle
+
+# on-disk cache helpers, synced from localization_solution/src/utils.py. Make changes there
+# and copy them over rather than editing this copy
+
+# default location of the on-disk cache for expensive startup computations
+CACHE_DIR = os.path.join(os.environ.get("ROS_HOME", os.path.expanduser("~/.ros")), "particle_filter_cache")
+
+def cache_path(name, key, extension, cache_dir=None):
+    """ Path of the on-disk cache entry for name. key is any object with a stable repr, such as
+        a tuple of parameters, and the path changes whenever key does.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s_%s.%s" % (name, digest, extension))
+
+def _write_cache_file(path, write):
+    """ Calls write(tmp_path) and moves the result to path, so that a concurrent reader never
+        sees a partial file. write returns False on failure.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if write(tmp_path) is not False:
+            os.rename(tmp_path, path)
+            return
+    except (IOError, OSError) as e:
+        print "WARNING:", e
+    print "WARNING: could not write cache file:", path
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+def load_or_compute(name, key, compute, cache_dir=None):
+    """ Returns the array cached on disk for (name, key), or calls compute() and caches the result.
+        Failing to read or write the cache is not an error, the array is just recomputed.
+    """
+    path = cache_path(name, key, "npy", cache_dir)
+    if os.path.isfile(path):
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            print "WARNING: ignoring unreadable cache file:", path
+
+    arr = compute()
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+    _write_cache_file(path, write)
+    return arr
+
+def cached_range_method(range_method_class, omap, max_range_px, theta_discretization, prune=False, cache_dir=None):
+    """ Returns a range_libc.PyCDDTCast or PyGiantLUTCast for omap. The lookup table is loaded from
+        the on-disk cache if it has been built for the same map, max range and theta discretization
+        before, otherwise it is built and saved for next time. Loaded giant LUTs are memory mapped,
+        so every process using the same map shares one copy of the table.
+    """
+    name = range_method_class.__name__ + ("_pruned" if prune else "")
+    key = (omap.hash(), int(max_range_px), int(theta_discretization))
+    path = cache_path(name, key, "bin", cache_dir)
+    if os.path.isfile(path):
+        range_method = range_method_class.load(path, omap)
+        if range_method is not None:
+            print "Loaded lookup table from:", path
+            return range_method
+        print "WARNING: ignoring unreadable cache file:", path
+
+    range_method = range_method_class(omap, max_range_px, theta_discretization)
+    if prune:
+        print "Pruning..."
+        range_method.prune()
+    _write_cache_file(path, range_method.save)
+    return range_method
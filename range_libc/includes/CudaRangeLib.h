@@ -11,7 +11,7 @@
 class RayMarchingCUDA
 {
 public:
-	RayMarchingCUDA(std::vector<std::vector<float> > grid, int w, int h, float mr);
+	RayMarchingCUDA(float *grid, int w, int h, float mr);
 	~RayMarchingCUDA();
 	void calc_range_many(float *ins, float *outs, int num_casts);
 	void numpy_calc_range(float *ins, float *outs, int num_casts);
@@ -58,7 +58,7 @@ namespace utils {
 		KeyMaker(int width, int height, int theta_discretization) {
 			y_shift = (int) std::ceil(std::log2(theta_discretization));
 			x_shift = (int) std::ceil(std::log2(height)) + y_shift;
-			int bitness = (int) std::ceil(std::log2(width)) + x_shift;
+			bitness = (int) std::ceil(std::log2(width)) + x_shift;
 
 			if (bitness > std::log2(std::numeric_limits<key_T>::max())) {
 				std::cerr << "Key bitness too large for integer packing scheme. Check your KeyMaker template type." << std::endl;
@@ -76,7 +76,10 @@ namespace utils {
 		std::tuple<int, int, int> unpack_key(key_T k) {
 			return std::make_tuple((int)((k & x_mask) >> x_shift), (int)((k & y_mask) >> y_shift), k & t_mask);
 		}
+		// number of low bits that keys may use
+		int bits() const { return bitness; }
 	private:
+		int bitness;
 		int y_shift;
 		int x_shift;
 		key_T x_mask;
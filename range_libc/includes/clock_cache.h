@@ -0,0 +1,186 @@
+/*
+* Copyright 2017 Corey H. Walsh (corey.walsh11@gmail.com)
+
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+
+*     http://www.apache.org/licenses/LICENSE-2.0
+
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+*/
+
+/*
+Fixed capacity cache from integer keys to floats, for memoizing ray casts.
+
+The table is split into buckets of WAYS slots, 64 bytes per bucket. A key hashes to one
+bucket and may live in any of its slots, when the bucket is full a CLOCK sweep over the bucket picks
+the victim: slots that were read since the hand last passed them get a second chance.
+
+Each slot is a single 64 bit word holding the key tag and the value, so readers and writers never
+see a torn entry and the cache can be shared between threads without locks. Concurrent puts to the
+same bucket may overwrite each other, which only costs a miss later. Nothing is allocated after
+construction.
+
+Keys must fit in key_bits bits. The key is mixed with a bijection on key_bits bits, the low bits of
+the result select the bucket and the rest are stored as the tag, so lookups are exact.
+*/
+
+#ifndef _CLOCK_CACHE_H_INCLUDED_
+#define _CLOCK_CACHE_H_INCLUDED_
+
+#include <atomic>
+#include <memory>
+#include <cstring>
+#include <cstddef>
+#include <stdint.h>
+#include <iostream>
+
+namespace cache {
+
+class clock_cache {
+public:
+	static const int WAYS = 8;
+
+	clock_cache() : clock_cache(0, 0) {}
+	clock_cache(size_t capacity, int key_bits) : key_bits(key_bits), bucket_bits(0) {
+		// as many buckets as fit in the capacity, but never more than there are keys
+		while (bucket_bits < key_bits && (size_t(WAYS) << (bucket_bits + 1)) <= capacity)
+			++bucket_bits;
+		if (key_bits - bucket_bits > 31) {
+			std::cerr << "Keys of " << key_bits << " bits do not fit in a cache of size " << capacity
+				<< ", caching is disabled." << std::endl;
+			num_buckets = 0;
+		} else {
+			num_buckets = capacity < WAYS ? 0 : size_t(1) << bucket_bits;
+		}
+		allocate();
+	}
+
+	clock_cache(const clock_cache &other) { *this = other; }
+
+	clock_cache& operator=(const clock_cache &other) {
+		if (this == &other) return *this;
+		key_bits = other.key_bits;
+		bucket_bits = other.bucket_bits;
+		num_buckets = other.num_buckets;
+		allocate();
+		for (size_t i = 0; i < num_buckets * WAYS; ++i) {
+			slots[i].store(other.slots[i].load(std::memory_order_relaxed), std::memory_order_relaxed);
+			referenced[i].store(other.referenced[i].load(std::memory_order_relaxed), std::memory_order_relaxed);
+		}
+		for (size_t i = 0; i < num_buckets; ++i)
+			hands[i].store(other.hands[i].load(std::memory_order_relaxed), std::memory_order_relaxed);
+		hit_count.store(other.hits(), std::memory_order_relaxed);
+		miss_count.store(other.misses(), std::memory_order_relaxed);
+		return *this;
+	}
+
+	// returns true and sets value if the key is in the cache
+	bool get(uint64_t key, float &value) {
+		if (num_buckets == 0) {
+			miss_count.fetch_add(1, std::memory_order_relaxed);
+			return false;
+		}
+		uint64_t h = mix(key);
+		size_t first = (h & (num_buckets - 1)) * WAYS;
+		uint64_t tag = (h >> bucket_bits) + 1;
+		for (int i = 0; i < WAYS; ++i) {
+			uint64_t slot = slots[first + i].load(std::memory_order_relaxed);
+			if ((slot >> 32) == tag) {
+				// skip the store when the bit is already set, so hot slots stay in shared cache lines
+				if (!referenced[first + i].load(std::memory_order_relaxed))
+					referenced[first + i].store(1, std::memory_order_relaxed);
+				uint32_t bits = (uint32_t) slot;
+				std::memcpy(&value, &bits, sizeof(float));
+				hit_count.fetch_add(1, std::memory_order_relaxed);
+				return true;
+			}
+		}
+		miss_count.fetch_add(1, std::memory_order_relaxed);
+		return false;
+	}
+
+	void put(uint64_t key, float value) {
+		if (num_buckets == 0) return;
+		uint64_t h = mix(key);
+		size_t bucket = h & (num_buckets - 1);
+		size_t first = bucket * WAYS;
+		uint64_t tag = (h >> bucket_bits) + 1;
+		uint32_t bits;
+		std::memcpy(&bits, &value, sizeof(float));
+		uint64_t entry = (tag << 32) | bits;
+
+		int victim = -1;
+		for (int i = 0; i < WAYS; ++i) {
+			uint64_t slot = slots[first + i].load(std::memory_order_relaxed);
+			if ((slot >> 32) == tag || slot == 0) {
+				victim = i;
+				break;
+			}
+		}
+		if (victim < 0) {
+			// CLOCK: clear reference bits until the hand reaches a slot that was not read recently.
+			// Terminates within two sweeps even if every slot was referenced
+			int hand = hands[bucket].load(std::memory_order_relaxed);
+			for (int i = 0; i < 2 * WAYS; ++i) {
+				if (!referenced[first + hand].load(std::memory_order_relaxed)) break;
+				referenced[first + hand].store(0, std::memory_order_relaxed);
+				hand = (hand + 1) % WAYS;
+			}
+			victim = hand;
+			hands[bucket].store((hand + 1) % WAYS, std::memory_order_relaxed);
+		}
+		// new entries start unreferenced, so keys that are never read again are evicted first
+		referenced[first + victim].store(0, std::memory_order_relaxed);
+		slots[first + victim].store(entry, std::memory_order_relaxed);
+	}
+
+	size_t capacity() const { return num_buckets * WAYS; }
+	size_t memory() const { return num_buckets * (WAYS * (sizeof(uint64_t) + sizeof(uint8_t)) + sizeof(uint8_t)); }
+	uint64_t hits() const { return hit_count.load(std::memory_order_relaxed); }
+	uint64_t misses() const { return miss_count.load(std::memory_order_relaxed); }
+	void reset_stats() {
+		hit_count.store(0, std::memory_order_relaxed);
+		miss_count.store(0, std::memory_order_relaxed);
+	}
+
+private:
+	void allocate() {
+		// value initialization zeroes the slots, and a zero tag marks an empty slot
+		slots.reset(new std::atomic<uint64_t>[num_buckets * WAYS]());
+		referenced.reset(new std::atomic<uint8_t>[num_buckets * WAYS]());
+		hands.reset(new std::atomic<uint8_t>[num_buckets]());
+		hit_count.store(0, std::memory_order_relaxed);
+		miss_count.store(0, std::memory_order_relaxed);
+	}
+
+	// bijection on the low key_bits bits: multiplying by an odd constant and xor shifting are both
+	// invertible modulo 2^key_bits, so (bucket, tag) identifies the key exactly
+	uint64_t mix(uint64_t key) const {
+		uint64_t mask = key_bits >= 64 ? ~uint64_t(0) : (uint64_t(1) << key_bits) - 1;
+		int shift = key_bits / 2 + 1;
+		uint64_t h = (key * 0x9E3779B97F4A7C15ull) & mask;
+		h ^= h >> shift;
+		h = (h * 0xBF58476D1CE4E5B9ull) & mask;
+		h ^= h >> shift;
+		return h;
+	}
+
+	int key_bits;
+	int bucket_bits;
+	size_t num_buckets;
+	std::unique_ptr<std::atomic<uint64_t>[]> slots;
+	std::unique_ptr<std::atomic<uint8_t>[]> referenced;
+	std::unique_ptr<std::atomic<uint8_t>[]> hands;
+	std::atomic<uint64_t> hit_count;
+	std::atomic<uint64_t> miss_count;
+};
+
+} // namespace cache
+
+#endif	/* _CLOCK_CACHE_H_INCLUDED_ */
@@ -202,19 +202,14 @@ void err_check() {
     	printf("Error: %s\n", cudaGetErrorString(err));
 }
 
-RayMarchingCUDA::RayMarchingCUDA(std::vector<std::vector<float> > grid, int w, int h, float mr) 
+RayMarchingCUDA::RayMarchingCUDA(float *grid, int w, int h, float mr) 
 	: width(w), height(h), max_range(mr) {
 	cudaMalloc((void **)&d_ins, sizeof(float) * CHUNK_SIZE * 3);
 	cudaMalloc((void **)&d_outs, sizeof(float) * CHUNK_SIZE);
 	cudaMalloc((void **)&d_distMap, sizeof(float) * width * height);
 
-	// convert vector format to raw float array, y axis is quickly changing dimension
-	// float raw_grid[width*height];
-	float *raw_grid = new float[width*height];
-	for (int i = 0; i < width; ++i) std::copy(grid[i].begin(), grid[i].end(), &raw_grid[i*height]);
-
-	cudaMemcpy(d_distMap, raw_grid, width*height*sizeof(float), cudaMemcpyHostToDevice);
-	free(raw_grid);
+	// the grid is a flat DistanceTransform grid, y axis is quickly changing dimension
+	cudaMemcpy(d_distMap, grid, width*height*sizeof(float), cudaMemcpyHostToDevice);
 }
 
 RayMarchingCUDA::~RayMarchingCUDA() {
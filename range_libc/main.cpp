@@ -44,6 +44,7 @@ DEFINE_string(query, "",
 DEFINE_string(trace_path, "", "Path to output trace map of memory access pattern. Works for Bresenham's Line or Ray Marching.");
 
 DEFINE_string(lut_slice_path, "", "Path to output a slice of the LUT.");
+DEFINE_string(glt_path, "", "Path to a saved GiantLUTCast table. It is memory mapped if it exists, otherwise the table is built and saved there.");
 DEFINE_string(lut_slice_theta, "1.57", "Which LUT slice to output");
 
 #define MAX_DISTANCE 500
@@ -78,6 +79,273 @@ void save_log(std::stringstream &log, std::string path) {
 	save_log(log,path.c_str());
 }
 
+// times RayMarching::calc_range on every query against the batched RayMarching::calc_range_many
+void compare_batched_ray_marching(RayMarching &rm, float *samples, int num_samples) {
+	float *scalar_outs = new float[num_samples];
+	float *batched_outs = new float[num_samples];
+
+	// warm up
+	rm.calc_range_many(samples, batched_outs, num_samples);
+
+	auto scalar_start = std::chrono::high_resolution_clock::now();
+	for (int i = 0; i < num_samples; ++i)
+		scalar_outs[i] = rm.calc_range(samples[3*i], samples[3*i+1], samples[3*i+2]);
+	auto scalar_end = std::chrono::high_resolution_clock::now();
+	rm.calc_range_many(samples, batched_outs, num_samples);
+	auto batched_end = std::chrono::high_resolution_clock::now();
+
+	std::chrono::duration<double> scalar_dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(scalar_end - scalar_start);
+	std::chrono::duration<double> batched_dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(batched_end - scalar_end);
+
+	int mismatches = 0;
+	for (int i = 0; i < num_samples; ++i)
+		if (std::abs(scalar_outs[i] - batched_outs[i]) > 0.001) ++mismatches;
+
+	std::cout << "...scalar vs batched ray marching, " << num_samples << " rays" << std::endl;
+	std::cout << ".....scalar rays/sec: " << num_samples / scalar_dur.count() << std::endl;
+	#if _RM_SIMD == 1
+	std::cout << ".....batched (" << _RM_BATCH << " lanes) rays/sec: " << num_samples / batched_dur.count() << std::endl;
+	#else
+	std::cout << ".....batched (disabled, compiled with _RM_SIMD=0) rays/sec: " << num_samples / batched_dur.count() << std::endl;
+	#endif
+	std::cout << ".....speedup: " << scalar_dur.count() / batched_dur.count() << std::endl;
+	std::cout << ".....mismatched ranges: " << mismatches << std::endl;
+
+	delete[] scalar_outs;
+	delete[] batched_outs;
+}
+
+// casts the queries with the distance transform stored as dist_t, and reports the throughput and
+// memory use along with the error relative to the given exact ranges
+template <typename dist_t>
+void time_distance_type(std::string name, OMap &map, float *samples, int num_samples, float *reference) {
+	RayMarchingImpl<dist_t> rm = RayMarchingImpl<dist_t>(map, MAX_DISTANCE);
+	float *outs = new float[num_samples];
+
+	// warm up
+	rm.calc_range_many(samples, outs, num_samples);
+	auto start = std::chrono::high_resolution_clock::now();
+	rm.calc_range_many(samples, outs, num_samples);
+	auto end = std::chrono::high_resolution_clock::now();
+	std::chrono::duration<double> dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(end - start);
+
+	double total_error = 0.0;
+	float max_error = 0.0;
+	int off_by_pixel = 0;
+	for (int i = 0; i < num_samples; ++i) {
+		float error = std::abs(outs[i] - reference[i]);
+		total_error += error;
+		max_error = std::max(max_error, error);
+		if (error > 1.0) ++off_by_pixel;
+	}
+
+	std::cout << "....." << name << " memory (MB): " << rm.memory() / MB << ", rays/sec: " << num_samples / dur.count() << std::endl;
+	std::cout << "......." << "mean error: " << total_error / num_samples << ", max error: " << max_error 
+		<< ", rays off by more than a pixel: " << off_by_pixel << std::endl;
+	delete[] outs;
+}
+
+// compares the accuracy and speed of the distance transform storage types. Ray marching is not exact
+// with any storage type, so the error is measured against Bresenham's line
+void compare_distance_types(OMap &map, float *samples, int num_samples) {
+	std::cout << "...comparing distance transform storage types, " << num_samples << " rays" << std::endl;
+	float *reference = new float[num_samples];
+	BresenhamsLine bl = BresenhamsLine(map, MAX_DISTANCE);
+	for (int i = 0; i < num_samples; ++i)
+		reference[i] = bl.calc_range(samples[3*i], samples[3*i+1], samples[3*i+2]);
+	time_distance_type<float>("float", map, samples, num_samples, reference);
+	time_distance_type<uint16_t>("uint16_t", map, samples, num_samples, reference);
+	time_distance_type<uint8_t>("uint8_t", map, samples, num_samples, reference);
+	delete[] reference;
+}
+
+// particle filter shaped workload for the ray cache comparison
+#define PF_STEPS 20
+#define PF_PARTICLES 4000
+#define PF_RAYS 60
+
+// casts every query with the given function, returns the time per query in ns
+template <typename F>
+double time_queries(F cast, float *samples, float *outs, int num_samples) {
+	auto start = std::chrono::high_resolution_clock::now();
+	for (int i = 0; i < num_samples; ++i)
+		outs[i] = cast(samples[3*i], samples[3*i+1], samples[3*i+2]);
+	auto end = std::chrono::high_resolution_clock::now();
+	std::chrono::duration<double> dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(end - start);
+	return 1e9 * dur.count() / num_samples;
+}
+
+#if _USE_LRU_CACHE
+void time_ray_cache(std::string name, CDDTCast &rc, float *samples, int num_samples) {
+	float *uncached = new float[num_samples];
+	float *cached = new float[num_samples];
+	// start from an empty cache
+	rc.cache = cache::clock_cache(_LRU_CACHE_SIZE, rc.key_maker.bits());
+
+	double uncached_ns = time_queries([&](float x, float y, float t) { return rc.calc_range_uncached(x, y, t); },
+		samples, uncached, num_samples);
+	double cached_ns = time_queries([&](float x, float y, float t) { return rc.calc_range(x, y, t); },
+		samples, cached, num_samples);
+
+	// cached ranges are for the pixel and angle bin of the query that filled the entry
+	double total_error = 0.0;
+	for (int i = 0; i < num_samples; ++i)
+		total_error += std::abs(cached[i] - uncached[i]);
+
+	std::cout << "....." << name << ", " << num_samples << " rays" << std::endl;
+	std::cout << ".......uncached ns/query: " << uncached_ns << ", cached ns/query: " << cached_ns
+		<< ", speedup: " << uncached_ns / cached_ns << std::endl;
+	std::cout << ".......hit rate: " << rc.cache.hits() / (double) (rc.cache.hits() + rc.cache.misses())
+		<< ", mean difference from uncached: " << total_error / num_samples << std::endl;
+	delete[] uncached;
+	delete[] cached;
+}
+#endif
+
+// compares CDDTCast with and without the ray cache, on uniformly random queries (nearly all misses)
+// and on queries shaped like a particle filter update, where particles cluster around the pose
+void compare_ray_cache(CDDTCast &rc, OMap &map) {
+	#if _USE_LRU_CACHE
+	std::cout << "...comparing CDDTCast with and without the ray cache, capacity: " << rc.cache.capacity()
+		<< " memory (MB): " << rc.cache.memory() / MB << std::endl;
+	float *samples = new float[RANDOM_SAMPLES*3];
+	Benchmark<CDDTCast>::get_random_samples(samples, RANDOM_SAMPLES, map.width, map.height);
+	time_ray_cache("random queries", rc, samples, RANDOM_SAMPLES);
+	delete[] samples;
+
+	int num_samples = PF_STEPS * PF_PARTICLES * PF_RAYS;
+	samples = new float[num_samples*3];
+	std::default_random_engine generator;
+	std::uniform_real_distribution<float> randx = std::uniform_real_distribution<float>(1.0,map.width - 1.0);
+	std::uniform_real_distribution<float> randy = std::uniform_real_distribution<float>(1.0,map.height - 1.0);
+	std::normal_distribution<float> position_noise = std::normal_distribution<float>(0.0, 2.0);
+	std::normal_distribution<float> heading_noise = std::normal_distribution<float>(0.0, 0.05);
+	float pose_x, pose_y, pose_t = 0.0;
+	do {
+		pose_x = randx(generator);
+		pose_y = randy(generator);
+	} while (map.isOccupied(pose_x, pose_y));
+
+	int q = 0;
+	for (int step = 0; step < PF_STEPS; ++step) {
+		for (int p = 0; p < PF_PARTICLES; ++p) {
+			float x = pose_x + position_noise(generator);
+			float y = pose_y + position_noise(generator);
+			float t = pose_t + heading_noise(generator);
+			for (int r = 0; r < PF_RAYS; ++r) {
+				samples[3*q] = x;
+				samples[3*q+1] = y;
+				samples[3*q+2] = t - 0.75 * M_PI + 1.5 * M_PI * r / (PF_RAYS - 1);
+				++q;
+			}
+		}
+		// drive slowly forward, turning around when about to leave free space
+		float next_x = pose_x + cosf(pose_t);
+		float next_y = pose_y + sinf(pose_t);
+		if (next_x < 1 || next_y < 1 || next_x >= map.width - 1 || next_y >= map.height - 1 || map.isOccupied(next_x, next_y)) {
+			pose_t += M_PI;
+		} else {
+			pose_x = next_x;
+			pose_y = next_y;
+		}
+	}
+	time_ray_cache("particle filter queries", rc, samples, num_samples);
+	delete[] samples;
+	#else
+	std::cout << "...ray cache not compiled in, build with -DWITH_RAY_CACHE=ON to compare it" << std::endl;
+	#endif
+}
+
+// checks the radial pair path of CDDTCast::calc_range_repeat_angles_eval_sensor_model against the
+// plain one, on a downsampled 270 degree scan like the particle filter evaluates
+void compare_radial_pairs(CDDTCast &rc, OMap &map) {
+	// the sensor model helpers convert from world coordinates, use the identity transform. Note that
+	// this swaps the x and y axes: the ray casts start at (query y, query x)
+	OMap *world = rc.getMap();
+	world->world_scale = 1.0;
+	world->world_angle = 0.0;
+	world->world_origin_x = 0.0;
+	world->world_origin_y = 0.0;
+	world->world_sin_angle = 0.0;
+	world->world_cos_angle = 1.0;
+
+	int table_width = MAX_DISTANCE + 1;
+	double *table = new double[table_width * table_width];
+	for (int r = 0; r < table_width; ++r)
+		for (int d = 0; d < table_width; ++d)
+			table[r * table_width + d] = 0.01 + std::exp(-(r - d) * (r - d) / (2.0 * 8.0 * 8.0));
+	rc.set_sensor_model(table, table_width);
+
+	int num_angles = PF_RAYS + 1;
+	float *angles = new float[num_angles];
+	for (int a = 0; a < num_angles; ++a)
+		angles[a] = -0.75 * M_PI + 1.5 * M_PI * a / (num_angles - 1);
+
+	std::default_random_engine generator;
+	std::uniform_real_distribution<float> randx = std::uniform_real_distribution<float>(1.0,map.width - 1.0);
+	std::uniform_real_distribution<float> randy = std::uniform_real_distribution<float>(1.0,map.height - 1.0);
+	std::uniform_real_distribution<float> randt = std::uniform_real_distribution<float>(0.0,M_2PI);
+	float *ins = new float[PF_PARTICLES * 3];
+	for (int i = 0; i < PF_PARTICLES; ++i) {
+		float x, y;
+		do {
+			x = randx(generator);
+			y = randy(generator);
+		} while (map.isOccupied(x, y));
+		ins[3*i] = y;
+		ins[3*i+1] = x;
+		ins[3*i+2] = randt(generator);
+	}
+
+	// the observation is the scan seen from the first particle
+	float *obs = new float[num_angles];
+	rc.numpy_calc_range_angles(ins, angles, obs, 1, num_angles);
+
+	double *plain = new double[PF_PARTICLES];
+	double *paired = new double[PF_PARTICLES];
+	auto plain_start = std::chrono::high_resolution_clock::now();
+	rc.RangeMethod::calc_range_repeat_angles_eval_sensor_model(ins, angles, obs, plain, PF_PARTICLES, num_angles);
+	auto plain_end = std::chrono::high_resolution_clock::now();
+	rc.calc_range_repeat_angles_eval_sensor_model(ins, angles, obs, paired, PF_PARTICLES, num_angles);
+	auto paired_end = std::chrono::high_resolution_clock::now();
+	std::chrono::duration<double> plain_dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(plain_end - plain_start);
+	std::chrono::duration<double> paired_dur = 
+		std::chrono::duration_cast<std::chrono::duration<double>>(paired_end - plain_end);
+
+	// the ranges are the same, but -ffast-math lets the compiler reorder the products of the weights
+	// differently in the two loops, so expect differences in the last few bits. Without it they are identical
+	int mismatches = 0;
+	double max_relative_error = 0.0;
+	for (int i = 0; i < PF_PARTICLES; ++i) {
+		if (plain[i] == paired[i]) continue;
+		++mismatches;
+		max_relative_error = std::max(max_relative_error, std::abs(plain[i] - paired[i]) / std::max(plain[i], paired[i]));
+	}
+	std::vector<int> primary, partner, singles;
+	rc.find_radial_pairs(angles, num_angles, primary, partner, singles);
+
+	std::cout << "...radial pair vs plain sensor model evaluation, " << PF_PARTICLES << " particles x "
+		<< num_angles << " rays" << std::endl;
+	std::cout << ".....lookups per particle: " << primary.size() + singles.size() << " instead of " << num_angles << std::endl;
+	std::cout << ".....plain rays/sec: " << PF_PARTICLES * num_angles / plain_dur.count()
+		<< ", radial pairs rays/sec: " << PF_PARTICLES * num_angles / paired_dur.count()
+		<< ", speedup: " << plain_dur.count() / paired_dur.count() << std::endl;
+	std::cout << ".....particles with different weights: " << mismatches
+		<< ", largest relative difference: " << max_relative_error << std::endl;
+
+	delete[] table;
+	delete[] angles;
+	delete[] ins;
+	delete[] obs;
+	delete[] plain;
+	delete[] paired;
+}
+
 int main(int argc, char *argv[])
 {
 	// set usage message
@@ -195,6 +463,21 @@ int main(int argc, char *argv[])
 		else if (FLAGS_which_benchmark == "random")
 			mark.random_sample(RANDOM_SAMPLES);
 
+		if (FLAGS_which_benchmark == "grid") {
+			int num_samples = Benchmark<RayMarching>::num_grid_samples(GRID_STEP, GRID_RAYS, GRID_SAMPLES, map.width, map.height);
+			float *samples = new float[num_samples*3];
+			Benchmark<RayMarching>::get_grid_samples(samples, GRID_STEP, GRID_RAYS, GRID_SAMPLES, map.width, map.height);
+			compare_batched_ray_marching(rm, samples, num_samples);
+			compare_distance_types(map, samples, num_samples);
+			delete[] samples;
+		} else if (FLAGS_which_benchmark == "random") {
+			float *samples = new float[RANDOM_SAMPLES*3];
+			Benchmark<RayMarching>::get_random_samples(samples, RANDOM_SAMPLES, map.width, map.height);
+			compare_batched_ray_marching(rm, samples, RANDOM_SAMPLES);
+			compare_distance_types(map, samples, RANDOM_SAMPLES);
+			delete[] samples;
+		}
+
 		if (!FLAGS_query.empty()) {
 			std::cout << "...querying pose:" << FLAGS_query << std::endl;
 			std::cout << "...   range: " << rm.calc_range(query_x,query_y,query_t) << std::endl;
@@ -242,6 +525,8 @@ int main(int argc, char *argv[])
 			if (DO_LOG) {
 				save_log(tlog, FLAGS_log_path+"/cddt.csv");
 			}
+			compare_ray_cache(rc, map);
+			compare_radial_pairs(rc, map);
 		}
 
 		if (utils::has("PrunedCDDTCast", methods) || utils::has("pcddt", methods)) {
@@ -285,15 +570,23 @@ int main(int argc, char *argv[])
 		
 
 		auto construction_start = std::chrono::high_resolution_clock::now();
-		GiantLUTCast glt = GiantLUTCast(map, MAX_DISTANCE, THETA_DISC);
+		GiantLUTCast *loaded = NULL;
+		if (!FLAGS_glt_path.empty()) loaded = GiantLUTCast::load(FLAGS_glt_path, map);
+		// copies share the table, so the loaded object can be released right away
+		GiantLUTCast glt = loaded ? *loaded : GiantLUTCast(map, MAX_DISTANCE, THETA_DISC);
+		delete loaded;
 		auto construction_end = std::chrono::high_resolution_clock::now();
 		std::chrono::duration<double> construction_dur = 
 			std::chrono::duration_cast<std::chrono::duration<double>>(construction_end - construction_start);
 
 
 		Benchmark<GiantLUTCast> mark = Benchmark<GiantLUTCast>(glt);
-		std::cout << "...lut size (MB): " << glt.memory() / MB << std::endl;
+		std::cout << "...lut size (MB): " << glt.memory() / MB << (glt.is_mapped() ? " (memory mapped)" : "") << std::endl;
 		std::cout << "...construction time: " << construction_dur.count() << std::endl;
+		if (!FLAGS_glt_path.empty() && !glt.is_mapped()) {
+			std::cout << "...saving LUT to: " << FLAGS_glt_path << std::endl;
+			if (!glt.save(FLAGS_glt_path)) std::cout << "...failed to save LUT" << std::endl;
+		}
 		std::cout << "...Running grid benchmark" << std::endl;
 		if (DO_LOG) {
 			tlog.str("");
@@ -1,10 +1,16 @@
 from libcpp cimport bool
 from libcpp.string cimport string
 from libcpp.vector cimport vector
+from libc.stdint cimport int8_t, uint8_t, uint64_t
 import numpy as np
 cimport numpy as np
 from cython.operator cimport dereference as deref
 
+# sensor model weights may be float32 or float64 arrays
+ctypedef fused weight_t:
+    float
+    double
+
 USE_ROS_MAP = True
 if USE_ROS_MAP:
     from nav_msgs.msg import OccupancyGrid
@@ -33,6 +39,8 @@ cdef extern from "includes/RangeLib.h" namespace "ranges":
         bool save(string filename)
         bool error()
         bool get(int x, int y)
+        uint64_t hash()
+        void update_region(int x0, int y0, int w, int h, uint8_t *region)
 
         # constants for coordinate space conversion
         float world_scale 
@@ -45,39 +53,77 @@ cdef extern from "includes/RangeLib.h" namespace "ranges":
     cdef cppclass BresenhamsLine:
         BresenhamsLine(OMap m, float mr)
         float calc_range(float x, float y, float heading)
-        void numpy_calc_range(float * ins, float * outs, int num_casts)
+        int memory()
+        void numpy_calc_range(float * ins, float * outs, int num_casts) nogil
         bool saveTrace(string filename)
-        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles)
+        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model(float * obs, float * ranges, float * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, double * outs, int rays_per_particle, int particles, double inv_squash) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, float * outs, int rays_per_particle, int particles, double inv_squash) nogil
         void set_sensor_model(double * table, int width)
-        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
-        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles)
+        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles, double inv_squash) nogil
     cdef cppclass RayMarching:
         RayMarching(OMap m, float mr)
         float calc_range(float x, float y, float heading)
-        void numpy_calc_range(float * ins, float * outs, int num_casts)
+        int memory()
+        void numpy_calc_range(float * ins, float * outs, int num_casts) nogil
         bool saveTrace(string filename)
-        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles)
+        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model(float * obs, float * ranges, float * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, double * outs, int rays_per_particle, int particles, double inv_squash) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, float * outs, int rays_per_particle, int particles, double inv_squash) nogil
         void set_sensor_model(double * table, int width)
-        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
-        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles)
+        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void refresh(OMap &m, int x0, int y0, int w, int h) nogil
     cdef cppclass CDDTCast:
         CDDTCast(OMap m, float mr, unsigned int td)
         float calc_range(float x, float y, float heading)
+        float maxRange()
+        int memory()
         void prune(float max_range)
-        void numpy_calc_range(float * ins, float * outs, int num_casts)
-        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles)
+        bool save(string filename)
+        @staticmethod
+        CDDTCast *load(string filename, OMap m)
+        void numpy_calc_range(float * ins, float * outs, int num_casts) nogil
+        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model(float * obs, float * ranges, float * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, double * outs, int rays_per_particle, int particles, double inv_squash) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, float * outs, int rays_per_particle, int particles, double inv_squash) nogil
         void set_sensor_model(double * table, int width)
-        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
-        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles)
-        void calc_range_many_radial_optimized(float * ins, float * outs, int num_particles, int num_rays, float min_angle, float max_angle)
+        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void calc_range_many_radial_optimized(float * ins, float * outs, int num_particles, int num_rays, float min_angle, float max_angle) nogil
     cdef cppclass GiantLUTCast:
         GiantLUTCast(OMap m, float mr, unsigned int td)
         float calc_range(float x, float y, float heading)
-        void numpy_calc_range(float * ins, float * outs, int num_casts)
-        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles)
+        float maxRange()
+        size_t memory()
+        bool is_mapped()
+        bool save(string filename)
+        @staticmethod
+        GiantLUTCast *load(string filename, OMap m, bool use_mmap)
+        void numpy_calc_range(float * ins, float * outs, int num_casts) nogil
+        void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model(float * obs, float * ranges, float * outs, int rays_per_particle, int particles) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, double * outs, int rays_per_particle, int particles, double inv_squash) nogil
+        void eval_sensor_model_log(float * obs, float * ranges, float * outs, int rays_per_particle, int particles, double inv_squash) nogil
         void set_sensor_model(double * table, int width)
-        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
-        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles)
+        void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles, double inv_squash) nogil
+        void calc_range_repeat_angles_eval_sensor_model_log(float * ins, float * angles, float * obs, float * weights, int num_particles, int num_angles, double inv_squash) nogil
     # you can only use this if USE_CUDA is true
     cdef cppclass RayMarchingGPU:
         RayMarchingGPU(OMap m, float mr)
@@ -87,9 +133,14 @@ cdef extern from "includes/RangeLib.h" namespace "ranges":
         void numpy_calc_range(float * ins, float * outs, int num_casts)
         void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
         void eval_sensor_model(float * obs, float * ranges, double * outs, int rays_per_particle, int particles)
+        void eval_sensor_model(float * obs, float * ranges, float * outs, int rays_per_particle, int particles)
+        void eval_sensor_model_log(float * obs, float * ranges, double * outs, int rays_per_particle, int particles, double inv_squash)
+        void eval_sensor_model_log(float * obs, float * ranges, float * outs, int rays_per_particle, int particles, double inv_squash)
         void set_sensor_model(double * table, int width)
         # void numpy_calc_range_angles(float * ins, float * angles, float * outs, int num_casts, int num_angles)
         void calc_range_repeat_angles_eval_sensor_model(float * ins, float * angles, float * obs, double * weights, int num_particles, int num_angles)
+    double c_normalize_log_weights "ranges::normalize_log_weights"(double * log_likelihoods, double * weights, int n, bool multiply) nogil
+    double c_normalize_log_weights "ranges::normalize_log_weights"(float * log_likelihoods, float * weights, int n, bool multiply) nogil
 
 # define flags
 USE_CACHED_TRIG = _USE_CACHED_TRIG
@@ -100,22 +151,81 @@ NO_INLINE = _NO_INLINE
 USE_LRU_CACHE = _USE_LRU_CACHE
 LRU_CACHE_SIZE = _LRU_CACHE_SIZE
 SHOULD_USE_CUDA = USE_CUDA
+# the CPU range methods release the GIL while casting rays. Queries can be split across threads
+# unless the trace map is compiled in, which is shared mutable state. The CDDTCast ray cache is
+# lock free and may be shared
+THREAD_SAFE = not _MAKE_TRACE_MAP
 
 '''
 Docs:
 
 PyOMap: wraps OMap class
-    constructor: PyOMap(arg1, arg2=None)
+    constructor: PyOMap(arg1, arg2=None, resolution=None, origin=None, occupied_threshold=None)
         Type options: <type(arg1)> <type(arg2)>
             <int width>, <int height> : empty omap of size width, height
             <string map_path>         : loads map from png image at given path
             <string map_path>, <float>: loads map from png image at given path with given occupancy threshold
-            <numpy.ndarray>           : loads map from given numpy boolean array
+            <OccupancyGrid>           : loads map from a ROS map message, including its resolution and origin
+            <numpy.ndarray>           : loads map from a 2D (height, width) array laid out like the
+                                        OccupancyGrid data. Nonzero cells are occupied, or with
+                                        occupied_threshold the cells above it: pass 10 for arrays in the
+                                        OccupancyGrid convention (0: free, -1: unknown, 100: occupied),
+                                        the rule used for messages. C-contiguous bool and uint8 arrays,
+                                        and int8 arrays with a threshold, are read in place without a
+                                        copy. The optional resolution (meters per pixel) and origin
+                                        (x, y, yaw) set the world coordinate conversion, like the info
+                                        of an OccupancyGrid
     methods:
         bool save(string filename)    : saves the occupancy grid to given path in png format. 
                                         white == free, black == occupied
         bool isOccupied(int x, int y) : returns true if the given pixel index is occupied, false otherwise
         bool error()                  : returns true if there was an error loading the map
+        int hash()                    : 64 bit hash of the map size and occupancy
+        update_region(int x0, int y0, numpy.ndarray region)
+                                      : sets the occupancy of pixel (x0 + i, y0 + j) to region[i,j] != 0.
+                                        For maps made from an OccupancyGrid x is the row of the message
+                                        data and y the column. Returns the (x0, y0, width, height) of the
+                                        updated pixels, clipped to the map
+
+PyBresenhamsLine, PyRayMarching, PyCDDTCast, PyGiantLUTCast:
+    methods:
+        int memory()                  : bytes used by the range method's data structures
+        eval_sensor_model_log(obs, ranges, outs, num_rays, num_particles, inv_squash_factor=1.0)
+        calc_range_repeat_angles_eval_sensor_model_log(ins, angles, obs, log_weights, inv_squash_factor=1.0)
+                                      : same as the functions without _log, but write the log of each
+                                        weight raised to the power inv_squash_factor. The log of the
+                                        sensor model table is summed instead of multiplying the table,
+                                        so long scans do not underflow. PyRayMarchingGPU only has
+                                        eval_sensor_model_log, its calc_range_repeat_angles_eval_sensor_model_log
+                                        raises NotImplementedError
+        The weights written by eval_sensor_model(_log) of every range method, and by the
+        calc_range_repeat_angles_eval_sensor_model(_log) functions of the CPU range methods, may be
+        float32 or float64 arrays. PyRayMarchingGPU.calc_range_repeat_angles_eval_sensor_model only
+        takes float64 weights. float32 weights should come from the _log functions, the product of a
+        scan underflows float32 quickly
+
+normalize_log_weights(log_likelihoods, weights, multiply=False)
+                                      : turns log weights into normalized weights, multiplying them into
+                                        the prior in weights if multiply is true. Returns the effective
+                                        sample size
+
+PyRayMarching:
+    methods:
+        refresh(PyOMap, region)       : copies the given (x0, y0, width, height) region of the map into
+                                        the range method, as returned by PyOMap.update_region. Only the
+                                        affected rows and columns of the distance transform are rebuilt
+
+PyCDDTCast, PyGiantLUTCast: precomputed lookup table range methods
+    methods:
+        bool save(string filename)    : saves the lookup table to given path in a binary format,
+                                        returns true on success
+        load(string filename, PyOMap) : static, returns the range method saved at the given path,
+                                        or None if the file is missing or was saved for another map
+    PyGiantLUTCast only:
+        load(string filename, PyOMap, bool use_mmap=True)
+                                      : by default the file is memory mapped read only, so the table
+                                        is paged in on demand and shared between processes
+        bool is_mapped()              : true if the table is memory mapped from a file
 
 '''
 
@@ -127,9 +237,35 @@ def quaternion_to_angle(q):
     roll, pitch, yaw = tf.transformations.euler_from_quaternion((x, y, z, w))
     return yaw
 
+def normalize_log_weights(weight_t[::1] log_likelihoods, weight_t[::1] weights, bool multiply=False):
+    """Turns the log likelihoods from the *_log sensor model functions into normalized weights,
+    written to weights. With multiply=True weights holds the prior and is multiplied by the
+    likelihoods. log_likelihoods may be the same array as weights. Returns the effective sample size.
+    """
+    if log_likelihoods.shape[0] != weights.shape[0]:
+        raise ValueError("log_likelihoods and weights must be the same length")
+    cdef double n_eff
+    with nogil:
+        n_eff = c_normalize_log_weights(&log_likelihoods[0], &weights[0], weights.shape[0], multiply)
+    return n_eff
+
+cdef void fill_grid_int8(OMap *omap, const int8_t[:, ::1] cells, int8_t threshold) nogil:
+    cdef int x, y
+    for x in range(cells.shape[0]):
+        for y in range(cells.shape[1]):
+            if cells[x, y] > threshold:
+                omap.grid[x][y] = True
+
+cdef void fill_grid_uint8(OMap *omap, const uint8_t[:, ::1] cells, uint8_t threshold) nogil:
+    cdef int x, y
+    for x in range(cells.shape[0]):
+        for y in range(cells.shape[1]):
+            if cells[x, y] > threshold:
+                omap.grid[x][y] = True
+
 cdef class PyOMap:
     cdef OMap *thisptr      # hold a C++ instance which we're wrapping
-    def __cinit__(self, arg1, arg2=None):
+    def __cinit__(self, arg1, arg2=None, resolution=None, origin=None, occupied_threshold=None):
         set_trans_params = False
         if arg1 is not None and arg2 is not None:
             if isinstance(arg1, int) and isinstance(arg1, int):
@@ -138,32 +274,21 @@ cdef class PyOMap:
                 self.thisptr = new OMap(<string>arg1,<float>arg2)
         elif arg1 is not None:
             if isinstance(arg1, np.ndarray):
-                height, width = arg1.shape
-                self.thisptr = new OMap(<int>height,<int>width)
-                for y in xrange(height):
-                    for x in xrange(width):
-                        self.thisptr.grid[x][y] = <bool>arg1[y,x]
+                self.set_cells(arg1, occupied_threshold)
+                if resolution is not None or origin is not None:
+                    x, y, angle = origin if origin is not None else (0.0, 0.0, 0.0)
+                    self.set_world_params(1.0 if resolution is None else resolution, x, y, angle)
+                    set_trans_params = True
             elif USE_ROS_MAP and isinstance(arg1, OccupancyGrid):
                 map_msg = arg1
                 width, height = map_msg.info.width, map_msg.info.height
-                self.thisptr = new OMap(<int>height,<int>width)
-
+                # message data is a python sequence, convert it once and read it like an array
                 # 0: permissible, -1: unmapped, 100: blocked
-                array_255 = np.array(map_msg.data).reshape((height, width))
-
-                for x in xrange(height):
-                    for y in xrange(width):
-                        if array_255[x,y] > 10:
-                            self.thisptr.grid[x][y] = True
+                self.set_cells(np.asarray(map_msg.data).reshape((height, width)), 10)
 
                 # cache constants for coordinate space conversion
-                angle = -1.0*quaternion_to_angle(map_msg.info.origin.orientation)
-                self.thisptr.world_scale = map_msg.info.resolution
-                self.thisptr.world_angle = angle
-                self.thisptr.world_origin_x = map_msg.info.origin.position.x
-                self.thisptr.world_origin_y = map_msg.info.origin.position.y
-                self.thisptr.world_sin_angle = np.sin(angle)
-                self.thisptr.world_cos_angle = np.cos(angle)
+                self.set_world_params(map_msg.info.resolution, map_msg.info.origin.position.x, map_msg.info.origin.position.y,
+                                      quaternion_to_angle(map_msg.info.origin.orientation))
                 set_trans_params = True
             else:
                 self.thisptr = new OMap(arg1)
@@ -182,6 +307,35 @@ cdef class PyOMap:
     def __dealloc__(self):
         del self.thisptr
 
+    cdef set_cells(self, cells, threshold):
+        # the omap x axis is the row of the array, and y the column. Cells above threshold are
+        # occupied, or nonzero cells if threshold is None
+        if cells.ndim != 2:
+            raise ValueError("expected a 2D occupancy array, got shape %s" % (cells.shape,))
+        height, width = cells.shape
+        self.thisptr = new OMap(<int>height,<int>width)
+        if threshold is None:
+            if cells.dtype == np.bool_ or cells.dtype == np.uint8:
+                fill_grid_uint8(self.thisptr, np.ascontiguousarray(cells).view(np.uint8), 0)
+            else:
+                fill_grid_uint8(self.thisptr, np.ascontiguousarray(cells != 0).view(np.uint8), 0)
+        elif cells.dtype == np.int8 and -128 <= threshold < 127:
+            fill_grid_int8(self.thisptr, np.ascontiguousarray(cells), <int8_t>threshold)
+        elif cells.dtype == np.uint8 and 0 <= threshold < 255:
+            fill_grid_uint8(self.thisptr, np.ascontiguousarray(cells), <uint8_t>threshold)
+        else:
+            fill_grid_uint8(self.thisptr, np.ascontiguousarray(cells > threshold).view(np.uint8), 0)
+
+    cdef set_world_params(self, float resolution, float origin_x, float origin_y, float origin_angle):
+        # cache constants for coordinate space conversion
+        angle = -1.0*origin_angle
+        self.thisptr.world_scale = resolution
+        self.thisptr.world_angle = angle
+        self.thisptr.world_origin_x = origin_x
+        self.thisptr.world_origin_y = origin_y
+        self.thisptr.world_sin_angle = np.sin(angle)
+        self.thisptr.world_cos_angle = np.cos(angle)
+
     cpdef bool save(self, string fn):
         return self.thisptr.save(fn)
 
@@ -197,27 +351,55 @@ cdef class PyOMap:
     cpdef int height(self):
         return self.thisptr.height
 
+    cpdef uint64_t hash(self):
+        return self.thisptr.hash()
+
+    def update_region(self, int x0, int y0, region):
+        # region[i,j] sets the occupancy of pixel (x0 + i, y0 + j), the part outside the map is ignored
+        cdef int x1 = min(x0 + region.shape[0], self.thisptr.width)
+        cdef int y1 = min(y0 + region.shape[1], self.thisptr.height)
+        cdef int cx0 = max(x0, 0)
+        cdef int cy0 = max(y0, 0)
+        if x1 <= cx0 or y1 <= cy0:
+            return (cx0, cy0, 0, 0)
+        cdef np.ndarray[np.uint8_t, ndim=2, mode="c"] block = \
+            np.ascontiguousarray(region[cx0-x0:x1-x0, cy0-y0:y1-y0] != 0, dtype=np.uint8)
+        self.thisptr.update_region(cx0, cy0, x1 - cx0, y1 - cy0, &block[0,0])
+        return (cx0, cy0, x1 - cx0, y1 - cy0)
+
 cdef class PyBresenhamsLine:
     cdef BresenhamsLine *thisptr      # hold a C++ instance which we're wrapping
     def __cinit__(self, PyOMap Map, float max_range):
         self.thisptr = new BresenhamsLine(deref(Map.thisptr), max_range)
     def __dealloc__(self):
         del self.thisptr
+    cpdef size_t memory(self):
+        return self.thisptr.memory()
     cpdef float calc_range(self, float x, float y, float heading):
         return self.thisptr.calc_range(x, y, heading)
     cpdef void calc_range_many(self,np.ndarray[float, ndim=2, mode="c"] ins, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
     
     cpdef void calc_range_repeat_angles(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
 
-    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, np.ndarray[double, ndim=1, mode="c"] weights):
-        self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] weights):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+    cpdef void calc_range_repeat_angles_eval_sensor_model_log(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] log_weights, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model_log(&ins[0,0], &angles[0], &obs[0],  &log_weights[0], ins.shape[0], angles.shape[0], inv_squash_factor)
 
     cpdef float saveTrace(self, string path):
         self.thisptr.saveTrace(path)
-    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, np.ndarray[double, ndim=1, mode="c"] outs, int num_rays, int num_particles):
-        self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles):
+        with nogil:
+            self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model_log(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.eval_sensor_model_log(&observation[0],&ranges[0], &outs[0], num_rays, num_particles, inv_squash_factor)
     cpdef void set_sensor_model(self, np.ndarray[double, ndim=2, mode="c"] table):
         if not table.shape[0] == table.shape[1]:
             print "Sensor model must have equal matrix dimensions, failing!"
@@ -230,20 +412,40 @@ cdef class PyRayMarching:
         self.thisptr = new RayMarching(deref(Map.thisptr), max_range)
     def __dealloc__(self):
         del self.thisptr
+    cpdef size_t memory(self):
+        return self.thisptr.memory()
     cpdef float calc_range(self, float x, float y, float heading):
         return self.thisptr.calc_range(x, y, heading)
     cpdef void calc_range_many(self,np.ndarray[float, ndim=2, mode="c"] ins, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
     cpdef float saveTrace(self, string path):
         self.thisptr.saveTrace(path)
     cpdef void calc_range_repeat_angles(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
-
-    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, np.ndarray[double, ndim=1, mode="c"] weights):
-        self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
-
-    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, np.ndarray[double, ndim=1, mode="c"] outs, int num_rays, int num_particles):
-        self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+        with nogil:
+            self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
+
+    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] weights):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+    cpdef void calc_range_repeat_angles_eval_sensor_model_log(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] log_weights, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model_log(&ins[0,0], &angles[0], &obs[0],  &log_weights[0], ins.shape[0], angles.shape[0], inv_squash_factor)
+
+    def refresh(self, PyOMap Map, region):
+        cdef int x0, y0, w, h
+        x0, y0, w, h = region
+        if w <= 0 or h <= 0:
+            return
+        with nogil:
+            self.thisptr.refresh(deref(Map.thisptr), x0, y0, w, h)
+
+    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles):
+        with nogil:
+            self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model_log(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.eval_sensor_model_log(&observation[0],&ranges[0], &outs[0], num_rays, num_particles, inv_squash_factor)
     cpdef void set_sensor_model(self, np.ndarray[double, ndim=2, mode="c"] table):
         if not table.shape[0] == table.shape[1]:
             print "Sensor model must have equal matrix dimensions, failing!"
@@ -253,11 +455,25 @@ cdef class PyRayMarching:
 cdef class PyCDDTCast:
     cdef CDDTCast *thisptr      # hold a C++ instance which we're wrapping
     cdef float max_range
-    def __cinit__(self, PyOMap Map, float max_range, unsigned int theta_disc):
+    def __cinit__(self, PyOMap Map, float max_range, unsigned int theta_disc, bool build=True):
         self.max_range = max_range
-        self.thisptr = new CDDTCast(deref(Map.thisptr), max_range, theta_disc)
+        # load() passes build=False and attaches the table it read instead
+        if build:
+            self.thisptr = new CDDTCast(deref(Map.thisptr), max_range, theta_disc)
     def __dealloc__(self):
         del self.thisptr
+    cpdef bool save(self, string path):
+        return self.thisptr.save(path)
+    cpdef size_t memory(self):
+        return self.thisptr.memory()
+    @staticmethod
+    def load(string path, PyOMap Map):
+        cdef CDDTCast *loaded = CDDTCast.load(path, deref(Map.thisptr))
+        if loaded == NULL:
+            return None
+        cdef PyCDDTCast method = PyCDDTCast(Map, loaded.maxRange(), 0, False)
+        method.thisptr = loaded
+        return method
     cpdef void prune(self, float max_range=-1.0):
         if max_range < 0.0:
             self.thisptr.prune(self.max_range)
@@ -266,20 +482,31 @@ cdef class PyCDDTCast:
     cpdef float calc_range(self, float x, float y, float heading):
         return self.thisptr.calc_range(x, y, heading)
     cpdef void calc_range_many(self,np.ndarray[float, ndim=2, mode="c"] ins, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
-
-    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, np.ndarray[double, ndim=1, mode="c"] weights):
-        self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
+
+    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] weights):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+    cpdef void calc_range_repeat_angles_eval_sensor_model_log(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] log_weights, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model_log(&ins[0,0], &angles[0], &obs[0],  &log_weights[0], ins.shape[0], angles.shape[0], inv_squash_factor)
     
     cpdef void calc_range_many_radial_optimized(self, int num_rays, float min_angle, float max_angle, np.ndarray[float, ndim=2, mode="c"] ins, np.ndarray[float, ndim=1, mode="c"] outs):
         # self.thisptr.calc_range_many_radial_optimized(num_rays, min_angle, max_angle, num_particles, &ins[0,0], &outs[0])
-        self.thisptr.calc_range_many_radial_optimized(&ins[0,0], &outs[0], ins.shape[0], num_rays, min_angle, max_angle)
+        with nogil:
+            self.thisptr.calc_range_many_radial_optimized(&ins[0,0], &outs[0], ins.shape[0], num_rays, min_angle, max_angle)
 
     cpdef void calc_range_repeat_angles(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
     
-    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, np.ndarray[double, ndim=1, mode="c"] outs, int num_rays, int num_particles):
-        self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles):
+        with nogil:
+            self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model_log(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.eval_sensor_model_log(&observation[0],&ranges[0], &outs[0], num_rays, num_particles, inv_squash_factor)
     cpdef void set_sensor_model(self, np.ndarray[double, ndim=2, mode="c"] table):
         if not table.shape[0] == table.shape[1]:
             print "Sensor model must have equal matrix dimensions, failing!"
@@ -288,23 +515,49 @@ cdef class PyCDDTCast:
 
 cdef class PyGiantLUTCast:
     cdef GiantLUTCast *thisptr      # hold a C++ instance which we're wrapping
-    def __cinit__(self, PyOMap Map, float max_range, unsigned int theta_disc):
-        self.thisptr = new GiantLUTCast(deref(Map.thisptr), max_range, theta_disc)
+    def __cinit__(self, PyOMap Map, float max_range, unsigned int theta_disc, bool build=True):
+        # load() passes build=False and attaches the table it read instead
+        if build:
+            self.thisptr = new GiantLUTCast(deref(Map.thisptr), max_range, theta_disc)
     def __dealloc__(self):
         del self.thisptr
+    cpdef bool save(self, string path):
+        return self.thisptr.save(path)
+    @staticmethod
+    def load(string path, PyOMap Map, bool use_mmap=True):
+        cdef GiantLUTCast *loaded = GiantLUTCast.load(path, deref(Map.thisptr), use_mmap)
+        if loaded == NULL:
+            return None
+        cdef PyGiantLUTCast method = PyGiantLUTCast(Map, loaded.maxRange(), 0, False)
+        method.thisptr = loaded
+        return method
+    cpdef size_t memory(self):
+        return self.thisptr.memory()
+    cpdef bool is_mapped(self):
+        return self.thisptr.is_mapped()
     cpdef float calc_range(self, float x, float y, float heading):
         return self.thisptr.calc_range(x, y, heading)
     cpdef void calc_range_many(self,np.ndarray[float, ndim=2, mode="c"] ins, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
+        with nogil:
+            self.thisptr.numpy_calc_range(&ins[0,0], &outs[0], outs.shape[0])
     
     cpdef void calc_range_repeat_angles(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] outs):
-        self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
-
-    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, np.ndarray[double, ndim=1, mode="c"] weights):
-        self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
-
-    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, np.ndarray[double, ndim=1, mode="c"] outs, int num_rays, int num_particles):
-        self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+        with nogil:
+            self.thisptr.numpy_calc_range_angles(&ins[0,0], &angles[0], &outs[0], ins.shape[0], angles.shape[0])
+
+    cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] weights):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
+    cpdef void calc_range_repeat_angles_eval_sensor_model_log(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, weight_t[::1] log_weights, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.calc_range_repeat_angles_eval_sensor_model_log(&ins[0,0], &angles[0], &obs[0],  &log_weights[0], ins.shape[0], angles.shape[0], inv_squash_factor)
+
+    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles):
+        with nogil:
+            self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model_log(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles, double inv_squash_factor=1.0):
+        with nogil:
+            self.thisptr.eval_sensor_model_log(&observation[0],&ranges[0], &outs[0], num_rays, num_particles, inv_squash_factor)
     cpdef void set_sensor_model(self, np.ndarray[double, ndim=2, mode="c"] table):
         if not table.shape[0] == table.shape[1]:
             print "Sensor model must have equal matrix dimensions, failing!"
@@ -331,8 +584,13 @@ cdef class PyRayMarchingGPU:
     cpdef void calc_range_repeat_angles_eval_sensor_model(self,np.ndarray[float, ndim=2, mode="c"] ins,np.ndarray[float, ndim=1, mode="c"] angles, np.ndarray[float, ndim=1, mode="c"] obs, np.ndarray[double, ndim=1, mode="c"] weights):
         self.thisptr.calc_range_repeat_angles_eval_sensor_model(&ins[0,0], &angles[0], &obs[0],  &weights[0], ins.shape[0], angles.shape[0])
     
-    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, np.ndarray[double, ndim=1, mode="c"] outs, int num_rays, int num_particles):
+    def calc_range_repeat_angles_eval_sensor_model_log(self, ins, angles, obs, log_weights, double inv_squash_factor=1.0):
+        raise NotImplementedError("Do not use calc_range_repeat_angles_eval_sensor_model for GPU, unimplemented")
+
+    cpdef void eval_sensor_model(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles):
         self.thisptr.eval_sensor_model(&observation[0],&ranges[0], &outs[0], num_rays, num_particles)
+    cpdef void eval_sensor_model_log(self, np.ndarray[float, ndim=1, mode="c"] observation, np.ndarray[float, ndim=1, mode="c"] ranges, weight_t[::1] outs, int num_rays, int num_particles, double inv_squash_factor=1.0):
+        self.thisptr.eval_sensor_model_log(&observation[0],&ranges[0], &outs[0], num_rays, num_particles, inv_squash_factor)
     cpdef void set_sensor_model(self, np.ndarray[double, ndim=2, mode="c"] table):
         if not table.shape[0] == table.shape[1]:
             print "Sensor model must have equal matrix dimensions, failing!"
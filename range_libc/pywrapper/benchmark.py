@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the range_libc Python wrappers with the query patterns the particle filter uses.
+
+Every requested range method is built on every map and timed on:
+	calc_range_many          : uniformly random queries, like the random benchmark in main.cpp
+	calc_range_repeat_angles : particles in free space each casting a fan of rays, like a laser scan
+	calc_range_repeat_angles_eval_sensor_model
+	                         : the same fan of rays with the sensor model evaluated in the same call
+	eval_sensor_model        : sensor model evaluation of precomputed ranges
+
+Results are written as JSON with rays/sec for every pattern plus the construction time and memory of
+every range method, so runs from different builds can be compared. Pass --compare with an earlier
+result file to print the relative throughput.
+
+Queries are in range_libc's native pixel coordinate space, see the warning in test.py.
+
+Usage:
+	$ python benchmark.py --output results.json
+	$ python benchmark.py --maps ../maps/basement_hallways_5cm.png --methods rm,cddt --compare results.json
+'''
+
+import argparse, glob, json, os, platform, time
+import numpy as np
+import range_libc
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../maps")
+METHODS = ["bl", "rm", "cddt", "pcddt", "glt"]
+PATTERNS = ["calc_range_many", "calc_range_repeat_angles", "calc_range_repeat_angles_eval_sensor_model", "eval_sensor_model"]
+
+def build_info():
+	''' Compile time options of the range_libc build, so results from different builds can be told apart. '''
+	return {
+		"use_cached_trig": bool(range_libc.USE_CACHED_TRIG),
+		"use_alternate_mod": bool(range_libc.USE_ALTERNATE_MOD),
+		"use_cached_constants": bool(range_libc.USE_CACHED_CONSTANTS),
+		"use_fast_round": bool(range_libc.USE_FAST_ROUND),
+		"no_inline": bool(range_libc.NO_INLINE),
+		"use_lru_cache": bool(range_libc.USE_LRU_CACHE),
+		"lru_cache_size": int(range_libc.LRU_CACHE_SIZE),
+		"use_cuda": bool(range_libc.SHOULD_USE_CUDA),
+		"thread_safe": bool(range_libc.THREAD_SAFE),
+		"numpy": np.__version__,
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"processor": platform.processor(),
+	}
+
+def default_maps(max_pixels):
+	''' Every map in range_libc/maps that is large enough to be meaningful and small enough to build quickly. '''
+	maps = []
+	for path in sorted(glob.glob(os.path.join(MAPS_DIR, "*.png"))):
+		omap = range_libc.PyOMap(path, 1)
+		if omap.error():
+			continue
+		pixels = omap.width() * omap.height()
+		if pixels < 64 * 64 or pixels > max_pixels:
+			print "skipping map:", os.path.basename(path), "(%dx%d)" % (omap.width(), omap.height())
+			continue
+		maps.append(path)
+	return maps
+
+def make_sensor_model(max_range_px):
+	''' Sensor model table in the same form as the particle filter's: table[observed, expected], columns sum to 1. '''
+	n = int(max_range_px) + 1
+	observed, expected = np.mgrid[0:n, 0:n].astype(np.float64)
+	z_hit = np.exp(-np.square(observed - expected) / (2.0 * 8.0 ** 2)) / (8.0 * np.sqrt(2.0 * np.pi))
+	z_short = np.where(observed < expected, 2.0 * (expected - observed) / np.square(np.maximum(expected, 1.0)), 0.0)
+	z_max = (observed == n - 1).astype(np.float64)
+	table = 0.75 * z_hit + 0.1 * z_short + 0.05 * z_max + 0.1 / float(max_range_px)
+	table /= table.sum(axis=0)
+	return np.ascontiguousarray(table)
+
+def make_queries(omap, args, rng):
+	''' Random queries over the whole map, and particle poses in free space for the scan patterns. '''
+	width, height = omap.width(), omap.height()
+	random_queries = np.zeros((args.rays, 3), dtype=np.float32)
+	random_queries[:,0] = rng.uniform(1.0, width - 1.0, args.rays)
+	random_queries[:,1] = rng.uniform(1.0, height - 1.0, args.rays)
+	random_queries[:,2] = rng.uniform(0.0, 2.0 * np.pi, args.rays)
+
+	particles = np.zeros((args.particles, 3), dtype=np.float32)
+	found = 0
+	for i in xrange(100 * args.particles):
+		if found == args.particles:
+			break
+		x, y = rng.uniform(1.0, width - 1.0), rng.uniform(1.0, height - 1.0)
+		if not omap.isOccupied(int(x), int(y)):
+			particles[found] = [x, y, rng.uniform(0.0, 2.0 * np.pi)]
+			found += 1
+	if found < args.particles:
+		# almost completely occupied map, fall back to arbitrary poses
+		particles[found:,0] = rng.uniform(1.0, width - 1.0, args.particles - found)
+		particles[found:,1] = rng.uniform(1.0, height - 1.0, args.particles - found)
+
+	# downsampled hokuyo field of view
+	angles = np.linspace(-0.75 * np.pi, 0.75 * np.pi, args.beams).astype(np.float32)
+	return random_queries, particles, angles
+
+def construct(method, omap, args):
+	''' Returns the range method, the time it took to build and any extra build details. '''
+	start = time.time()
+	details = {}
+	if method == "bl":
+		range_method = range_libc.PyBresenhamsLine(omap, args.max_range)
+	elif method == "rm":
+		range_method = range_libc.PyRayMarching(omap, args.max_range)
+	elif method == "rmgpu":
+		range_method = range_libc.PyRayMarchingGPU(omap, args.max_range)
+	elif method in ("cddt", "pcddt"):
+		range_method = range_libc.PyCDDTCast(omap, args.max_range, args.theta_discretization)
+		if method == "pcddt":
+			prune_start = time.time()
+			range_method.prune()
+			details["prune_sec"] = time.time() - prune_start
+	elif method == "glt":
+		range_method = range_libc.PyGiantLUTCast(omap, args.max_range, args.theta_discretization)
+	else:
+		raise ValueError("unknown range method: " + method)
+	return range_method, time.time() - start, details
+
+def time_call(fn, reps):
+	''' Median wall time of reps calls, after one warm up call. '''
+	fn()
+	times = []
+	for i in xrange(reps):
+		start = time.time()
+		fn()
+		times.append(time.time() - start)
+	return float(np.median(times))
+
+def time_patterns(range_method, random_queries, particles, angles, args):
+	num_rays = particles.shape[0] * angles.shape[0]
+	random_ranges = np.zeros(random_queries.shape[0], dtype=np.float32)
+	ranges = np.zeros(num_rays, dtype=np.float32)
+	weights = np.zeros(particles.shape[0], dtype=np.float64)
+
+	# the observation is the scan seen from the first particle, so the sensor model sees realistic values
+	observation = np.zeros(angles.shape[0], dtype=np.float32)
+	range_method.calc_range_repeat_angles(particles[:1], angles, observation)
+	range_method.set_sensor_model(make_sensor_model(args.max_range))
+	range_method.calc_range_repeat_angles(particles, angles, ranges)
+
+	calls = {
+		"calc_range_many": (lambda: range_method.calc_range_many(random_queries, random_ranges), random_queries.shape[0]),
+		"calc_range_repeat_angles": (lambda: range_method.calc_range_repeat_angles(particles, angles, ranges), num_rays),
+		"calc_range_repeat_angles_eval_sensor_model":
+			(lambda: range_method.calc_range_repeat_angles_eval_sensor_model(particles, angles, observation, weights), num_rays),
+		"eval_sensor_model":
+			(lambda: range_method.eval_sensor_model(observation, ranges, weights, angles.shape[0], particles.shape[0]), num_rays),
+	}
+	results = {}
+	for pattern in args.patterns:
+		fn, rays = calls[pattern]
+		sec = time_call(fn, args.reps)
+		results[pattern] = {"rays": rays, "sec_per_call": sec, "rays_per_sec": rays / sec}
+	return results
+
+def run(args):
+	results = []
+	for map_path in args.maps:
+		omap = range_libc.PyOMap(map_path, 1)
+		if omap.error():
+			print "could not load map:", map_path
+			continue
+		rng = np.random.RandomState(args.seed)
+		random_queries, particles, angles = make_queries(omap, args, rng)
+		for method in args.methods:
+			print "map:", os.path.basename(map_path), " method:", method
+			range_method, construction_sec, details = construct(method, omap, args)
+			result = {
+				"map": os.path.basename(map_path),
+				"width": omap.width(),
+				"height": omap.height(),
+				"method": method,
+				"construction_sec": construction_sec,
+				"memory_bytes": int(range_method.memory()) if hasattr(range_method, "memory") else None,
+				"patterns": time_patterns(range_method, random_queries, particles, angles, args),
+			}
+			result.update(details)
+			for pattern in args.patterns:
+				print "    %-44s %12.0f rays/sec" % (pattern, result["patterns"][pattern]["rays_per_sec"])
+			results.append(result)
+			del range_method
+	return results
+
+def compare(results, baseline):
+	''' Prints the throughput of each result relative to the matching entry of an earlier run. '''
+	previous = dict(((r["map"], r["method"]), r) for r in baseline["results"])
+	print
+	print "relative to baseline (>1 is faster):"
+	for result in results:
+		old = previous.get((result["map"], result["method"]))
+		if old is None:
+			continue
+		ratios = []
+		for pattern in PATTERNS:
+			if pattern in result["patterns"] and pattern in old["patterns"]:
+				ratios.append("%s %.2fx" % (pattern, result["patterns"][pattern]["rays_per_sec"] / old["patterns"][pattern]["rays_per_sec"]))
+		print "  %-28s %-6s" % (result["map"], result["method"]), ", ".join(ratios)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the range_libc Python wrappers.")
+	parser.add_argument("--maps", nargs="*", default=None, help="map images, defaults to every map in range_libc/maps")
+	parser.add_argument("--max_pixels", type=int, default=4000000, help="largest default map to include, in pixels")
+	parser.add_argument("--methods", default=",".join(METHODS), help="comma separated list of: bl,rm,rmgpu,cddt,pcddt,glt")
+	parser.add_argument("--patterns", default=",".join(PATTERNS), help="comma separated list of: " + ",".join(PATTERNS))
+	parser.add_argument("--max_range", type=float, default=500)
+	parser.add_argument("--theta_discretization", type=int, default=108)
+	parser.add_argument("--rays", type=int, default=100000, help="number of random queries for calc_range_many")
+	parser.add_argument("--particles", type=int, default=4000)
+	parser.add_argument("--beams", type=int, default=61, help="rays cast per particle")
+	parser.add_argument("--reps", type=int, default=5, help="timed calls per pattern, the median is reported")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="path of the JSON results, printed if not given")
+	parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+	args = parser.parse_args()
+
+	args.methods = args.methods.split(",")
+	args.patterns = args.patterns.split(",")
+	for pattern in args.patterns:
+		if pattern not in PATTERNS:
+			parser.error("unknown pattern: " + pattern)
+	if "rmgpu" in args.methods and not range_libc.SHOULD_USE_CUDA:
+		parser.error("rmgpu needs range_libc compiled with CUDA")
+	if not args.maps:
+		args.maps = default_maps(args.max_pixels)
+
+	config = dict((k, v) for k, v in vars(args).items() if k not in ("output", "compare"))
+	report = {"build": build_info(), "config": config, "results": run(args)}
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+		print "saved results to:", args.output
+	else:
+		print json.dumps(report, indent=2, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(report["results"], json.load(f))
@@ -30,6 +30,12 @@ use_cuda = check_for_flag("WITH_CUDA", \
 trace    = check_for_flag("TRACE", \
 	"Compiling with trace enabled for Bresenham's Line", \
 	"Compiling without trace enabled for Bresenham's Line")
+no_simd  = check_for_flag("NO_SIMD", \
+	"Compiling without batched SIMD ray marching, RayMarching casts one ray at a time", \
+	False)
+ray_cache = check_for_flag("WITH_RAY_CACHE", \
+	"Compiling with the CDDTCast ray cache", \
+	False)
 
 print 
 print "--------------"
@@ -113,6 +119,17 @@ if use_cuda:
 if trace:
 	compiler_flags.append("-D_MAKE_TRACE_MAP=1")
 
+if no_simd:
+	compiler_flags.append("-D_RM_SIMD=0")
+
+if ray_cache:
+	compiler_flags.append("-D_USE_LRU_CACHE=1")
+
+# storage type of the RayMarching distance transform: float, uint16_t (default) or uint8_t
+if "RM_DISTANCE_TYPE" in os.environ:
+	print "Compiling with RayMarching distance transform type:", os.environ["RM_DISTANCE_TYPE"]
+	compiler_flags.append("-D_RM_DISTANCE_TYPE="+os.environ["RM_DISTANCE_TYPE"])
+
 
 ##################################################################
 